@@ -1,23 +1,26 @@
 from __future__ import absolute_import, unicode_literals
 from past.builtins import basestring
+import math
 import os
+import shutil
+from collections import defaultdict
 from itertools import chain, islice
 from . import exceptions
-from adsmp.models import ChangeLog, IdentifierMapping, MetricsBase, MetricsModel, Records, SitemapInfo
+from adsmp.models import ChangeLog, IdentifierMapping, KeyValue, MetricsBase, MetricsModel, Records, SitemapFile, SitemapFileSite, SitemapInfo, SitemapRun, SolrDoc
 from adsmsg import OrcidClaims, DenormalizedRecord, FulltextUpdate, MetricsRecord, NonBibRecord, NonBibRecordList, MetricsRecordList, AugmentAffiliationResponseRecord, AugmentAffiliationRequestRecord, ClassifyRequestRecord, ClassifyRequestRecordList, ClassifyResponseRecord, ClassifyResponseRecordList, BoostRequestRecord, BoostRequestRecordList, BoostResponseRecord, BoostResponseRecordList,Status as AdsMsgStatus
 from adsmsg.msg import Msg
 from adsputils import ADSCelery, create_engine, sessionmaker, scoped_session, contextmanager
 from sqlalchemy.orm import load_only as _load_only
-from sqlalchemy import Table, bindparam, func
+from sqlalchemy import Table, and_, bindparam, case, func, not_, or_
 import adsputils
 import json
 from adsmp import solr_updater
 from adsmp import templates
+from adsmp.datalinks_updater import DatalinksUpdater, make_delta, row_fingerprints
 from adsputils import serializer
 from sqlalchemy import exc
 from multiprocessing.util import register_after_fork
 import zlib
-import requests
 from copy import deepcopy
 import sys
 from sqlalchemy.dialects.postgresql import insert
@@ -25,96 +28,179 @@ import csv
 from datetime import timedelta
 from SciXPipelineUtils import scix_id
 
+
+def sitemap_file_index(filename):
+    """The number of a sitemap file, 3 for sitemap_bib_3.xml; None for a
+    name that doesn't follow the sitemap_bib_N.xml pattern"""
+    try:
+        return int(filename.split('_bib_')[1].split('.')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def checksum(data, ignore_keys=('mtime', 'ctime', 'update_timestamp')):
+    """
+    Compute checksum of the passed in data. Preferred situation is when you
+    give us a dictionary. We can clean it up, remove the 'ignore_keys' and
+    sort the keys. Then compute CRC on the string version. You can also pass
+    a string, in which case we simple return the checksum.
+    
+    @param data: string or dict
+    @param ignore_keys: list of patterns, if they are found (anywhere) in
+        the key name, we'll ignore this key-value pair
+    @return: checksum
+    """
+    assert isinstance(ignore_keys, tuple)
+
+    if isinstance(data, basestring):
+        if sys.version_info > (3,):
+            data_str = data.encode('utf-8')
+        else:
+            data_str = unicode(data)
+        return hex(zlib.crc32(data_str) & 0xffffffff)
+    else:
+        data = deepcopy(data)
+        # remove all the modification timestamps
+        for k, v in list(data.items()):
+            for x in ignore_keys:
+                if x in k:
+                    del data[k]
+                    break
+        if sys.version_info > (3,):
+            data_str = json.dumps(data, sort_keys=True).encode('utf-8')
+        else:
+            data_str = json.dumps(data, sort_keys=True)
+        return hex(zlib.crc32(data_str) & 0xffffffff)
+
+
+def build_metrics_upsert():
+    """Returns the bulk upsert statement for the metrics table, it is built
+    from MetricsModel so no database reflection is needed"""
+    insert_columns = {
+        'an_refereed_citations': bindparam('an_refereed_citations', required=False),
+        'an_citations': bindparam('an_citations', required=False),
+        'author_num': bindparam('author_num', required=False),
+        'bibcode': bindparam('bibcode'),
+        'citations': bindparam('citations', required=False),
+        'citation_num': bindparam('citation_num', required=False),
+        'downloads': bindparam('downloads', required=False),
+        'reads': bindparam('reads', required=False),
+        'refereed': bindparam('refereed', required=False, value=False),
+        'refereed_citations': bindparam('refereed_citations', required=False),
+        'refereed_citation_num': bindparam('refereed_citation_num', required=False),
+        'reference_num': bindparam('reference_num', required=False),
+        'rn_citations': bindparam('rn_citations', required=False),
+        'rn_citation_data': bindparam('rn_citation_data', required=False),
+    }
+    upsert = insert(MetricsModel).values(insert_columns)
+    # on insert conflict we specify which columns update
+    update_columns = {
+        'an_refereed_citations': getattr(upsert.excluded, 'an_refereed_citations'),
+        'an_citations': getattr(upsert.excluded, 'an_citations'),
+        'author_num': getattr(upsert.excluded, 'author_num'),
+        'citations': getattr(upsert.excluded, 'citations'),
+        'citation_num': getattr(upsert.excluded, 'citation_num'),
+        'downloads': getattr(upsert.excluded, 'downloads'),
+        'reads': getattr(upsert.excluded, 'reads'),
+        'refereed': getattr(upsert.excluded, 'refereed'),
+        'refereed_citations': getattr(upsert.excluded, 'refereed_citations'),
+        'refereed_citation_num': getattr(upsert.excluded, 'refereed_citation_num'),
+        'reference_num': getattr(upsert.excluded, 'reference_num'),
+        'rn_citations': getattr(upsert.excluded, 'rn_citations'),
+        'rn_citation_data': getattr(upsert.excluded, 'rn_citation_data')}
+    return upsert.on_conflict_do_update(index_elements=['bibcode'], set_=update_columns)
+
+
 class ADSMasterPipelineCelery(ADSCelery):
 
     def __init__(self, app_name, *args, **kwargs):
         ADSCelery.__init__(self, app_name, *args, **kwargs)
-        # this is used for bulk/efficient updates to metrics db
-        self._metrics_engine = self._metrics_session = None
-        if self._config.get('METRICS_SQLALCHEMY_URL', None):
-            self._metrics_engine = create_engine(self._config.get('METRICS_SQLALCHEMY_URL', 'sqlite:///'),
-                                                 echo=self._config.get('SQLALCHEMY_ECHO', False))
+        # this is used for bulk/efficient updates to metrics db; the engine,
+        # session and table are only created when first used (most workers
+        # and run.py invocations never touch the metrics db)
+        self._metrics_db = None
+        self._metrics_reflected_table = None
+        self._datalinks_updater = None
+
+    def _init_metrics_db(self):
+        """Creates the metrics engine and session on first use.
+
+        :return: dict with 'engine' and 'session' or None if METRICS_SQLALCHEMY_URL is not set
+        """
+        if self._metrics_db is None and self._config.get('METRICS_SQLALCHEMY_URL', None):
+            engine = create_engine(self._config.get('METRICS_SQLALCHEMY_URL', 'sqlite:///'),
+                                   echo=self._config.get('SQLALCHEMY_ECHO', False))
             _msession_factory = sessionmaker()
-            self._metrics_session = scoped_session(_msession_factory)
-            self._metrics_session.configure(bind=self._metrics_engine)
-
-            MetricsBase.metadata.bind = self._metrics_engine
-            self._metrics_table = Table('metrics', MetricsBase.metadata, autoload=True, autoload_with=self._metrics_engine)
-            register_after_fork(self._metrics_engine, self._metrics_engine.dispose)
-
-            insert_columns = {
-                'an_refereed_citations': bindparam('an_refereed_citations', required=False),
-                'an_citations': bindparam('an_citations', required=False),
-                'author_num': bindparam('author_num', required=False),
-                'bibcode': bindparam('bibcode'),
-                'citations': bindparam('citations', required=False),
-                'citation_num': bindparam('citation_num', required=False),
-                'downloads': bindparam('downloads', required=False),
-                'reads': bindparam('reads', required=False),
-                'refereed': bindparam('refereed', required=False, value=False),
-                'refereed_citations': bindparam('refereed_citations', required=False),
-                'refereed_citation_num': bindparam('refereed_citation_num', required=False),
-                'reference_num': bindparam('reference_num', required=False),
-                'rn_citations': bindparam('rn_citations', required=False),
-                'rn_citation_data': bindparam('rn_citation_data', required=False),
-            }
-            self._metrics_table_upsert = insert(MetricsModel).values(insert_columns)
-            # on insert conflict we specify which columns update
-            update_columns = {
-                'an_refereed_citations': getattr(self._metrics_table_upsert.excluded, 'an_refereed_citations'),
-                'an_citations': getattr(self._metrics_table_upsert.excluded, 'an_citations'),
-                'author_num': getattr(self._metrics_table_upsert.excluded, 'author_num'),
-                'citations': getattr(self._metrics_table_upsert.excluded, 'citations'),
-                'citation_num': getattr(self._metrics_table_upsert.excluded, 'citation_num'),
-                'downloads': getattr(self._metrics_table_upsert.excluded, 'downloads'),
-                'reads': getattr(self._metrics_table_upsert.excluded, 'reads'),
-                'refereed': getattr(self._metrics_table_upsert.excluded, 'refereed'),
-                'refereed_citations': getattr(self._metrics_table_upsert.excluded, 'refereed_citations'),
-                'refereed_citation_num': getattr(self._metrics_table_upsert.excluded, 'refereed_citation_num'),
-                'reference_num': getattr(self._metrics_table_upsert.excluded, 'reference_num'),
-                'rn_citations': getattr(self._metrics_table_upsert.excluded, 'rn_citations'),
-                'rn_citation_data': getattr(self._metrics_table_upsert.excluded, 'rn_citation_data')}
-            self._metrics_table_upsert = self._metrics_table_upsert.on_conflict_do_update(index_elements=['bibcode'], set_=update_columns)
+            session = scoped_session(_msession_factory)
+            session.configure(bind=engine)
+
+            MetricsBase.metadata.bind = engine
+            register_after_fork(engine, engine.dispose)
+            self._metrics_db = {'engine': engine, 'session': session}
+        return self._metrics_db
+
+    @property
+    def _metrics_engine(self):
+        metrics_db = self._init_metrics_db()
+        return metrics_db and metrics_db['engine']
+
+    @property
+    def _metrics_session(self):
+        metrics_db = self._init_metrics_db()
+        return metrics_db and metrics_db['session']
+
+    @property
+    def _metrics_table(self):
+        """The metrics table as reflected from the live database; this costs a
+        round trip so it is only done when somebody actually asks for it"""
+        if self._metrics_reflected_table is None and self._metrics_engine is not None:
+            self._metrics_reflected_table = Table('metrics', MetricsBase.metadata, autoload=True, autoload_with=self._metrics_engine)
+        return self._metrics_reflected_table
+
+    @property
+    def _metrics_table_upsert(self):
+        """Upsert statement built from the static MetricsModel definition,
+        it does not need a connection and is shared by all instances"""
+        cls = ADSMasterPipelineCelery
+        if cls._metrics_upsert_statement is None:
+            cls._metrics_upsert_statement = build_metrics_upsert()
+        return cls._metrics_upsert_statement
+
+    _metrics_upsert_statement = None
 
     @property
     def sitemap_dir(self):
         """Get the sitemap directory from configuration"""
         return self.conf.get('SITEMAP_DIR', '/app/logs/sitemap/')
 
+    def sitemap_output_filename(self, filename):
+        """Name of the file written to disk for a sitemap filename of the
+        sitemap table: the same, or with .gz appended when SITEMAP_GZIP is set"""
+        if self.conf.get('SITEMAP_GZIP', False):
+            return filename + '.gz'
+        return filename
+
     def flag_one_row_for_filename(self, session, filename):
         """Flag exactly one sitemap row for the given filename if none already flagged.
         Returns number of rows flagged (0 or 1)."""
-        if not filename:
+        return self.flag_sitemap_files(session, [filename])
+
+    def flag_sitemap_files(self, session, filenames):
+        """Flag one sitemap row (the lowest id) of every given file that has
+        no flagged row yet, in a single UPDATE in the caller's transaction.
+        Returns number of rows flagged (one per file at most)."""
+        filenames = sorted(set(f for f in filenames if f))
+        if not filenames:
             return 0
 
-        already = (
-            session.query(SitemapInfo.id)
-            .filter(
-                SitemapInfo.sitemap_filename == filename,
-                SitemapInfo.update_flag.is_(True),
-            )
-            .limit(1)
-            .scalar()
-        )
-        if already:
-            return 0
-
-        row_id = (
-            session.query(SitemapInfo.id)
-            .filter(
-                SitemapInfo.sitemap_filename == filename,
-                SitemapInfo.update_flag.is_(False),
-            )
-            .order_by(SitemapInfo.id.asc())
-            .limit(1)
-            .scalar()
+        first_rows = (
+            session.query(func.min(SitemapInfo.id))
+            .filter(SitemapInfo.sitemap_filename.in_(filenames))
+            .group_by(SitemapInfo.sitemap_filename)
+            .having(func.max(case([(SitemapInfo.update_flag.is_(True), 1)], else_=0)) == 0)
         )
-        if row_id is None:
-            return 0
-
         return session.query(SitemapInfo).filter(
-            SitemapInfo.id == row_id,
-            SitemapInfo.update_flag.is_(False),
+            SitemapInfo.id.in_(first_rows.subquery().select()),
         ).update({ 'update_flag': True }, synchronize_session=False)
 
     def update_storage(self, bibcode, type, payload):
@@ -246,14 +332,16 @@ class ADSMasterPipelineCelery(ADSCelery):
                 
                 # First delete any associated SitemapInfo records
                 session.query(SitemapInfo).filter_by(bibcode=bibcode).delete(synchronize_session=False)
+                if self.conf.get('SOLR_DOC_STORE', False):
+                    session.query(SolrDoc).filter_by(bibcode=bibcode).delete(synchronize_session=False)
                 # Then delete the Records entry and create ChangeLog
                 session.add(ChangeLog(key='bibcode:%s' % bibcode, type='deleted', oldvalue=serializer.dumps(r.toJSON())))
                 session.delete(r)
                 
-                # Mark affected sitemap files for regeneration synchronously (one row per file)
-                for (filename,) in sorted({f for f in affected_files if f}):
-                    if self.flag_one_row_for_filename(session, filename):
-                        session.commit()
+                self.adjust_sitemap_file_counts(session, {f: -1 for (f,) in affected_files if f})
+                
+                # Mark affected sitemap files for regeneration, same transaction (one row per file)
+                self.flag_sitemap_files(session, [f for (f,) in affected_files])
                 
                 session.commit()
                 return True
@@ -264,11 +352,11 @@ class ADSMasterPipelineCelery(ADSCelery):
                 # Get the filename before deleting the orphaned record
                 orphaned_filename = s.sitemap_filename
                 session.delete(s)
-                
-                # Mark the file for regeneration if it has a filename (synchronously)
                 if orphaned_filename:
-                    if self.flag_one_row_for_filename(session, orphaned_filename):
-                        session.commit()
+                    self.adjust_sitemap_file_counts(session, {orphaned_filename: -1})
+                
+                # Mark the file for regeneration if it has a filename, same transaction
+                self.flag_sitemap_files(session, [orphaned_filename])
                 
                 session.commit()
                 return True
@@ -393,9 +481,11 @@ class ADSMasterPipelineCelery(ADSCelery):
         if len(errs) == 0:
             if update_processed:
                 self.mark_processed([x['bibcode'] for x in solr_docs], 'solr', checksums=solr_docs_checksum, status='success')
+                self.store_solr_docs(solr_docs, solr_docs_checksum)
         else:
             self.logger.error('%s docs failed indexing', len(errs))
             failed_bibcodes = []
+            accepted = []
             # recover from errors by sending docs one by one
             for doc, checksum in zip(solr_docs, solr_docs_checksum):
                 try:
@@ -403,6 +493,7 @@ class ADSMasterPipelineCelery(ADSCelery):
                     solr_updater.update_solr([doc], solr_urls, ignore_errors=False, commit=commit)
                     if update_processed:
                         self.mark_processed((doc['bibcode'],), 'solr', checksums=(checksum,), status='success')
+                        accepted.append((doc, checksum))
                     self.logger.debug('%s success', doc['bibcode'])
                 except Exception as e:
                     # if individual insert fails,
@@ -417,6 +508,7 @@ class ADSMasterPipelineCelery(ADSCelery):
                             solr_updater.update_solr([tmp_doc], solr_urls, ignore_errors=False, commit=commit)
                             if update_processed:
                                 self.mark_processed((doc['bibcode'],), 'solr', checksums=(checksum,), status='success')
+                                accepted.append((tmp_doc, checksum))
                             self.logger.debug('%s success without body', doc['bibcode'])
                         except Exception as e:
                             self.logger.exception('Failed posting bibcode %s to Solr even without fulltext (urls: %s)', failed_bibcode, solr_urls)
@@ -428,6 +520,45 @@ class ADSMasterPipelineCelery(ADSCelery):
             # finally update postgres record
             if failed_bibcodes and update_processed:
                 self.mark_processed(failed_bibcodes, 'solr', checksums=None, status='solr-failed')
+            if accepted:
+                self.store_solr_docs([x[0] for x in accepted], [x[1] for x in accepted])
+
+    def store_solr_docs(self, solr_docs, checksums):
+        """Keeps a compressed copy of the documents accepted by solr, replacing
+        the ones stored for the same bibcodes; noop unless SOLR_DOC_STORE"""
+        if not solr_docs or not self.conf.get('SOLR_DOC_STORE', False):
+            return
+        now = adsputils.get_date()
+        rows = {}
+        for doc, checksum in zip(solr_docs, checksums):
+            rows[doc['bibcode']] = {'bibcode': doc['bibcode'], 'checksum': checksum, 'updated': now,
+                                    'doc': zlib.compress(json.dumps(doc).encode('utf-8'))}
+        with self.session_scope() as session:
+            session.query(SolrDoc).filter(SolrDoc.bibcode.in_(list(rows))).delete(synchronize_session=False)
+            session.execute(SolrDoc.__table__.insert(), list(rows.values()))
+            session.commit()
+
+    def get_solr_docs(self, bibcodes):
+        """Returns dict bibcode -> last document accepted by solr, for the
+        bibcodes found in the store"""
+        with self.session_scope() as session:
+            rows = session.query(SolrDoc.bibcode, SolrDoc.doc).filter(SolrDoc.bibcode.in_(list(bibcodes))).all()
+            return {bibcode: json.loads(zlib.decompress(doc).decode('utf-8')) for bibcode, doc in rows}
+
+    def iter_solr_docs(self, batch_size=1000):
+        """Yields (bibcode, checksum, doc) for every stored document in
+        bibcode order; one query per batch, keyset paginated"""
+        last = ''
+        while True:
+            with self.session_scope() as session:
+                rows = session.query(SolrDoc.bibcode, SolrDoc.checksum, SolrDoc.doc) \
+                    .filter(SolrDoc.bibcode > last) \
+                    .order_by(SolrDoc.bibcode).limit(batch_size).all()
+            if not rows:
+                return
+            for bibcode, checksum, doc in rows:
+                yield bibcode, checksum, json.loads(zlib.decompress(doc).decode('utf-8'))
+            last = rows[-1][0]
 
     def mark_processed(self, bibcodes, type, checksums=None, status=None):
         """
@@ -460,12 +591,20 @@ class ADSMasterPipelineCelery(ADSCelery):
         else:
             raise ValueError('invalid type value of %s passed, must be solr, metrics or links' % type)
         updt[timestamp_column] = now
-        checksums = checksums or [None] * len(bibcodes)
-        for bibcode, checksum in zip(bibcodes, checksums):
-            updt[checksum_column] = checksum
-            with self.session_scope() as session:
-                session.query(Records).filter_by(bibcode=bibcode).update(updt, synchronize_session=False)
-        session.commit()
+        with self.session_scope() as session:
+            if not checksums:
+                # same values for every bibcode, a single statement is enough
+                updt[checksum_column] = None
+                session.query(Records).filter(Records.bibcode.in_(list(bibcodes))).update(updt, synchronize_session=False)
+            else:
+                # one executemany with a checksum per bibcode
+                updt[checksum_column] = bindparam('_checksum')
+                stmt = Records.__table__.update() \
+                    .where(Records.__table__.c.bibcode == bindparam('_bibcode')) \
+                    .values(updt)
+                session.execute(stmt, [{'_bibcode': bibcode, '_checksum': checksum}
+                                       for bibcode, checksum in zip(bibcodes, checksums)])
+            session.commit()
 
     def get_metrics(self, bibcode):
         """Helper method to retrieve data from the metrics db
@@ -484,6 +623,43 @@ class ADSMasterPipelineCelery(ADSCelery):
             else:
                 return {}
 
+    def get_metrics_bulk(self, bibcodes, columns=None):
+        """Retrieve data for a batch of bibcodes from the metrics db
+        with a single query
+
+        @param bibcodes: list of strings
+        @param columns: optional list of metrics column names to load,
+            bibcode is always included
+        @return: dict mapping bibcode to JSON structure, bibcodes that
+            were not found are left out
+        """
+
+        if not self._metrics_session:
+            raise Exception('METRICS_SQLALCHEMY_URL not set!')
+
+        if not bibcodes:
+            return {}
+
+        out = {}
+        with self.metrics_session_scope() as session:
+            if columns:
+                columns = ['bibcode'] + [c for c in columns if c != 'bibcode']
+                for c in columns:
+                    if c not in MetricsModel.__table__.columns:
+                        raise ValueError('invalid metrics column %s' % c)
+                q = session.query(*[getattr(MetricsModel, c) for c in columns]) \
+                    .filter(MetricsModel.bibcode.in_(list(bibcodes)))
+                for row in q:
+                    x = dict(zip(columns, row))
+                    if 'modtime' in x:
+                        x['modtime'] = x['modtime'] and adsputils.get_date(x['modtime']).isoformat() or None
+                    out[x['bibcode']] = x
+            else:
+                q = session.query(MetricsModel).filter(MetricsModel.bibcode.in_(list(bibcodes)))
+                for x in q:
+                    out[x.bibcode] = x.toJSON()
+        return out
+
     @contextmanager
     def metrics_session_scope(self):
         """Provides a transactional session - ie. the session for the
@@ -533,20 +709,12 @@ class ADSMasterPipelineCelery(ADSCelery):
                     if update_processed:
                         self.mark_processed([x['bibcode'] for x in batch], 'metrics', checksums=batch_checksum, status='success')
                 except exc.SQLAlchemyError as e:
-                    # recover from errors by upserting data one by one
+                    # recover from errors by bisecting the batch until the bad rows are isolated
                     trans.rollback()
-                    self.logger.error('Metrics insert batch failed, will upsert one by one %s recs', len(batch))
-                    failed_bibcodes = []
-                    for x, checksum in zip(batch, batch_checksum):
-                        try:
-                            trans.session.execute(self._metrics_table_upsert, [x])
-                            trans.commit()
-                            if update_processed:
-                                self.mark_processed((x['bibcode'],), 'metrics', checksums=(checksum,), status='success')
-                        except Exception as e:
-                            failed_bibcode = x['bibcode']
-                            self.logger.exception('Failed posting individual bibcode %s to metrics', failed_bibcode)
-                            failed_bibcodes.append(failed_bibcode)
+                    self.logger.error('Metrics insert batch failed, will bisect %s recs', len(batch))
+                    upserted, upserted_checksums, failed_bibcodes = self._bisect_metrics_upsert(session, batch, batch_checksum)
+                    if upserted and update_processed:
+                        self.mark_processed(upserted, 'metrics', checksums=upserted_checksums, status='success')
                     if failed_bibcodes and update_processed:
                         self.mark_processed(failed_bibcodes, 'metrics', checksums=None, status='metrics-failed')
                 except Exception as e:
@@ -555,33 +723,131 @@ class ADSMasterPipelineCelery(ADSCelery):
                     if update_processed:
                         self.mark_processed([x['bibcode'] for x in batch], 'metrics', checksums=None, status='metrics-failed')
 
-    def index_datalinks(self, links_data, links_data_checksum, update_processed=True):
-        # todo is failed right?
-        links_url = self.conf.get('LINKS_RESOLVER_UPDATE_URL')
-        api_token = self.conf.get('ADS_API_TOKEN', '')
-        if len(links_data):
-            # bulk put request
-            bibcodes = [x['bibcode'] for x in links_data]
-            r = requests.put(links_url, data=json.dumps(links_data), headers={'Authorization': 'Bearer {}'.format(api_token)})
-            if r.status_code == 200:
-                self.logger.info('sent %s datalinks to %s including %s', len(links_data), links_url, links_data[0])
-                if update_processed:
-                    self.mark_processed(bibcodes, 'links', checksums=links_data_checksum, status='success')
-            else:
-                # recover from errors by issuing put requests one by one
-                self.logger.error('error sending links to %s, error = %s', links_url, r.text)
-                failed_bibcodes = []
-                for data, checksum in zip(links_data, links_data_checksum):
-                    r = requests.put(links_url, data=json.dumps([data]), headers={'Authorization': 'Bearer {}'.format(api_token)})
-                    if r.status_code == 200:
-                        self.logger.info('sent 1 datalinks to %s for bibcode %s', links_url, data.get('bibcode'))
-                        if update_processed:
-                            self.mark_processed(bibcodes, 'links', checksums=links_data_checksum, status='success')
-                    else:
-                        self.logger.error('error sending individual links to %s for bibcode %s, error = %s', links_url, data.get('bibcode'), r.text)
-                        failed_bibcodes.append(data['bibcode'])
-                if failed_bibcodes and update_processed:
-                    self.mark_processed(failed_bibcodes, 'links', status='links-failed')
+    def _bisect_metrics_upsert(self, session, batch, batch_checksum):
+        """Upserts a batch that is known to contain bad rows by recursively
+        halving it; every attempt runs inside its own savepoint so the good
+        halves land in a few large statements.
+
+        :return: tuple (upserted bibcodes, their checksums, failed bibcodes)
+        """
+        upserted = []
+        upserted_checksums = []
+        failed_bibcodes = []
+
+        def halves(rows, checksums):
+            middle = len(rows) // 2
+            return [x for x in ((rows[middle:], checksums[middle:]), (rows[:middle], checksums[:middle])) if x[0]]
+
+        # the whole batch already failed, so start with its two halves
+        pending = halves(batch, batch_checksum)
+        while pending:
+            rows, checksums = pending.pop()
+            trans = session.begin_nested()
+            try:
+                trans.session.execute(self._metrics_table_upsert, rows)
+                trans.commit()
+                upserted.extend([x['bibcode'] for x in rows])
+                upserted_checksums.extend(checksums)
+            except Exception:
+                trans.rollback()
+                if len(rows) == 1:
+                    self.logger.exception('Failed posting individual bibcode %s to metrics', rows[0]['bibcode'])
+                    failed_bibcodes.append(rows[0]['bibcode'])
+                else:
+                    pending.extend(halves(rows, checksums))
+        return upserted, upserted_checksums, failed_bibcodes
+
+    @property
+    def datalinks_updater(self):
+        """Pooled sender for the links resolver, created on first use so
+        that every worker process gets its own connection pool"""
+        if self._datalinks_updater is None:
+            self._datalinks_updater = DatalinksUpdater(
+                self.conf.get('LINKS_RESOLVER_UPDATE_URL'),
+                api_token=self.conf.get('ADS_API_TOKEN', ''),
+                timeout=self.conf.get('LINKS_RESOLVER_TIMEOUT', 60),
+                max_retries=self.conf.get('LINKS_RESOLVER_MAX_RETRIES', 3),
+                backoff=self.conf.get('LINKS_RESOLVER_BACKOFF', 1.0),
+                compress=self.conf.get('LINKS_RESOLVER_GZIP', False),
+                logger=self.logger,
+                delta_url=self.conf.get('LINKS_RESOLVER_DELTA_URL', None))
+        return self._datalinks_updater
+
+    def index_datalinks(self, links_data, links_data_checksum, update_processed=True, use_deltas=True):
+        """Sends data links to the resolver; rejected batches are bisected
+        so only the records that were actually accepted are marked as sent.
+
+        Records the resolver already has (we stored the fingerprints of their
+        rows) are sent as row level deltas when the resolver supports them,
+        unchanged records are not sent at all. Set use_deltas=False to force
+        a full replacement.
+        """
+        if not len(links_data):
+            return
+        fingerprints = [row_fingerprints(x['data_links_rows']) for x in links_data]
+        updater = self.datalinks_updater
+        sent = []
+        failed = []
+        full = list(range(len(links_data)))
+        if use_deltas and update_processed and updater.delta_url:
+            previous = self.get_datalinks_fingerprints([x['bibcode'] for x in links_data])
+            full = []
+            deltas = []
+            delta_positions = []
+            for i, record in enumerate(links_data):
+                delta = make_delta(record, fingerprints[i], previous.get(record['bibcode']))
+                if delta is None:
+                    full.append(i)
+                elif delta['upsert'] or delta['delete']:
+                    deltas.append(delta)
+                    delta_positions.append(i)
+                else:
+                    sent.append(i)
+            if deltas:
+                unchanged = len(sent)
+                d_sent, d_failed, d_unsupported = updater.send_deltas(deltas)
+                sent.extend(delta_positions[j] for j in d_sent)
+                failed.extend(delta_positions[j] for j in d_failed)
+                full.extend(delta_positions[j] for j in d_unsupported)
+                self.logger.info('sent %s datalinks deltas, %s records unchanged', len(d_sent), unchanged)
+        if full:
+            f_sent, f_failed = updater.send([links_data[i] for i in full])
+            if f_sent:
+                self.logger.info('sent %s datalinks to %s including %s', len(f_sent), updater.url, links_data[full[f_sent[0]]])
+            sent.extend(full[j] for j in f_sent)
+            failed.extend(full[j] for j in f_failed)
+        if update_processed:
+            if sent:
+                sent.sort()
+                self.mark_processed([links_data[i]['bibcode'] for i in sent], 'links',
+                                    checksums=[links_data_checksum[i] for i in sent], status='success')
+                self.save_datalinks_fingerprints([links_data[i]['bibcode'] for i in sent],
+                                                 [fingerprints[i] for i in sent])
+            if failed:
+                failed.sort()
+                self.mark_processed([links_data[i]['bibcode'] for i in failed], 'links', status='links-failed')
+
+    def get_datalinks_fingerprints(self, bibcodes):
+        """Returns dict bibcode -> fingerprints of the data links rows last
+        accepted by the resolver, bibcodes without them are left out"""
+        with self.session_scope() as session:
+            rows = session.query(Records.bibcode, Records.datalinks_fingerprints) \
+                .filter(Records.bibcode.in_(list(bibcodes))) \
+                .filter(Records.datalinks_fingerprints.isnot(None)).all()
+            return {bibcode: json.loads(fingerprints) for bibcode, fingerprints in rows}
+
+    def save_datalinks_fingerprints(self, bibcodes, fingerprints):
+        """Stores the row fingerprints of records accepted by the resolver,
+        None (rows with duplicate keys) clears them"""
+        if not bibcodes:
+            return
+        stmt = Records.__table__.update() \
+            .where(Records.__table__.c.bibcode == bindparam('_bibcode')) \
+            .values(datalinks_fingerprints=bindparam('_fingerprints'))
+        with self.session_scope() as session:
+            session.execute(stmt, [{'_bibcode': bibcode, '_fingerprints': json.dumps(f) if f is not None else None}
+                                   for bibcode, f in zip(bibcodes, fingerprints)])
+            session.commit()
 
     def metrics_delete_by_bibcode(self, bibcode):
         with self.metrics_session_scope() as session:
@@ -592,38 +858,8 @@ class ADSMasterPipelineCelery(ADSCelery):
                 return True
 
     def checksum(self, data, ignore_keys=('mtime', 'ctime', 'update_timestamp')):
-        """
-        Compute checksum of the passed in data. Preferred situation is when you
-        give us a dictionary. We can clean it up, remove the 'ignore_keys' and
-        sort the keys. Then compute CRC on the string version. You can also pass
-        a string, in which case we simple return the checksum.
-        
-        @param data: string or dict
-        @param ignore_keys: list of patterns, if they are found (anywhere) in
-            the key name, we'll ignore this key-value pair
-        @return: checksum
-        """
-        assert isinstance(ignore_keys, tuple)
-
-        if isinstance(data, basestring):
-            if sys.version_info > (3,):
-                data_str = data.encode('utf-8')
-            else:
-                data_str = unicode(data)
-            return hex(zlib.crc32(data_str) & 0xffffffff)
-        else:
-            data = deepcopy(data)
-            # remove all the modification timestamps
-            for k, v in list(data.items()):
-                for x in ignore_keys:
-                    if x in k:
-                        del data[k]
-                        break
-            if sys.version_info > (3,):
-                data_str = json.dumps(data, sort_keys=True).encode('utf-8')
-            else:
-                data_str = json.dumps(data, sort_keys=True)
-            return hex(zlib.crc32(data_str) & 0xffffffff)
+        """Compute checksum of the passed in data, see checksum() at module level"""
+        return checksum(data, ignore_keys)
 
     def request_aff_augment(self, bibcode, data=None):
         """send aff data for bibcode to augment affiliation pipeline
@@ -818,7 +1054,26 @@ class ADSMasterPipelineCelery(ADSCelery):
             entry = (rec, metrics, collections)
         return entry
 
-    def generate_boost_request_message(self, bibcode, run_id=None, output_path=None):
+    def _get_info_for_boost_entries(self, bibcodes):
+        """Bulk version of _get_info_for_boost_entry, it issues one query
+        against the records db and one against the metrics db.
+
+        @return: dict mapping bibcode to (rec, metrics, collections), bibcodes
+            without a record are left out
+        """
+        records = self.get_record(list(bibcodes))
+        metrics = {}
+        try:
+            metrics = self.get_metrics_bulk([rec['bibcode'] for rec in records])
+        except Exception:
+            pass
+
+        entries = {}
+        for rec in records:
+            entries[rec['bibcode']] = (rec, metrics.get(rec['bibcode'], {}), [])
+        return entries
+
+    def generate_boost_request_message(self, bibcode, run_id=None, output_path=None, entry=None):
         """Build and send boost request message to Boost Pipeline.
         
         Parameters
@@ -829,6 +1084,9 @@ class ADSMasterPipelineCelery(ADSCelery):
             Optional job/run identifier added to each entry.
         output_path : str, optional
             Optional output path hint added to each entry.
+        entry : tuple, optional
+            Pre-fetched (rec, metrics, classifications) for the bibcode,
+            see _get_info_for_boost_entries.
 
         Returns
         -------
@@ -843,7 +1101,9 @@ class ADSMasterPipelineCelery(ADSCelery):
         
         try:
             # Get record data for this bibcode
-            (rec, metrics, classifications) = self._get_info_for_boost_entry(bibcode)
+            if entry is None:
+                entry = self._get_info_for_boost_entry(bibcode)
+            (rec, metrics, classifications) = entry
             if not rec:
                 self.logger.debug('Skipping bibcode with no data: %s', bibcode)
                 return False
@@ -1019,7 +1279,8 @@ class ADSMasterPipelineCelery(ADSCelery):
     def get_current_sitemap_state(self, session):
         """Get current sitemap state using provided session.
         
-        Finds the last file being filled (highest index number).
+        Finds the last file being filled (highest index number) in the
+        sitemap_files table, a single indexed lookup.
         If that file is full (>= MAX_RECORDS_PER_SITEMAP), returns state for next file.
         
         :param session: Database session to use
@@ -1027,27 +1288,15 @@ class ADSMasterPipelineCelery(ADSCelery):
         """
         max_records = self.conf.get('MAX_RECORDS_PER_SITEMAP', 50000)
         
-        # Get all files with their counts
-        results = session.query(
-            SitemapInfo.sitemap_filename,
-            func.count(SitemapInfo.id).label('record_count')
-        ).filter(
-            SitemapInfo.sitemap_filename.isnot(None)
-        ).group_by(
-            SitemapInfo.sitemap_filename
-        ).all()
-        
-        if results:
-            # Sort by numeric index (not alphabetically)
-            def get_file_index(result):
-                return int(result.sitemap_filename.split('_bib_')[1].split('.')[0])
-            
-            sorted_results = sorted(results, key=get_file_index)
-            last_result = sorted_results[-1]
-            
-            filename = last_result.sitemap_filename
-            count = last_result.record_count
-            index = get_file_index(last_result)
+        last_file = self._last_sitemap_file(session)
+        if last_file is None and session.query(SitemapInfo.id).filter(
+                SitemapInfo.sitemap_filename.isnot(None)).first() is not None:
+            # sitemap rows written before sitemap_files was maintained, build it once
+            self.refresh_sitemap_files(session)
+            last_file = self._last_sitemap_file(session)
+        
+        if last_file is not None:
+            filename, count, index = last_file
             
             # If last file is full, prepare for next file
             if count >= max_records:
@@ -1071,6 +1320,192 @@ class ADSMasterPipelineCelery(ADSCelery):
             'index': 1
         }
     
+    def _last_sitemap_file(self, session):
+        """(filename, record_count, file_index) of the highest numbered file, or None"""
+        return (
+            session.query(SitemapFile.filename, SitemapFile.record_count, SitemapFile.file_index)
+            .filter(SitemapFile.file_index.isnot(None))
+            .order_by(SitemapFile.file_index.desc())
+            .first()
+        )
+    
+    def adjust_sitemap_file_counts(self, session, deltas):
+        """Apply changes in the number of sitemap rows per file to sitemap_files,
+        in the caller's transaction. Files not known yet are added.
+        
+        :param session: database session to use
+        :param deltas: dict filename -> number of rows added (negative when removed)
+        """
+        for filename, delta in sorted(deltas.items()):
+            if not filename or not delta:
+                continue
+            updated = (
+                session.query(SitemapFile)
+                .filter(SitemapFile.filename == filename)
+                .update({SitemapFile.record_count: SitemapFile.record_count + delta},
+                        synchronize_session=False)
+            )
+            if not updated and delta > 0:
+                session.execute(SitemapFile.__table__.insert().values(
+                    filename=filename, file_index=sitemap_file_index(filename), record_count=delta))
+    
+    def set_sitemap_file_counts(self, session, counts):
+        """Set the number of sitemap rows of the given files, files with no
+        rows left are dropped from sitemap_files
+        
+        :param session: database session to use
+        :param counts: dict filename -> number of rows
+        """
+        empty = [filename for filename, count in counts.items() if not count]
+        if empty:
+            session.query(SitemapFile).filter(SitemapFile.filename.in_(empty)).delete(synchronize_session=False)
+            session.query(SitemapFileSite).filter(SitemapFileSite.filename.in_(empty)).delete(synchronize_session=False)
+        for filename, count in sorted(counts.items()):
+            if not count:
+                continue
+            updated = (
+                session.query(SitemapFile)
+                .filter(SitemapFile.filename == filename)
+                .update({SitemapFile.record_count: count}, synchronize_session=False)
+            )
+            if not updated:
+                session.execute(SitemapFile.__table__.insert().values(
+                    filename=filename, file_index=sitemap_file_index(filename), record_count=count))
+    
+    def refresh_sitemap_files(self, session):
+        """Rebuild the record counts of sitemap_files from the sitemap table
+        (one GROUP BY over it), e.g. after rows were written by other means
+        
+        :param session: database session to use
+        :return: number of files
+        """
+        counts = dict(
+            session.query(SitemapInfo.sitemap_filename, func.count(SitemapInfo.id))
+            .filter(SitemapInfo.sitemap_filename.isnot(None))
+            .group_by(SitemapInfo.sitemap_filename)
+            .all()
+        )
+        known = [filename for (filename,) in session.query(SitemapFile.filename)]
+        counts.update({filename: 0 for filename in known if filename not in counts})
+        self.set_sitemap_file_counts(session, counts)
+        return len([c for c in counts.values() if c])
+    
+    def mark_sitemap_file_generated(self, session, filename, outputs=None, content_hash=None):
+        """Record when a sitemap file was last written (and its content hash);
+        the record count is left alone, rows may be added to the file while
+        it is being written
+        
+        :param outputs: dict site key -> (output filename, size in bytes,
+            content hash) of the files written, kept in sitemap_file_sites
+            for the index; sites left out keep what they had
+        :param content_hash: hash over all sites, for sitemap_files
+        """
+        now = adsputils.get_date()
+        values = {'last_generated': now, 'content_hash': content_hash}
+        if outputs:
+            session.query(SitemapFileSite).filter(
+                SitemapFileSite.filename == filename,
+                SitemapFileSite.site.in_(list(outputs))
+            ).delete(synchronize_session=False)
+            session.execute(SitemapFileSite.__table__.insert(), [
+                {'filename': filename, 'site': site, 'output_filename': output_filename,
+                 'generated': now, 'byte_size': size, 'content_hash': site_hash}
+                for site, (output_filename, size, site_hash) in sorted(outputs.items())])
+        updated = (
+            session.query(SitemapFile)
+            .filter(SitemapFile.filename == filename)
+            .update(values, synchronize_session=False)
+        )
+        if not updated:
+            # file not known to sitemap_files yet, count its rows once
+            record_count = session.query(func.count(SitemapInfo.id)).filter(
+                SitemapInfo.sitemap_filename == filename).scalar()
+            session.execute(SitemapFile.__table__.insert().values(
+                filename=filename, file_index=sitemap_file_index(filename), record_count=record_count, **values))
+    
+    def get_sitemap_file_outputs(self, session, filename):
+        """What was last published for a sitemap file: dict site key ->
+        (output filename, content hash)"""
+        return {
+            site: (output_filename, content_hash)
+            for site, output_filename, content_hash in
+            session.query(SitemapFileSite.site, SitemapFileSite.output_filename, SitemapFileSite.content_hash)
+            .filter(SitemapFileSite.filename == filename)
+        }
+    
+    def start_sitemap_run(self, total_files):
+        """Record a run of total_files sitemap file tasks, returns its id"""
+        with self.session_scope() as session:
+            run = SitemapRun(total_files=total_files, pending_files=total_files)
+            session.add(run)
+            session.commit()
+            return run.id
+    
+    def get_sitemap_run(self, run_id):
+        """The sitemap_runs row as a dict, or None"""
+        with self.session_scope() as session:
+            run = session.query(SitemapRun).filter_by(id=run_id).first()
+            return run.toJSON() if run else None
+    
+    def finish_sitemap_run_file(self, run_id, written=0, skipped=0):
+        """Count off one successful file task of the run
+        
+        The decrement is a single UPDATE, concurrent tasks are serialized on
+        the row; the task that takes the count to zero also stamps the run as
+        finished, so exactly one caller gets True.
+        
+        :param written, skipped: site files the task published and left
+            alone because their content had not changed
+        :return: True if this was the last file of the run
+        """
+        with self.session_scope() as session:
+            session.query(SitemapRun).filter(
+                SitemapRun.id == run_id,
+                SitemapRun.pending_files > 0
+            ).update({SitemapRun.pending_files: SitemapRun.pending_files - 1,
+                      SitemapRun.written_files: SitemapRun.written_files + written,
+                      SitemapRun.skipped_files: SitemapRun.skipped_files + skipped},
+                     synchronize_session=False)
+            last = session.query(SitemapRun).filter(
+                SitemapRun.id == run_id,
+                SitemapRun.pending_files == 0,
+                SitemapRun.finished.is_(None)
+            ).update({SitemapRun.finished: adsputils.get_date()}, synchronize_session=False)
+            session.commit()
+            return last == 1
+    
+    def fail_sitemap_run_file(self, run_id):
+        """Record a failed file task (or bootstrap range) of the run
+        
+        The task is not counted off, so the run doesn't finish and its index
+        is not generated from the files it has; expire_sitemap_runs closes
+        it later.
+        """
+        with self.session_scope() as session:
+            session.query(SitemapRun).filter(SitemapRun.id == run_id).update(
+                {SitemapRun.failed_files: SitemapRun.failed_files + 1}, synchronize_session=False)
+            session.commit()
+    
+    def expire_sitemap_runs(self, timeout_minutes):
+        """Close the runs still unfinished timeout_minutes after they were
+        started: a file task failed or its worker was lost
+        
+        :return: ids of the runs closed by this call
+        """
+        cutoff = adsputils.get_date() - timedelta(minutes=timeout_minutes)
+        with self.session_scope() as session:
+            run_ids = [run_id for (run_id,) in session.query(SitemapRun.id).filter(
+                SitemapRun.finished.is_(None), SitemapRun.created < cutoff)]
+            if not run_ids:
+                return []
+            # a file task finishing the run meanwhile wins
+            session.query(SitemapRun).filter(
+                SitemapRun.id.in_(run_ids),
+                SitemapRun.finished.is_(None)
+            ).update({SitemapRun.finished: adsputils.get_date()}, synchronize_session=False)
+            session.commit()
+            return run_ids
+    
     def _process_sitemap_batch(self, bibcodes, action, session, sitemap_state):
         """Process a batch of bibcodes with provided session and state.
         
@@ -1210,6 +1645,12 @@ class ADSMasterPipelineCelery(ADSCelery):
             return
         
         session.bulk_insert_mappings(SitemapInfo, sitemap_records)
+        
+        # Keep the per file counters in step, same transaction
+        deltas = defaultdict(int)
+        for record in sitemap_records:
+            deltas[record.get('sitemap_filename')] += 1
+        self.adjust_sitemap_file_counts(session, deltas)
     
     def bulk_update_sitemap_records(self, update_records, session):
         """Bulk update sitemap records using provided session.
@@ -1248,18 +1689,56 @@ class ADSMasterPipelineCelery(ADSCelery):
             session.commit()
     
     def backup_sitemap_files(self, directory):
-        """Backup the sitemap files to the given directory
-
-        :param directory: string, directory to backup the sitemap files
+        """Set the sitemap files aside and start over with an empty directory
+
+        directory is a symlink to the current generation, a directory in
+        <directory>.generations; a new, empty generation is created and the
+        symlink swapped to it in one rename, so readers see either the old or
+        the new files, never a half emptied directory. The previous
+        SITEMAP_BACKUP_GENERATIONS generations are kept, older ones removed.
+        A plain directory (the old layout) becomes the first generation.
+
+        :param directory: string, the sitemap directory (SITEMAP_DIR)
+        :return: path of the generation that was set aside, None if there was
+            no sitemap directory
         """
+        directory = directory.rstrip(os.sep)
+        parent, name = os.path.split(directory)
+        generations = directory + '.generations'
+        os.makedirs(generations, exist_ok=True)
+
+        def generation_name():
+            # sorts by creation time
+            stamp = candidate = adsputils.get_date().strftime('%Y%m%dT%H%M%S.%f')
+            n = 0
+            while os.path.lexists(os.path.join(generations, candidate)):
+                n += 1
+                candidate = '%s-%d' % (stamp, n)
+            return candidate
+
+        previous = None
+        if os.path.islink(directory):
+            previous = os.path.realpath(directory)
+        elif os.path.isdir(directory):
+            # on the same filesystem, a rename: files are not copied
+            previous = os.path.join(generations, generation_name())
+            os.rename(directory, previous)
+
+        current = generation_name()
+        os.mkdir(os.path.join(generations, current))
+        link = os.path.join(parent, '.%s.%s.tmp' % (name, current))
+        os.symlink(os.path.join(name + '.generations', current), link)
+        os.replace(link, directory)
+        self.logger.info('Sitemap directory %s switched to generation %s, previous files in %s',
+                         directory, current, previous)
+
+        keep = self.conf.get('SITEMAP_BACKUP_GENERATIONS', 3)
+        old = sorted(g for g in os.listdir(generations) if g != current)
+        for g in old[:max(len(old) - keep, 0)]:
+            shutil.rmtree(os.path.join(generations, g), ignore_errors=True)
+            self.logger.info('Removed old sitemap generation %s', g)
+        return previous
 
-        # move dir to /app/tmp 
-        date = adsputils.get_date()
-        tmpdir = '/app/logs/tmp/sitemap_{}_{}_{}-{}/'.format(date.year, date.month, date.day, date.time())
-        os.system('mkdir -p {}'.format(tmpdir))
-        os.system('mv {}/* {}/'.format(directory, tmpdir))
-        return
-    
     def _execute_remove_action(self, session, bibcodes_to_remove):
         """
         Efficiently remove bibcodes from sitemaps using optimized bulk operations.
@@ -1306,6 +1785,10 @@ class ADSMasterPipelineCelery(ADSCelery):
         # Identify empty files and files that still have records
         files_to_delete = set(file for file in affected_files if file not in file_counts_after)
         files_to_update = affected_files - files_to_delete
+        
+        # Keep the per file counters in step, same transaction
+        self.set_sitemap_file_counts(
+            session, {file: file_counts_after.get(file, 0) for file in affected_files})
 
         self.logger.info('Removed %d bibcodes from %d files, %d files now empty, %d files pending regeneration flag', 
                          removed_count, len(affected_files), len(files_to_delete), len(files_to_update))
@@ -1313,6 +1796,163 @@ class ADSMasterPipelineCelery(ADSCelery):
         return removed_count, files_to_delete, files_to_update
 
 
+    def plan_sitemap_compaction(self, file_counts, max_records, fill_factor):
+        """Choose which sparse files to merge into which
+        
+        Files holding fewer than fill_factor * max_records rows are sparse.
+        Whole files are moved, the smallest sparse file into the fullest
+        sparse one it still fits in (up to max_records), so each move
+        empties a file while touching as few rows as possible. Files at or
+        above the fill factor are never read or written.
+        
+        :param file_counts: dict filename -> number of rows
+        :return: dict donor filename -> destination filename
+        """
+        target = int(math.ceil(fill_factor * max_records))
+        sparse = sorted((count, sitemap_file_index(filename), filename)
+                        for filename, count in file_counts.items() if 0 < count < target)
+        counts = dict((filename, count) for count, _, filename in sparse)
+        moves = {}
+        lo, hi = 0, len(sparse) - 1
+        while lo < hi:
+            donor, destination = sparse[lo][2], sparse[hi][2]
+            if counts[donor] + counts[destination] <= max_records:
+                counts[destination] += counts.pop(donor)
+                moves[donor] = destination
+                lo += 1
+            else:
+                hi -= 1
+        return moves
+    
+    def compact_sitemap_files(self, session, fill_factor, max_records=None):
+        """Repack the rows of sparse sitemap files, in the caller's transaction
+        
+        The last file (the one new records go to) is left alone. Moved rows
+        keep their dates; the counters of the files involved are set and
+        emptied files dropped from sitemap_files.
+        
+        :return: tuple (moved_count: int, files_to_delete: set, files_to_update: set)
+        """
+        max_records = max_records or self.conf.get('MAX_RECORDS_PER_SITEMAP', 50000)
+        file_counts = dict(
+            session.query(SitemapFile.filename, SitemapFile.record_count)
+            .filter(SitemapFile.file_index.isnot(None))
+        )
+        last_file = self._last_sitemap_file(session)
+        if last_file is not None:
+            file_counts.pop(last_file[0], None)
+        
+        moves = self.plan_sitemap_compaction(file_counts, max_records, fill_factor)
+        if not moves:
+            return 0, set(), set()
+        
+        moved_count = 0
+        new_counts = {}
+        for donor, destination in sorted(moves.items(), key=lambda x: sitemap_file_index(x[0])):
+            moved_count += (
+                session.query(SitemapInfo)
+                .filter(SitemapInfo.sitemap_filename == donor)
+                .update({SitemapInfo.sitemap_filename: destination}, synchronize_session=False)
+            )
+            new_counts[donor] = 0
+        for destination in set(moves.values()):
+            new_counts[destination] = (
+                session.query(func.count(SitemapInfo.id))
+                .filter(SitemapInfo.sitemap_filename == destination)
+                .scalar()
+            )
+        self.set_sitemap_file_counts(session, new_counts)
+        
+        files_to_delete = set(moves.keys())
+        files_to_update = set(moves.values())
+        self.logger.info('Compacted %d sitemap files into %d, %d rows moved', 
+                         len(files_to_delete), len(files_to_update), moved_count)
+        return moved_count, files_to_delete, files_to_update
+    
+    def sitemap_inclusion_clause(self):
+        """SQL counterpart of should_include_in_sitemap, over sitemap rows
+        outer joined to records: the record exists, has bib_data and its
+        status is not solr-failed or retrying (staleness never excludes)"""
+        return and_(
+            Records.id.isnot(None),
+            Records.bib_data.isnot(None),
+            or_(Records.status.is_(None), Records.status.notin_(['solr-failed', 'retrying']))
+        )
+    
+    def get_sitemap_auto_watermark(self):
+        """Start time of the last successful --update-sitemaps-auto run, or None"""
+        with self.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key='last.sitemap.auto').first()
+            return adsputils.get_date(kv.value) if kv is not None else None
+
+    def set_sitemap_auto_watermark(self, value):
+        with self.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key='last.sitemap.auto').first()
+            if kv is None:
+                session.add(KeyValue(key='last.sitemap.auto', value=value.isoformat()))
+            else:
+                kv.value = value.isoformat()
+            session.commit()
+
+    def sitemap_auto_changes(self, session, cutoff_date, after_bibcode=None):
+        """Query of the bibcodes of records changed since cutoff_date (bib
+        data updated or sent to solr), without a sitemap row already flagged
+        for update, in bibcode order
+
+        Each criterion is a range scan on its records index, the flagged rows
+        are left out with an anti-join on the sitemap bibcode index; UNION
+        removes the duplicates.
+
+        :param after_bibcode: only bibcodes after this one, to page with limit()
+        """
+        def changed_since(column):
+            q = (
+                session.query(Records.bibcode)
+                .outerjoin(SitemapInfo, and_(SitemapInfo.bibcode == Records.bibcode,
+                                             SitemapInfo.update_flag.is_(True)))
+                .filter(column >= cutoff_date, SitemapInfo.id.is_(None))
+            )
+            if after_bibcode is not None:
+                q = q.filter(Records.bibcode > after_bibcode)
+            return q
+        return (changed_since(Records.bib_data_updated)
+                .union(changed_since(Records.solr_processed))
+                .order_by(Records.bibcode))
+    
+    def delete_invalid_sitemap_rows(self, session, batch_size, after_id=0):
+        """Delete up to batch_size sitemap rows with id > after_id that no
+        longer meet sitemap_inclusion_clause, in the caller's transaction
+        
+        One DELETE ... RETURNING statement, valid rows are never read; on
+        databases without DELETE RETURNING the ids are selected first.
+        
+        :return: list of (id, sitemap_filename) of the deleted rows
+        """
+        invalid_ids = (
+            session.query(SitemapInfo.id)
+            .outerjoin(Records, SitemapInfo.bibcode == Records.bibcode)
+            .filter(SitemapInfo.id > after_id, not_(self.sitemap_inclusion_clause()))
+            .order_by(SitemapInfo.id)
+            .limit(batch_size)
+        )
+        table = SitemapInfo.__table__
+        if session.get_bind().dialect.full_returning:
+            stmt = (
+                table.delete()
+                .where(table.c.id.in_(invalid_ids.subquery().select()))
+                .returning(table.c.id, table.c.sitemap_filename)
+            )
+            return [tuple(row) for row in session.execute(stmt)]
+        
+        rows = (
+            session.query(SitemapInfo.id, SitemapInfo.sitemap_filename)
+            .filter(SitemapInfo.id.in_([row_id for (row_id,) in invalid_ids]))
+            .all()
+        )
+        if rows:
+            session.execute(table.delete().where(table.c.id.in_([row[0] for row in rows])))
+        return [tuple(row) for row in rows]
+    
     def delete_sitemap_files(self, files_to_delete, sitemap_dir):
         """
         Helper function to delete empty sitemap files from all sites.
@@ -1329,11 +1969,13 @@ class ADSMasterPipelineCelery(ADSCelery):
         
         for filename in files_to_delete:
             for site_key in sites_config.keys():
-                site_filepath = os.path.join(sitemap_dir, site_key, filename)
-                if os.path.exists(site_filepath):
-                    os.remove(site_filepath)
-                    self.logger.info('Deleted empty sitemap file: %s', site_filepath)
-                    deleted_count += 1
+                # plain or gzipped, whichever was written
+                for name in (filename, filename + '.gz'):
+                    site_filepath = os.path.join(sitemap_dir, site_key, name)
+                    if os.path.exists(site_filepath):
+                        os.remove(site_filepath)
+                        self.logger.info('Deleted empty sitemap file: %s', site_filepath)
+                        deleted_count += 1
         
         self.logger.info('Deleted %d empty sitemap files across all sites', deleted_count)
 
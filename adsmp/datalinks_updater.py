@@ -0,0 +1,203 @@
+import gzip
+import json
+import logging
+import time
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# responses that mean the resolver is busy or restarting, these are retried
+# with backoff
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+# a bad token, retrying or bisecting won't help
+AUTH_STATUS_CODES = (401, 403)
+# answers from a resolver without a delta endpoint, deltas are then disabled
+# and the affected records are sent again as full replacements
+UNSUPPORTED_STATUS_CODES = (404, 405, 415, 501)
+
+
+class DeltaNotSupported(Exception):
+    pass
+
+
+class ResolverUnavailable(Exception):
+    """The resolver can't take requests at all: retries of a transient
+    failure ran out, the token was refused or the server failed"""
+    pass
+
+
+def row_key(row):
+    """Identity of a data links row inside its record"""
+    return '{}/{}'.format(row.get('link_type', ''), row.get('link_sub_type', ''))
+
+
+def row_fingerprints(rows):
+    """Returns dict row key -> crc of the row, or None when two rows share
+    a key (such records can only be sent as a full replacement)"""
+    fingerprints = {}
+    for row in rows:
+        key = row_key(row)
+        if key in fingerprints:
+            return None
+        data = json.dumps(row, sort_keys=True).encode('utf-8')
+        fingerprints[key] = hex(zlib.crc32(data) & 0xffffffff)
+    return fingerprints
+
+
+def make_delta(record, fingerprints, previous):
+    """Compares the rows of a resolver record with the fingerprints of
+    what was last accepted for it.
+
+    :param record: dict with 'bibcode' and 'data_links_rows'
+    :param fingerprints: row_fingerprints() of the record
+    :param previous: fingerprints last accepted by the resolver, or None
+    :return: None when a full replacement is needed, else a delta dict with
+        the added or changed rows under 'upsert' and the keys of removed
+        rows under 'delete' (both empty when nothing changed)
+    """
+    if fingerprints is None or previous is None:
+        return None
+    upsert = [row for row in record['data_links_rows']
+              if previous.get(row_key(row)) != fingerprints[row_key(row)]]
+    delete = []
+    for key in sorted(set(previous) - set(fingerprints)):
+        link_type, link_sub_type = key.split('/', 1)
+        delete.append({'link_type': link_type, 'link_sub_type': link_sub_type})
+    return {'bibcode': record['bibcode'], 'upsert': upsert, 'delete': delete}
+
+
+class DatalinksUpdater(object):
+    """Sends data links records to the links resolver update endpoint.
+
+    A single pooled session is reused for every request, bodies are
+    optionally gzipped and every request has a timeout. Transient failures
+    are retried with exponential backoff; when a batch is rejected (4xx other
+    than 401/403) it is bisected until the offending records are isolated.
+    When the resolver is unavailable or refuses the token, sending stops and
+    the records not sent yet are reported failed.
+
+    When delta_url is set, records can also be sent as row level deltas
+    (see make_delta); if the resolver turns out not to support them
+    delta_url is cleared and callers fall back to full replacement.
+    """
+
+    def __init__(self, url, api_token='', timeout=60, max_retries=3, backoff=1.0,
+                 compress=False, pool_size=4, logger=None, delta_url=None):
+        self.url = url
+        self.delta_url = delta_url
+        self.api_token = api_token
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.compress = compress
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Authorization': 'Bearer {}'.format(api_token),
+                                     'Content-Type': 'application/json'})
+
+    def close(self):
+        self.session.close()
+
+    def encode(self, records):
+        """Returns (body, extra headers) for the given list of records"""
+        body = json.dumps(records).encode('utf-8')
+        if self.compress:
+            return gzip.compress(body), {'Content-Encoding': 'gzip'}
+        return body, {}
+
+    def put(self, records, delta=False):
+        """Sends one request, retrying transient failures.
+
+        :return: tuple (success, error message), not successful only when
+            the resolver rejected the payload (4xx other than 401/403)
+        :raises DeltaNotSupported: if a delta request hits a resolver
+            without a delta endpoint
+        :raises ResolverUnavailable: when the retries of a transient failure
+            ran out, on 401/403 and on any other 5xx
+        """
+        url = self.delta_url if delta else self.url
+        body, headers = self.encode(records)
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                r = self.session.put(url, data=body, headers=headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = str(e)
+                self.logger.warning('error sending %s datalinks to %s (attempt %s): %s',
+                                    len(records), url, attempt + 1, error)
+                continue
+            if r.status_code == 200:
+                return True, None
+            if delta and r.status_code in UNSUPPORTED_STATUS_CODES:
+                raise DeltaNotSupported('resolver at {} answered {}'.format(url, r.status_code))
+            error = '{}: {}'.format(r.status_code, r.text)
+            server_error = r.status_code >= 500 and r.status_code not in RETRY_STATUS_CODES
+            if r.status_code in AUTH_STATUS_CODES or server_error:
+                raise ResolverUnavailable('resolver at {} answered {}'.format(url, error))
+            if r.status_code not in RETRY_STATUS_CODES:
+                return False, error
+            self.logger.warning('resolver at %s answered %s (attempt %s), will retry',
+                                url, r.status_code, attempt + 1)
+        raise ResolverUnavailable('resolver at {} unavailable after {} attempts: {}'.format(
+            url, self.max_retries + 1, error))
+
+    def send(self, records):
+        """Sends records, bisecting rejected batches to isolate bad records.
+
+        :param records: list of dicts, each with 'bibcode' and 'data_links_rows'
+        :return: tuple (sent, failed), lists with the positions of records in
+            the input that were accepted or rejected by the resolver
+        """
+        sent, failed, _ = self._send(records)
+        return sent, failed
+
+    def send_deltas(self, deltas):
+        """Sends deltas built by make_delta to delta_url.
+
+        :return: tuple (sent, failed, unsupported), lists of positions in the
+            input; unsupported holds the deltas that were not sent because the
+            resolver does not accept deltas, these need a full replacement
+        """
+        if not self.delta_url:
+            return [], [], list(range(len(deltas)))
+        return self._send(deltas, delta=True)
+
+    def _send(self, records, delta=False):
+        url = self.delta_url if delta else self.url
+        sent = []
+        failed = []
+        pending = [list(range(len(records)))]
+        while pending:
+            positions = pending.pop()
+            try:
+                ok, error = self.put([records[i] for i in positions], delta=delta)
+            except DeltaNotSupported as e:
+                self.logger.warning('%s, disabling delta updates', e)
+                self.delta_url = None
+                unsent = positions + [i for p in pending for i in p]
+                return sorted(sent), sorted(failed), sorted(unsent)
+            except ResolverUnavailable as e:
+                # no point in bisecting or sending the rest
+                unsent = positions + [i for p in pending for i in p]
+                self.logger.error('%s, %s records not sent', e, len(unsent))
+                return sorted(sent), sorted(failed + unsent), []
+            if ok:
+                sent.extend(positions)
+            elif len(positions) == 1:
+                self.logger.error('error sending individual links to %s for bibcode %s, error = %s',
+                                  url, records[positions[0]].get('bibcode'), error)
+                failed.extend(positions)
+            else:
+                self.logger.error('error sending %s links to %s, will bisect, error = %s',
+                                  len(positions), url, error)
+                middle = len(positions) // 2
+                pending.append(positions[middle:])
+                pending.append(positions[:middle])
+        return sorted(sent), sorted(failed), []
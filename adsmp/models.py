@@ -5,13 +5,14 @@ from past.builtins import basestring
 from adsputils import get_date
 from datetime import datetime
 from dateutil.tz import tzutc
-from sqlalchemy import Column, Integer, BigInteger, String, Text, TIMESTAMP, Boolean, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, Text, TIMESTAMP, Boolean, DateTime, LargeBinary
 from sqlalchemy import types
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.types import Enum
 from sqlalchemy.dialects import postgresql
 from sqlalchemy import text
 import json
+import zlib
 from sqlalchemy import ForeignKey
 
 Base = declarative_base()
@@ -63,7 +64,7 @@ class Records(Base):
     boost_factors = Column(Text) # holds a dictionary of boost factors but stored as a string
 
     # when data is received we set the updated timestamp
-    bib_data_updated = Column(UTCDateTime, default=None)
+    bib_data_updated = Column(UTCDateTime, default=None, index=True)
     orcid_claims_updated = Column(UTCDateTime, default=None)
     nonbib_data_updated = Column(UTCDateTime, default=None)
     fulltext_updated = Column(UTCDateTime, default=None)
@@ -76,13 +77,16 @@ class Records(Base):
     updated = Column(UTCDateTime, default=get_date)
     processed = Column(UTCDateTime)
 
-    solr_processed = Column(UTCDateTime, default=None)
+    solr_processed = Column(UTCDateTime, default=None, index=True)
     metrics_processed = Column(UTCDateTime, default=None)
     datalinks_processed = Column(UTCDateTime, default=None)
 
     solr_checksum = Column(String(10), default=None)
     metrics_checksum = Column(String(10), default=None)
     datalinks_checksum = Column(String(10), default=None)
+    # json dict row key -> crc of the data links rows last accepted by the
+    # resolver, used to send it row level deltas
+    datalinks_fingerprints = Column(Text, default=None)
 
     status = Column(Enum('solr-failed', 'metrics-failed', 'links-failed', 'retrying', 'success', name='status'))
 
@@ -141,6 +145,22 @@ class ChangeLog(Base):
                 }
 
 
+class SolrDoc(Base):
+    """The last document accepted by solr for each bibcode, stored as zlib
+    compressed json; used to replay documents and to diff them"""
+    __tablename__ = 'solr_docs'
+    bibcode = Column(String(19), primary_key=True)
+    checksum = Column(String(10))
+    doc = Column(LargeBinary)
+    updated = Column(UTCDateTime, default=get_date)
+
+    def toJSON(self):
+        return {'bibcode': self.bibcode,
+                'checksum': self.checksum,
+                'doc': json.loads(zlib.decompress(self.doc).decode('utf-8')),
+                'updated': self.updated and get_date(self.updated).isoformat() or None}
+
+
 class IdentifierMapping(Base):
     """Storage for the mapping (bibcode translation) - it is a directed
     graph pointing to the most recent canonical identifier"""
@@ -190,6 +210,143 @@ class SitemapInfo(Base):
             'update_flag': self.update_flag,           
         }
 
+class SitemapFile(Base):
+    """
+    One row per sitemap file, maintained together with the sitemap table so
+    the state of the files is known without scanning it.
+
+    Attributes:
+        filename (str): The sitemap filename, e.g. sitemap_bib_3.xml.
+        file_index (int): The number in the filename (3), None for names
+            outside the sitemap_bib_N.xml numbering.
+        record_count (int): Number of sitemap rows assigned to the file.
+        last_generated (datetime): When the file was last written.
+        content_hash (str): Hash of the content last written.
+    """
+
+    __tablename__ = 'sitemap_files'
+
+    filename = Column(String(255), primary_key=True)
+    file_index = Column(Integer, index=True, unique=True)
+    record_count = Column(Integer, nullable=False, default=0)
+    last_generated = Column(UTCDateTime, default=None)
+    content_hash = Column(String(64), default=None)
+
+    def toJSON(self):
+        return {
+            'filename': self.filename,
+            'file_index': self.file_index,
+            'record_count': self.record_count,
+            'last_generated': self.last_generated,
+            'content_hash': self.content_hash,
+        }
+
+class SitemapFileSite(Base):
+    """
+    What was last written for a sitemap file in one site directory, the
+    sitemap index is built from these rows.
+
+    Attributes:
+        filename (str): The sitemap filename (as in the sitemap table).
+        site (str): The SITES key.
+        output_filename (str): The name written to disk (.xml or .xml.gz).
+        generated (datetime): When the file was written.
+        byte_size (int): Size of the file on disk.
+        content_hash (str): sha256 of the (uncompressed) content.
+    """
+
+    __tablename__ = 'sitemap_file_sites'
+
+    filename = Column(String(255), primary_key=True)
+    site = Column(String(64), primary_key=True)
+    output_filename = Column(String(255), nullable=False)
+    generated = Column(UTCDateTime, default=None)
+    byte_size = Column(BigInteger, default=None)
+    content_hash = Column(String(64), default=None)
+
+    def toJSON(self):
+        return {
+            'filename': self.filename,
+            'site': self.site,
+            'output_filename': self.output_filename,
+            'generated': self.generated,
+            'byte_size': self.byte_size,
+            'content_hash': self.content_hash,
+        }
+
+class SitemapRun(Base):
+    """
+    One row per run of task_update_sitemap_files; every file task counts
+    itself off when it succeeds and the last one triggers the index. A run
+    with a failed (or lost) file task never counts down to zero, it is
+    closed by task_update_sitemap_files after SITEMAP_RUN_TIMEOUT_MINUTES.
+
+    Attributes:
+        id (int): The unique identifier for the run.
+        total_files (int): Number of file tasks sent.
+        pending_files (int): File tasks not finished yet.
+        created (datetime): When the run was started.
+        finished (datetime): When the last file task finished, or when the
+            run was closed as stale.
+        written_files (int): Site files published by the run.
+        skipped_files (int): Site files left alone, content unchanged.
+        failed_files (int): File tasks that failed.
+    """
+
+    __tablename__ = 'sitemap_runs'
+
+    id = Column(Integer, primary_key=True)
+    total_files = Column(Integer, nullable=False, default=0)
+    pending_files = Column(Integer, nullable=False, default=0)
+    created = Column(UTCDateTime, default=get_date)
+    finished = Column(UTCDateTime, default=None)
+    written_files = Column(Integer, nullable=False, default=0)
+    skipped_files = Column(Integer, nullable=False, default=0)
+    failed_files = Column(Integer, nullable=False, default=0)
+
+    def toJSON(self):
+        return {
+            'id': self.id,
+            'total_files': self.total_files,
+            'pending_files': self.pending_files,
+            'created': self.created,
+            'finished': self.finished,
+            'written_files': self.written_files,
+            'skipped_files': self.skipped_files,
+            'failed_files': self.failed_files,
+        }
+
+class SitemapSyncedFile(Base):
+    """
+    What was last uploaded to the object store for a file of a site
+    directory (sitemap files, index, robots.txt), so a sync only uploads
+    what changed since.
+
+    Attributes:
+        site (str): The SITES key.
+        filename (str): The name of the file in the site directory.
+        content_hash (str): Hash of the file when it was uploaded.
+        byte_size (int): Size of the file uploaded.
+        synced (datetime): When it was uploaded.
+    """
+
+    __tablename__ = 'sitemap_synced_files'
+
+    site = Column(String(64), primary_key=True)
+    filename = Column(String(255), primary_key=True)
+    content_hash = Column(String(64), nullable=False)
+    byte_size = Column(BigInteger, default=None)
+    synced = Column(UTCDateTime, default=get_date)
+
+    def toJSON(self):
+        return {
+            'site': self.site,
+            'filename': self.filename,
+            'content_hash': self.content_hash,
+            'byte_size': self.byte_size,
+            'synced': self.synced,
+        }
+
 ## This definition is copied directly from: https://github.com/adsabs/metrics_service/blob/master/service/models.py
 ## We need to have it when we are sending/writing data into the metrics database
 class MetricsModel(MetricsBase):
@@ -0,0 +1,260 @@
+"""Incremental upload of the sitemap output to an object store.
+
+sync_sitemaps() compares every file of the site directories (sitemap
+files, index, robots.txt, ...) with what was last uploaded, kept in the
+sitemap_synced_files table, uploads the files whose content changed from a
+pool of threads and deletes the remote objects that have no local file any
+more. Objects are stored as <prefix><site>/<filename>.
+
+The hash of a sitemap file comes from sitemap_file_sites (computed while it
+was written) as long as the size on disk matches; other files, and files
+that don't match, are hashed from disk.
+
+Two backends: S3Backend (botocore, any S3 compatible endpoint) and
+DirectoryBackend, a directory standing in for the bucket, e.g. in tests or
+with SITEMAP_S3_BUCKET = 'file:///some/dir'.
+"""
+
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from adsputils import get_date
+
+from adsmp.models import SitemapFileSite, SitemapSyncedFile
+from adsmp.solr_export import file_sha256
+
+# defaults of SITEMAP_S3_SYNC_CONCURRENCY, SITEMAP_S3_MULTIPART_THRESHOLD and
+# SITEMAP_S3_MULTIPART_PART_SIZE
+CONCURRENCY = 8
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+
+CONTENT_TYPES = {
+    '.xml': 'application/xml',
+    '.gz': 'application/gzip',
+    '.txt': 'text/plain',
+}
+
+
+def content_type(filename):
+    return CONTENT_TYPES.get(os.path.splitext(filename)[1], 'application/octet-stream')
+
+
+class DirectoryBackend(object):
+    """Keeps the objects as files under root, multipart uploads are staged
+    as part files and concatenated on completion"""
+
+    def __init__(self, root):
+        self.root = root
+        self.multipart_uploads = 0
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def list_keys(self, prefix):
+        directory = self._path(prefix)
+        if not os.path.isdir(directory):
+            return
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                yield prefix + entry.name
+
+    def _replace(self, key, write):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(tmp, 'wb') as out:
+            write(out)
+        os.replace(tmp, path)
+
+    def put(self, key, path, content_type):
+        with open(path, 'rb') as f:
+            self._replace(key, lambda out: shutil.copyfileobj(f, out))
+
+    def create_multipart(self, key, content_type):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.root, '.multipart', upload_id))
+        return upload_id
+
+    def upload_part(self, key, upload_id, number, data):
+        with open(os.path.join(self.root, '.multipart', upload_id, '%05d' % number), 'wb') as f:
+            f.write(data)
+        return '%05d' % number
+
+    def complete_multipart(self, key, upload_id, etags):
+        staging = os.path.join(self.root, '.multipart', upload_id)
+
+        def write(out):
+            for etag in etags:
+                with open(os.path.join(staging, etag), 'rb') as part:
+                    shutil.copyfileobj(part, out)
+        self._replace(key, write)
+        shutil.rmtree(staging)
+        self.multipart_uploads += 1
+
+    def abort_multipart(self, key, upload_id):
+        shutil.rmtree(os.path.join(self.root, '.multipart', upload_id), ignore_errors=True)
+
+    def delete(self, keys):
+        for key in keys:
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+
+
+class S3Backend(object):
+    """Objects in an S3 bucket, under an optional key prefix
+
+    :param client: a botocore s3 client, created from client_kwargs
+        (endpoint_url, region_name, credentials) if not given
+    """
+
+    def __init__(self, bucket, prefix='', client=None, **client_kwargs):
+        if client is None:
+            import botocore.session
+            client = botocore.session.get_session().create_client('s3', **client_kwargs)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def list_keys(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(self.prefix):]
+
+    def put(self, key, path, content_type):
+        with open(path, 'rb') as f:
+            self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=f, ContentType=content_type)
+
+    def create_multipart(self, key, content_type):
+        return self.client.create_multipart_upload(Bucket=self.bucket, Key=self.prefix + key,
+                                                   ContentType=content_type)['UploadId']
+
+    def upload_part(self, key, upload_id, number, data):
+        return self.client.upload_part(Bucket=self.bucket, Key=self.prefix + key, UploadId=upload_id,
+                                       PartNumber=number, Body=data)['ETag']
+
+    def complete_multipart(self, key, upload_id, etags):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.prefix + key, UploadId=upload_id,
+            MultipartUpload={'Parts': [{'ETag': etag, 'PartNumber': n} for n, etag in enumerate(etags, 1)]})
+
+    def abort_multipart(self, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.prefix + key, UploadId=upload_id)
+
+    def delete(self, keys):
+        keys = list(keys)
+        # at most 1000 keys per request
+        for i in range(0, len(keys), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': self.prefix + k} for k in keys[i:i + 1000]], 'Quiet': True})
+
+
+def backend_from_config(conf):
+    """The backend for SITEMAP_S3_BUCKET, a file:// url gives a DirectoryBackend"""
+    bucket = conf.get('SITEMAP_S3_BUCKET')
+    prefix = conf.get('SITEMAP_S3_PREFIX', '')
+    if bucket.startswith('file://'):
+        return DirectoryBackend(os.path.join(bucket[len('file://'):], *prefix.split('/')))
+    return S3Backend(bucket, prefix=prefix,
+                     endpoint_url=conf.get('SITEMAP_S3_ENDPOINT_URL'),
+                     region_name=conf.get('AWS_DEFAULT_REGION'),
+                     aws_access_key_id=conf.get('AWS_ACCESS_KEY_ID'),
+                     aws_secret_access_key=conf.get('AWS_SECRET_ACCESS_KEY'))
+
+
+def upload_file(backend, key, path, size, multipart_threshold, part_size):
+    """Uploads path as key, in parts of part_size from multipart_threshold bytes on"""
+    if size < multipart_threshold:
+        backend.put(key, path, content_type(key))
+        return
+    upload_id = backend.create_multipart(key, content_type(key))
+    try:
+        etags = []
+        with open(path, 'rb') as f:
+            for number, data in enumerate(iter(lambda: f.read(part_size), b''), 1):
+                etags.append(backend.upload_part(key, upload_id, number, data))
+        backend.complete_multipart(key, upload_id, etags)
+    except Exception:
+        backend.abort_multipart(key, upload_id)
+        raise
+
+
+def local_files(session, site_dir, site):
+    """dict filename -> (content hash, size) of the files of a site directory"""
+    written = {
+        output_filename: (content_hash, byte_size)
+        for output_filename, content_hash, byte_size in
+        session.query(SitemapFileSite.output_filename, SitemapFileSite.content_hash, SitemapFileSite.byte_size)
+        .filter(SitemapFileSite.site == site, SitemapFileSite.content_hash.isnot(None))
+    }
+    files = {}
+    if not os.path.isdir(site_dir):
+        return files
+    for entry in os.scandir(site_dir):
+        # skip files still being written
+        if not entry.is_file() or entry.name.endswith('.tmp'):
+            continue
+        size = entry.stat().st_size
+        known = written.get(entry.name)
+        if known is not None and known[1] == size:
+            files[entry.name] = known
+        else:
+            files[entry.name] = (file_sha256(entry.path), size)
+    return files
+
+
+def sync_sitemaps(app, backend, sitemap_dir, sites, concurrency=CONCURRENCY,
+                  multipart_threshold=MULTIPART_THRESHOLD, part_size=PART_SIZE):
+    """Uploads the changed files of every site directory and deletes the
+    remote objects removed locally.
+
+    A file that fails to upload is left as it was in sitemap_synced_files,
+    so the next sync tries again.
+
+    :param sites: SITES keys, the subdirectories of sitemap_dir
+    :param concurrency: number of uploads running at the same time
+    :return: dict with the number of files 'uploaded', 'unchanged' and
+        'deleted', and the keys that 'failed'
+    """
+    result = {'uploaded': 0, 'unchanged': 0, 'deleted': 0, 'failed': []}
+    with app.session_scope() as session:
+        for site in sites:
+            files = local_files(session, os.path.join(sitemap_dir, site), site)
+            synced = dict(session.query(SitemapSyncedFile.filename, SitemapSyncedFile.content_hash)
+                          .filter(SitemapSyncedFile.site == site))
+            changed = sorted(name for name, (content_hash, _) in files.items() if synced.get(name) != content_hash)
+            result['unchanged'] += len(files) - len(changed)
+
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                futures = [
+                    (name, pool.submit(upload_file, backend, '%s/%s' % (site, name),
+                                       os.path.join(sitemap_dir, site, name), files[name][1],
+                                       multipart_threshold, part_size))
+                    for name in changed
+                ]
+                for name, future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        app.logger.error('Failed to upload %s/%s: %s', site, name, e)
+                        result['failed'].append('%s/%s' % (site, name))
+                        continue
+                    session.merge(SitemapSyncedFile(site=site, filename=name, content_hash=files[name][0],
+                                                    byte_size=files[name][1], synced=get_date()))
+                    result['uploaded'] += 1
+
+            removed = [key for key in backend.list_keys(site + '/') if key[len(site) + 1:] not in files]
+            if removed:
+                backend.delete(removed)
+                result['deleted'] += len(removed)
+            session.query(SitemapSyncedFile).filter(
+                SitemapSyncedFile.site == site,
+                SitemapSyncedFile.filename.notin_(list(files))
+            ).delete(synchronize_session=False)
+            session.commit()
+            app.logger.info('Synced sitemap site %s: %d uploaded, %d unchanged, %d deleted so far',
+                            site, result['uploaded'], result['unchanged'], result['deleted'])
+    return result
@@ -0,0 +1,258 @@
+"""Offline export of solr documents.
+
+export_solr_docs() walks the records table in id order (keyset pagination),
+builds the final solr documents in a pool of worker processes and writes
+them as gzipped JSON lines, sharded in files of a fixed number of documents,
+together with a manifest. load_solr_export() posts such an export to any
+solr collection; the same export can be loaded into several targets and no
+celery broker is involved.
+
+With SOLR_DOC_STORE the documents accepted by solr are also kept in the
+solr_docs table; replay_solr_docs() posts them to another collection and
+diff_stored_solr_docs() compares them with freshly built documents.
+
+Every line of a shard is {"bibcode": ..., "checksum": ..., "doc": {...}},
+the checksum is the one reindex stores in records.solr_checksum.
+"""
+
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import deque
+
+from adsputils import get_date
+
+from adsmp import solr_updater
+from adsmp.app import checksum
+from adsmp.models import Records
+
+MANIFEST = 'manifest.json'
+
+
+def iter_record_batches(app, batch_size=1000, start_id=0, end_id=None):
+    """Yields lists of records (as dicts) that have bib data, in id order;
+    every batch is a fresh query starting after the last id seen"""
+    last_id = start_id
+    while True:
+        with app.session_scope() as session:
+            q = session.query(Records) \
+                .filter(Records.id > last_id) \
+                .filter(Records.bib_data_updated.isnot(None))
+            if end_id is not None:
+                q = q.filter(Records.id <= end_id)
+            batch = [r.toJSON() for r in q.order_by(Records.id).limit(batch_size)]
+        if not batch:
+            return
+        last_id = batch[-1]['id']
+        yield batch
+
+
+def transform_batch(batch):
+    """Returns (last id, list of json lines) for a batch of records"""
+    lines = []
+    for r in batch:
+        doc = solr_updater.to_solr_doc(r)
+        lines.append(json.dumps({'bibcode': doc['bibcode'], 'checksum': checksum(doc), 'doc': doc}))
+    return batch[-1]['id'], lines
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ShardWriter(object):
+    """Writes lines to directory/prefix-NNNNN.jsonl.gz, starting a new file
+    every shard_size lines; a shard only gets its final name once complete"""
+
+    def __init__(self, directory, shard_size, prefix='solr-docs'):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.shards = []
+        self.f = None
+        self.count = 0
+
+    def write(self, line):
+        if self.f is None:
+            self.filename = '%s-%05d.jsonl.gz' % (self.prefix, len(self.shards))
+            self.tmp = os.path.join(self.directory, self.filename + '.tmp')
+            self.f = gzip.open(self.tmp, 'wt', encoding='utf-8')
+            self.count = 0
+        self.f.write(line)
+        self.f.write('\n')
+        self.count += 1
+        if self.count >= self.shard_size:
+            self.close_shard()
+
+    def close_shard(self):
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+        path = os.path.join(self.directory, self.filename)
+        os.replace(self.tmp, path)
+        self.shards.append({'file': self.filename, 'count': self.count, 'sha256': file_sha256(path)})
+
+
+def export_solr_docs(app, directory, batch_size=1000, shard_size=100000, workers=None,
+                     start_id=0, end_id=None):
+    """Exports solr documents for all records with bib data.
+
+    :param directory: output directory, created if needed
+    :param batch_size: records per query and per unit of work
+    :param shard_size: documents per output file
+    :param workers: number of transform processes, defaults to the cpu
+        count; 1 transforms in this process
+    :param start_id, end_id: export only records with start_id < id <= end_id
+    :return: the manifest (also written to directory/manifest.json)
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    workers = workers or multiprocessing.cpu_count()
+    writer = ShardWriter(directory, shard_size)
+    manifest = {'created': get_date().isoformat(), 'start_id': start_id, 'last_id': start_id,
+                'count': 0, 'shards': writer.shards}
+
+    def write(result):
+        last_id, lines = result
+        for line in lines:
+            writer.write(line)
+        manifest['count'] += len(lines)
+        manifest['last_id'] = last_id
+        app.logger.info('exported %s solr docs to %s, last id %s', manifest['count'], directory, last_id)
+
+    batches = iter_record_batches(app, batch_size=batch_size, start_id=start_id, end_id=end_id)
+    if workers == 1:
+        for batch in batches:
+            write(transform_batch(batch))
+    else:
+        # the pool is created before any batch is read; results are written
+        # in order and at most 2 batches per worker are in flight, so memory
+        # stays bounded however large the table is
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.apply_async(transform_batch, (batch,)))
+                if len(pending) >= 2 * workers:
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+    writer.close_shard()
+
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def read_export(directory, verify=True):
+    """Yields (bibcode, checksum, doc) from an export in shard order
+
+    :param verify: compare every shard with the sha256 in the manifest
+    """
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    if verify:
+        # check everything before the first document is handed out
+        for shard in manifest['shards']:
+            path = os.path.join(directory, shard['file'])
+            if file_sha256(path) != shard['sha256']:
+                raise ValueError('checksum mismatch for %s, the export is corrupted' % path)
+    for shard in manifest['shards']:
+        with gzip.open(os.path.join(directory, shard['file']), 'rt', encoding='utf-8') as f:
+            for line in f:
+                x = json.loads(line)
+                yield x['bibcode'], x['checksum'], x['doc']
+
+
+def post_docs(docs, solr_urls, batch_size=100, commit=False, app=None, update_processed=False):
+    """Posts (bibcode, checksum, doc) tuples to the given solr urls in
+    batches, a rejected batch is retried one document at a time.
+
+    :param app: only needed with update_processed, to store the checksums of
+        the documents that were accepted (as index_solr does)
+    :return: tuple (number of docs posted, list of bibcodes that failed)
+    """
+    posted = 0
+    failed = []
+
+    def post(batch):
+        ok = []
+        if not solr_updater.update_solr([x[2] for x in batch], solr_urls, ignore_errors=True):
+            ok = batch
+        else:
+            for x in batch:
+                try:
+                    solr_updater.update_solr([x[2]], solr_urls)
+                    ok.append(x)
+                except Exception as e:
+                    solr_updater.logger.error('failed to post %s: %s', x[0], e)
+                    failed.append(x[0])
+        if ok and update_processed:
+            app.mark_processed([x[0] for x in ok], 'solr', checksums=[x[1] for x in ok], status='success')
+        return len(ok)
+
+    batch = []
+    for x in docs:
+        batch.append(x)
+        if len(batch) >= batch_size:
+            posted += post(batch)
+            batch = []
+    if batch:
+        posted += post(batch)
+    if commit:
+        solr_updater.update_solr([], solr_urls, commit=True)
+    return posted, failed
+
+
+def load_solr_export(directory, solr_urls, batch_size=100, commit=False, app=None,
+                     update_processed=False, verify=True):
+    """Posts an export to the given solr urls, see post_docs"""
+    return post_docs(read_export(directory, verify=verify), solr_urls, batch_size=batch_size,
+                     commit=commit, app=app, update_processed=update_processed)
+
+
+def replay_solr_docs(app, solr_urls, batch_size=100, commit=False):
+    """Posts the documents kept in the solr_docs table (SOLR_DOC_STORE) to
+    the given solr urls, e.g. to seed a new collection without rebuilding
+    them; see post_docs"""
+    return post_docs(app.iter_solr_docs(batch_size=max(batch_size, 1000)), solr_urls,
+                     batch_size=batch_size, commit=commit)
+
+
+def diff_docs(old, new):
+    """Field level differences between two solr documents
+
+    :return: dict with 'added' and 'removed' (field -> value) and 'changed'
+        (field -> (old value, new value)), all empty if the docs are equal
+    """
+    return {'added': {k: new[k] for k in new if k not in old},
+            'removed': {k: old[k] for k in old if k not in new},
+            'changed': {k: (old[k], new[k]) for k in old if k in new and old[k] != new[k]}}
+
+
+def diff_stored_solr_docs(app, bibcodes):
+    """Compares the stored (last sent) solr docs with freshly built ones
+
+    :return: dict bibcode -> diff_docs(stored, fresh); bibcodes without a
+        stored doc or without a record are left out
+    """
+    stored = app.get_solr_docs(bibcodes)
+    out = {}
+    for bibcode in bibcodes:
+        record = app.get_record(bibcode) if bibcode in stored else None
+        if record is None:
+            continue
+        # same normalization the stored doc went through
+        fresh = json.loads(json.dumps(solr_updater.to_solr_doc(record)))
+        out[bibcode] = diff_docs(stored[bibcode], fresh)
+    return out
@@ -1,7 +1,9 @@
 import json
 import os
+import re
 import sys
 import time
+from functools import lru_cache
 
 import requests
 from adsputils import date2solrstamp, load_config, setup_logging
@@ -15,6 +17,11 @@ logger = setup_logging(
     attach_stdout=config.get("LOG_STDOUT", False),
 )
 
+# names of fields to check for solr "has:" field, sorted once
+HAS_FIELDS = sorted(config.get("HAS_FIELDS", []))
+# same characters as str.isalnum(), \w minus the underscore
+_alnum = re.compile(r"[^\W_]")
+
 
 def extract_metrics_pipeline(data, solrdoc):
     citation = data.get("citations", [])
@@ -40,7 +47,7 @@ def extract_data_pipeline(data, solrdoc):
         agency, grant_no = x.split(" ", 1)
         grant.append(agency)
         grant.append(grant_no)
-        grant_facet_hier.extend(generate_hier_facet(agency, grant_no))
+        grant_facet_hier.extend(_hier_facet(agency, grant_no))
 
     planetary_feature = []
     planetary_feature_id = []
@@ -62,10 +69,10 @@ def extract_data_pipeline(data, solrdoc):
         planet, feature, feature_name, id_no = x.split("/", 3)
         planetary_feature.append("/".join([planet, feature, feature_name]))
         planetary_feature_id.append(id_no)
-        planetary_feature_facet_hier_3level.extend(generate_hier_facet(planet, feature, feature_name))
+        planetary_feature_facet_hier_3level.extend(_hier_facet(planet, feature, feature_name))
         if feature.lower() in featurelist:
             feature_name = " ".join([feature, feature_name])
-        planetary_feature_facet_hier_2level.extend(generate_hier_facet(planet, feature_name))
+        planetary_feature_facet_hier_2level.extend(_hier_facet(planet, feature_name))
 
     uat = []
     uat_id = []
@@ -77,7 +84,7 @@ def extract_data_pipeline(data, solrdoc):
         uat_no = uat_info[-1]
         uat.append("/".join(uat_keywords))
         uat_id.append(uat_no)
-        uat_facet_hier.extend(generate_hier_facet(*uat_keywords))
+        uat_facet_hier.extend(_hier_facet(*uat_keywords))
 
     simbid = []
     simbtype = []
@@ -94,10 +101,9 @@ def extract_data_pipeline(data, solrdoc):
                 )
             )
         simbid.append(sid)
-        simbtype.append(map_simbad_type(stype))
-        simbad_object_facet_hier.extend(
-            generate_hier_facet(map_simbad_type(stype), sid)
-        )
+        stype = map_simbad_type(stype)
+        simbtype.append(stype)
+        simbad_object_facet_hier.extend(_hier_facet(stype, sid))
 
     nedid = []
     nedtype = []
@@ -114,8 +120,9 @@ def extract_data_pipeline(data, solrdoc):
                 )
             )
         nedid.append(nid)
-        nedtype.append(map_ned_type(ntype))
-        ned_object_facet_hier.extend(generate_hier_facet(map_ned_type(ntype), nid))
+        ntype = map_ned_type(ntype)
+        nedtype.append(ntype)
+        ned_object_facet_hier.extend(_hier_facet(ntype, nid))
 
     d = dict(
         reader=reader,
@@ -237,16 +244,29 @@ def extract_fulltext(data, solrdoc):
 
 
 def generate_hier_facet(*levels):
-    levels = list(levels)
-    out = []
-    i = 0
-    tmpl = "{}/{}"
-    j = len(levels)
-    while i < j:
-        out.append(tmpl.format(*[i] + levels[0 : i + 1]))
-        tmpl += "/{}"
-        i += 1
-    return out
+    return list(_hier_facet(*levels))
+
+
+def _hier_facet(*levels):
+    """generate_hier_facet as a tuple, the parent levels come from a cache"""
+    if not levels:
+        return ()
+    facets, path = _hier_parents(levels[:-1])
+    leaf = levels[-1] if path is None else path + "/" + levels[-1]
+    return facets + ("%d/%s" % (len(levels) - 1, leaf),)
+
+
+# the leading levels (object types, grant agencies, planets, UAT branches)
+# repeat across records while the last level is mostly unique, so only the
+# parents are memoized; tuples so that cached values can't be modified
+@lru_cache(maxsize=16384)
+def _hier_parents(levels):
+    """Returns (facet values, path) for the given leading levels"""
+    if not levels:
+        return (), None
+    facets, path = _hier_parents(levels[:-1])
+    path = levels[-1] if path is None else path + "/" + levels[-1]
+    return facets + ("%d/%s" % (len(levels) - 1, path),), path
 
 
 def get_orcid_claims(data, solrdoc):
@@ -266,6 +286,12 @@ def map_simbad_type(otype):
     used for searching and faceting.  Based on Thomas Boch's mappings
     used in AladinLite
     """
+    return SIMBAD_TYPES.get(otype) or _simbad_class(otype)
+
+
+@lru_cache(maxsize=4096)
+def _simbad_class(otype):
+    """The SIMBAD rules, for types not in SIMBAD_TYPES"""
     if otype.startswith("G") or otype.endswith("G"):
         return "Galaxy"
     elif otype == "Star" or otype.find("*") >= 0:
@@ -321,6 +347,12 @@ def map_ned_type(otype):
     Maps a native NED object type to a subset of basic classes
     used for searching and faceting.
     """
+    return NED_TYPES.get(otype) or _ned_class(otype)
+
+
+@lru_cache(maxsize=4096)
+def _ned_class(otype):
+    """The NED rules, for types not in NED_TYPES"""
     if otype.startswith("!"):
         return "Galactic Object"
     elif otype.startswith("*"):
@@ -333,6 +365,27 @@ def map_ned_type(otype):
         return _o_types.get(otype, "Other")
 
 
+# precomputed from the rules for the object types that make up nearly all of
+# the data, other types go through the rules and a bounded cache
+SIMBAD_TYPES = {
+    x: _simbad_class.__wrapped__(x)
+    for x in [
+        "*", "**", "*iC", "*iN", "*inCl", "AGN", "BLL", "Be*", "BiC", "Bla", "C*", "Cl*", "ClG",
+        "EB*", "EmG", "EmO", "G", "GiC", "GiG", "GiP", "GlC", "GrG", "H2G", "HI", "HII", "HzG",
+        "IG", "IR", "LIN", "LSB", "MIR", "Maser", "Mi*", "Neb", "OpC", "PM*", "PN", "PaG", "Psr",
+        "QSO", "RGB*", "Radio", "Radio(cm)", "Red*", "RR*", "SBG", "SN", "SNR", "Sy1", "Sy2",
+        "SyG", "UV", "V*", "WD*", "WR*", "X", "YSO", "bCG", "gam", "mul", "rG", "smm",
+    ]
+}
+NED_TYPES = {
+    x: _ned_class.__wrapped__(x)
+    for x in list(_o_types) + [
+        "!*", "!Cl", "!HII", "!Neb", "!PN", "!SNR", "*", "**", "*Ass", "*Cl", "EmLS", "EmObj",
+        "IrS", "MCld", "Other", "QGroup", "QSO", "RadioS", "SmmS", "UvES", "UvS", "VisS", "XrayS",
+    ]
+}
+
+
 # When building SOLR record, we grab data from the database and insert them
 # into the dictionary with the following conventions:
 
@@ -440,6 +493,93 @@ def update_solr(json_records, solr_urls, ignore_errors=False, commit=False):
     return out
 
 
+class TransformStats(object):
+    """Cumulative time, number of calls and output size (number of fields
+    produced) per stage of transform_json_record.
+
+    When log_interval (seconds) is set, a summary line is logged at most
+    that often while records are being transformed.
+    """
+
+    def __init__(self, log_interval=None):
+        self.log_interval = log_interval
+        self.reset()
+
+    def reset(self):
+        self.records = 0
+        self.stages = {}
+        self.last_logged = time.time()
+
+    def add(self, stage, seconds, size):
+        s = self.stages.get(stage)
+        if s is None:
+            s = self.stages[stage] = {"calls": 0, "seconds": 0.0, "size": 0}
+        s["calls"] += 1
+        s["seconds"] += seconds
+        s["size"] += size
+
+    def lap(self, stage, start, size):
+        """Adds the time since start to stage, returns the new start"""
+        now = time.perf_counter()
+        self.add(stage, now - start, size)
+        return now
+
+    def record_done(self):
+        self.records += 1
+        if self.log_interval and time.time() - self.last_logged >= self.log_interval:
+            logger.info("solr transform stats: %s", self.summary())
+            self.last_logged = time.time()
+
+    def summary(self):
+        """One line, slowest stage first"""
+        stages = sorted(self.stages.items(), key=lambda x: -x[1]["seconds"])
+        return "records=%s %s" % (self.records, " ".join(
+            "%s=%.3fs/%s/%s" % (k, v["seconds"], v["calls"], v["size"]) for k, v in stages))
+
+    def as_dict(self):
+        return {"records": self.records,
+                "stages": {k: dict(v) for k, v in self.stages.items()}}
+
+
+stats = None
+if config.get("SOLR_TRANSFORM_STATS", False):
+    stats = TransformStats(config.get("SOLR_TRANSFORM_STATS_INTERVAL", 300))
+
+
+def enable_transform_stats(log_interval=None):
+    """Starts collecting (fresh) per-stage stats in this process"""
+    global stats
+    stats = TransformStats(log_interval)
+    return stats
+
+
+def disable_transform_stats():
+    global stats
+    stats = None
+
+
+def transform_stats():
+    """Collected stats as a dict, {} when they are not enabled"""
+    return stats.as_dict() if stats is not None else {}
+
+
+def has_alnum(value):
+    """True if value holds at least one alphanumeric character, this is done
+    to not count fields where blank entries can be ['-',...]
+
+    Strings and lists of strings are scanned element by element and the scan
+    stops at the first match, anything else is checked by its str()
+    """
+    if isinstance(value, str):
+        return _alnum.search(value) is not None
+    if not isinstance(value, list):
+        value = [value]
+    for x in value:
+        if _alnum.search(x if isinstance(x, str) else str(x)):
+            return True
+    return False
+
+
 def transform_json_record(db_record):
     out = {"bibcode": db_record["bibcode"]}
 
@@ -455,7 +595,11 @@ def transform_json_record(db_record):
     timestamps.sort(key=lambda x: x[2])
 
     # merge data based on timestamps
+    st = stats
     for field, target, _ in timestamps:
+        if st is not None:
+            start = time.perf_counter()
+        x = None
         if db_record.get(field, None):
             if target:
                 if callable(target):
@@ -465,12 +609,13 @@ def transform_json_record(db_record):
                     if x:
                         out.update(x)
                 else:
-                    out[target] = db_record.get(field)
+                    x = out[target] = db_record.get(field)
             else:
                 if target is None:
                     continue
 
-                out.update(db_record.get(field))
+                x = db_record.get(field)
+                out.update(x)
 
         elif field.startswith("#"):
             if callable(target):
@@ -479,7 +624,14 @@ def transform_json_record(db_record):
                 )  # in the interest of speed, don't create copy of out
                 if x:
                     out.update(x)
+        else:
+            continue
+        if st is not None:
+            st.add(getattr(target, "__name__", None) or field, time.perf_counter() - start,
+                   len(x) if isinstance(x, dict) else int(x is not None))
 
+    if st is not None:
+        start = time.perf_counter()
     # override temporal priority for links data
     if (
         db_record.get("bib_data", None)
@@ -491,6 +643,9 @@ def transform_json_record(db_record):
         # use nonbib data even if it is older
         out["links_data"] = db_record["nonbib_data"]["links_data"]
 
+    if st is not None:
+        start = st.lap("links", start, int("links_data" in out))
+
     # override temporal priority for bibgroup and bibgroup_facet, prefer nonbib
     if db_record.get("nonbib_data", None) and db_record["nonbib_data"].get(
         "bibgroup", None
@@ -500,7 +655,9 @@ def transform_json_record(db_record):
         "bibgroup_facet", None
     ):
         out["bibgroup_facet"] = db_record["nonbib_data"]["bibgroup_facet"]
-    
+    if st is not None:
+        start = st.lap("bibgroup", start, int("bibgroup" in out) + int("bibgroup_facet" in out))
+
     # if only bib data is available, use it to compute property
     if db_record.get("nonbib_data", None) is None and db_record.get("bib_data", None):
         links_data = db_record["bib_data"].get("links_data", None)
@@ -529,12 +686,17 @@ def transform_json_record(db_record):
                         db_record["bibcode"], type(links_data), links_data
                     )
                 )
+    if st is not None:
+        start = st.lap("bib_property", start, len(out.get("property", [])))
+
     boost_columns = ['doctype_boost', 'recency_boost', 'boost_factor', 'astronomy_final_boost', 'physics_final_boost', \
         'earth_science_final_boost', 'planetary_science_final_boost', 'heliophysics_final_boost', 'general_final_boost']
     
     for column in boost_columns:
         if column not in out.keys():
             out[column] = 1
+    if st is not None:
+        start = st.lap("boost_columns", start, len(boost_columns))
 
     # Override temporal priority for classifications data
     # if both bib_data and classifications provide values
@@ -550,29 +712,27 @@ def transform_json_record(db_record):
     out["scix_id"] = None
     if db_record.get("scix_id", None):
         out["scix_id"] = db_record.get("scix_id")
+    if st is not None:
+        start = st.lap("classifications_merge", start, int("database" in out))
 
     if config.get("ENABLE_HAS", False):
-        # Read-in names of fields to check for solr "has:" field
-        hasfields = sorted(config.get("HAS_FIELDS", []))
-
         # populate "has:" field with fields that exist for a particular record
-        has = []
-        for field in hasfields:
-            if out.get(field, ""):
-                # if field is not empty, check if at least one character is alphanumeric
-                # this is done to not count fields where blank entries can be ['-',...]
-
-                # if field does not have a string or list, make it a list of strings so it is iterable
+        out["has"] = [field for field in HAS_FIELDS if out.get(field, "") and has_alnum(out[field])]
+        if st is not None:
+            st.lap("has", start, len(out["has"]))
+    if st is not None:
+        st.record_done()
 
-                if not (isinstance(out[field], list) or isinstance(out[field], str)):
-                    out_field = str.join("", str(out[field]))
-                else:
-                    out_field = str.join("", out[field])
+    return out
 
-                out_field = set(out_field)
-                # iterate through each character of each element in the field to check for at least one alphanumeric character
-                if any([char.isalnum() for char in out_field]):
-                    has.append(field)
-        out["has"] = has
 
-    return out
+def to_solr_doc(db_record):
+    """Final solr document for a database record (as returned by
+    Records.toJSON), this is what gets posted to solr"""
+    doc = transform_json_record(db_record)
+    # ADS microservices assume the identifier field exists and contains the canonical bibcode:
+    if "identifier" not in doc:
+        doc["identifier"] = []
+    if "bibcode" in doc and doc["bibcode"] not in doc["identifier"]:
+        doc["identifier"].append(doc["bibcode"])
+    return doc
@@ -1,24 +1,26 @@
 from __future__ import absolute_import, unicode_literals
 from past.builtins import basestring
+import hashlib
+import html
 import os
 import time
+from datetime import datetime, timezone
 import shutil
 import adsputils
 import math
 from adsmp import app as app_module
 from adsmp import solr_updater
 from adsmp import templates
-# from adsmp import s3_utils
+from adsmp import sitemap_sync
 from kombu import Queue
 from adsmsg.msg import Msg
-from sqlalchemy import create_engine, MetaData, Table, exc, insert
+from sqlalchemy import create_engine, MetaData, Table, exc, func, insert
 from sqlalchemy.orm import sessionmaker
-from adsmp.models import SitemapInfo, Records
+from adsmp.models import SitemapFile, SitemapFileSite, SitemapInfo, Records
 import math
 from collections import defaultdict
 import pdb
 from sqlalchemy.orm import load_only
-from celery.exceptions import Retry
 
 
 
@@ -40,6 +42,7 @@ app.conf.CELERY_QUEUES = (
     Queue('manage-sitemap', app.exchange, routing_key='manage-sitemap'),
     Queue('generate-single-sitemap', app.exchange, routing_key='generate-single-sitemap'),
     Queue('update-sitemap-files', app.exchange, routing_key='update-sitemap-files'),
+    Queue('sync-sitemaps', app.exchange, routing_key='sync-sitemaps'),
     Queue('update-scixid', app.exchange, routing_key='update-scixid'),
     Queue('boost-request', app.exchange, routing_key='boost-request'),
     Queue('augment-record', app.exchange, routing_key='augment-record'),
@@ -310,8 +313,9 @@ def task_index_metrics(metrics_records, metrics_records_checksum, update_process
 
 
 @app.task(queue='index-data-links-resolver')
-def task_index_data_links_resolver(links_data_records, links_data_records_checksum, update_processed=True):
-    app.index_datalinks(links_data_records, links_data_records_checksum, update_processed=update_processed)
+def task_index_data_links_resolver(links_data_records, links_data_records_checksum, update_processed=True, use_deltas=True):
+    app.index_datalinks(links_data_records, links_data_records_checksum, update_processed=update_processed,
+                        use_deltas=use_deltas)
 
 
 def reindex_records(bibcodes, force=False, update_solr=True, update_metrics=True, update_links=True, commit=False,
@@ -393,13 +397,7 @@ def reindex_records(bibcodes, force=False, update_solr=True, update_metrics=True
                               metrics_updated, augments_updated))
             # build the solr record
             if update_solr:
-                solr_payload = solr_updater.transform_json_record(r)
-
-                # ADS microservices assume the identifier field exists and contains the canonical bibcode:
-                if 'identifier' not in solr_payload:
-                    solr_payload['identifier'] = []
-                if 'bibcode' in solr_payload and solr_payload['bibcode'] not in solr_payload['identifier']:
-                    solr_payload['identifier'].append(solr_payload['bibcode'])
+                solr_payload = solr_updater.to_solr_doc(r)
                 logger.debug('Built SOLR record for %s', solr_payload['bibcode'])
                 solr_checksum = app.checksum(solr_payload)
                 if ignore_checksums or r.get('solr_checksum', None) != solr_checksum:
@@ -455,7 +453,9 @@ def reindex_records(bibcodes, force=False, update_solr=True, update_metrics=True
         task_index_data_links_resolver.apply_async(
             args=(links_data_records, links_data_records_checksum,),
             kwargs={
-               'update_processed': update_processed
+               'update_processed': update_processed,
+               # a forced reindex resends the complete records
+               'use_deltas': not ignore_checksums
             }
         )
 
@@ -483,9 +483,14 @@ def task_cleanup_invalid_sitemaps():
     """
     Cleanup invalid sitemap entries using efficient batch processing.
     
-    This task processes all sitemap records in batches and removes those that
-    no longer meet inclusion criteria based on SOLR status, bib_data availability,
-    and processing staleness.
+    The inclusion criteria (record exists, has bib_data, SOLR status not
+    failed or retrying) are evaluated by the database: every batch is a
+    DELETE ... RETURNING sitemap_filename of the invalid rows only, the
+    sitemap_files counters of the affected files are set in the same
+    transaction.
+    
+    Valid rows are never read or counted, the result reports the rows
+    deleted ('invalid_removed').
     
     Returns:
         dict: Cleanup results with removed count and processing stats
@@ -495,86 +500,53 @@ def task_cleanup_invalid_sitemaps():
     
     batch_size = app.conf.get('SITEMAP_BOOTSTRAP_BATCH_SIZE', 50000)
     total_removed = 0
+    all_files_to_delete = set()
     all_files_to_update = set()
     batch_count = 0
-    total_processed = 0
-    
     last_id = 0  
     while True:
         with app.session_scope() as session:
-            # Get batch of sitemap records with associated Records data using keyset pagination
-            batch_query = (
-                session.query(
-                    SitemapInfo.id,  
-                    SitemapInfo.bibcode,
-                    (Records.bib_data.isnot(None)).label('has_bib_data'),
-                    Records.bib_data_updated,
-                    Records.solr_processed,
-                    Records.status
-                )
-                .outerjoin(Records, SitemapInfo.bibcode == Records.bibcode)
-                .filter(SitemapInfo.id > last_id)  
-                .order_by(SitemapInfo.id)          
-                .limit(batch_size)
-            )
-            
-            batch_records = batch_query.all()
-            
-            if not batch_records:
+            deleted = app.delete_invalid_sitemap_rows(session, batch_size, after_id=last_id)
+            if not deleted:
                 break
-                
-            batch_count += 1
-            total_processed += len(batch_records)
             
-            # Update last_id for next iteration
-            last_id = batch_records[-1].id
-            
-            # Check which records should be removed
-            bibcodes_to_remove = []
+            batch_count += 1
+            total_removed += len(deleted)
+            # keyset, the next batch starts after the last row deleted
+            last_id = max(row_id for row_id, _ in deleted)
             
-            for record_data in batch_records:
-                # Convert to dict for should_include_in_sitemap function
-                record_dict = {
-                    'bibcode': record_data.bibcode,
-                    'has_bib_data': record_data.has_bib_data,
-                    'bib_data_updated': record_data.bib_data_updated,
-                    'solr_processed': record_data.solr_processed,
-                    'status': record_data.status
-                }
-                
-                # Check if record should still be in sitemap
-                if not app.should_include_in_sitemap(record_dict):
-                    bibcodes_to_remove.append(record_data.bibcode)
+            affected_files = set(filename for _, filename in deleted if filename)
+            file_counts_after = dict(
+                session.query(SitemapInfo.sitemap_filename, func.count(SitemapInfo.id))
+                .filter(SitemapInfo.sitemap_filename.in_(affected_files))
+                .group_by(SitemapInfo.sitemap_filename)
+                .all()
+            ) if affected_files else {}
+            app.set_sitemap_file_counts(
+                session, {filename: file_counts_after.get(filename, 0) for filename in affected_files})
+            session.commit()
             
-            # Remove invalid records from this batch
-            if bibcodes_to_remove:
-                logger.info('Batch %d: removing %d invalid records (processed %d total)', 
-                           batch_count, len(bibcodes_to_remove), total_processed)
-                
-                # Use our existing remove action helper
-                removed_count, files_to_delete, files_to_update = app._execute_remove_action(session, bibcodes_to_remove)
-                session.commit()  # Commit database changes first
-
-                app.delete_sitemap_files(files_to_delete, app.sitemap_dir)
-                
-                total_removed += removed_count
-                all_files_to_update.update(files_to_update)
-            else:
-                logger.debug('Batch %d: no invalid records found (processed %d total)', 
-                           batch_count, total_processed)
+            files_to_delete = set(f for f in affected_files if f not in file_counts_after)
+            all_files_to_delete.update(files_to_delete)
+            all_files_to_update.update(affected_files - files_to_delete)
+            logger.info('Batch %d: removed %d invalid records from %d files (%d removed total)', 
+                       batch_count, len(deleted), len(affected_files), total_removed)
+    
+    # a file emptied in one batch can't get rows back in a later one
+    app.delete_sitemap_files(all_files_to_delete, app.sitemap_dir)
+    all_files_to_update -= all_files_to_delete
                 
-    # Synchronously flag files to regenerate (one row per file)
+    # Flag files to regenerate, one statement (one row per file)
     flagged = 0
     if all_files_to_update:
         with app.session_scope() as flag_session:
-            for filename in sorted(all_files_to_update):
-                flagged += app.flag_one_row_for_filename(flag_session, filename)
-                flag_session.commit()
+            flagged = app.flag_sitemap_files(flag_session, all_files_to_update)
+            flag_session.commit()
     
     cleanup_result = {
-        'total_processed': total_processed,
         'invalid_removed': total_removed,
         'batches_processed': batch_count,
+        'files_deleted': len(all_files_to_delete),
         'files_regenerated': total_removed > 0,
         'files_flagged': flagged
     }
@@ -582,6 +554,141 @@ def task_cleanup_invalid_sitemaps():
     logger.info('Sitemap cleanup completed: %s', cleanup_result)
     return cleanup_result
 
+def bootstrap_sitemap_range(session, start_id, end_id, first_file_index, max_records_per_sitemap, batch_size):
+    """Add the records with start_id < id <= end_id (no upper bound if end_id
+    is None) to the sitemap table, flagged for generation
+    
+    Records are read with keyset pagination and included per
+    should_include_in_sitemap; files are filled in id order starting at
+    sitemap_bib_<first_file_index>.xml. Every batch is committed with its
+    sitemap_files counters.
+    
+    :return: tuple (records processed, records added, records skipped or failed)
+    """
+    processed = 0
+    successful_count = 0
+    failed_count = 0
+    last_id = start_id
+    
+    # Pre-calculate sitemap filename assignments
+    current_file_index = first_file_index
+    records_in_current_file = 0
+    
+    while True:
+        # Use keyset pagination instead of OFFSET/LIMIT for O(1) performance
+        query = (
+            session.query(Records.id, Records.bibcode, Records.bib_data_updated, 
+                        Records.bib_data, Records.solr_processed, Records.status)
+            .filter(Records.id > last_id)
+        )
+        if end_id is not None:
+            query = query.filter(Records.id <= end_id)
+        records_batch = query.order_by(Records.id).limit(batch_size).all()
+        
+        if not records_batch:
+            break  # No more records
+        
+        # Prepare bulk insert data
+        bulk_data = []
+        file_counts = defaultdict(int)
+        for record in records_batch:
+            try:
+                # Apply SOLR filtering - convert record to dict for should_include_in_sitemap
+                record_dict = {
+                    'bibcode': record.bibcode,
+                    'has_bib_data': bool(record.bib_data),
+                    'bib_data_updated': record.bib_data_updated,
+                    'solr_processed': record.solr_processed,
+                    'status': record.status
+                }
+                
+                # Check if record should be included in sitemap based on SOLR status
+                if not app.should_include_in_sitemap(record_dict):
+                    logger.debug('Skipping %s in bootstrap: does not meet sitemap inclusion criteria', record.bibcode)
+                    failed_count += 1
+                    continue
+                
+                # Calculate sitemap filename
+                if records_in_current_file >= max_records_per_sitemap:
+                    current_file_index += 1
+                    records_in_current_file = 0
+                
+                sitemap_filename = f'sitemap_bib_{current_file_index}.xml'
+                records_in_current_file += 1
+                file_counts[sitemap_filename] += 1
+                
+                # Create bulk insert record
+                bulk_data.append({
+                    'record_id': record.id,
+                    'bibcode': record.bibcode,
+                    'bib_data_updated': record.bib_data_updated,
+                    'scix_id': None,
+                    'sitemap_filename': sitemap_filename,
+                    'filename_lastmoddate': None,
+                    'update_flag': True
+                })
+                successful_count += 1
+                
+            except Exception as e:
+                logger.error('Failed to prepare record %s: %s', record.bibcode, str(e))
+                failed_count += 1
+                continue
+        
+        # Bulk insert the entire batch 
+        if bulk_data:
+            try:
+                insert_sitemap = insert(SitemapInfo)
+                session.execute(insert_sitemap, bulk_data)
+                # Per file counters go in the same transaction
+                app.adjust_sitemap_file_counts(session, file_counts)
+                session.commit()
+                logger.debug('Bulk inserted %d records', len(bulk_data))
+            except Exception as e:
+                logger.error('Bulk insert failed for batch: %s', str(e))
+                session.rollback()
+                failed_count += len(bulk_data)
+                successful_count -= len(bulk_data)
+        
+        # Update last_id for next iteration
+        last_id = records_batch[-1].id
+        processed += len(records_batch)
+        
+        # Log progress
+        if processed % (batch_size * 5) == 0:  # Log every 5 batches
+            logger.info('Bootstrapped %d records - %d successful, %d failed', 
+                      processed, successful_count, failed_count)
+    
+    return processed, successful_count, failed_count
+
+@app.task(queue='manage-sitemap')
+def task_bootstrap_sitemap_range(start_id, end_id, first_file_index, run_id=None):
+    """Bootstrap the sitemap rows of one records.id range (parallel-bootstrap)
+    
+    Each range has its own block of filenames starting at first_file_index,
+    so concurrent ranges never share a file or a counter. With run_id the
+    range counts itself off the run when it succeeds and the last one
+    submits task_update_sitemap_files; a failed range is recorded on the run
+    instead, so the files are not generated from a partial bootstrap.
+    """
+    try:
+        with app.session_scope() as session:
+            processed, successful_count, failed_count = bootstrap_sitemap_range(
+                session, start_id, end_id, first_file_index,
+                app.conf.get('MAX_RECORDS_PER_SITEMAP', 10000),
+                app.conf.get('SITEMAP_BOOTSTRAP_BATCH_SIZE', 50000))
+    except Exception as e:
+        logger.error('Failed to bootstrap ids %s-%s: %s', start_id + 1, end_id, str(e))
+        if run_id is not None:
+            app.fail_sitemap_run_file(run_id)
+            logger.error('Bootstrap run %s left unfinished, sitemap files are not generated', run_id)
+        raise
+    logger.info('Bootstrapped ids %s-%s: %d successful, %d failed out of %d records', 
+                start_id + 1, end_id, successful_count, failed_count, processed)
+    if run_id is not None and app.finish_sitemap_run_file(run_id):
+        task_update_sitemap_files.apply_async()
+        logger.info('Last bootstrap range of run %s done, sitemap files update submitted', run_id)
+    return successful_count
+
 @app.task(queue='manage-sitemap') 
 def task_manage_sitemap(bibcodes, action):
     """
@@ -593,6 +700,10 @@ def task_manage_sitemap(bibcodes, action):
     - 'remove': remove bibcodes from sitemap table (TODO: not implemented)
     - 'delete-table': delete all contents of sitemap table and backup files
     - 'update-robots': force update robots.txt files for all sites
+    - 'bootstrap': populate the sitemap table from all records, in this task
+    - 'parallel-bootstrap': same, split into records.id ranges run as
+      independent tasks; the last one submits task_update_sitemap_files
+    - 'compact': merge sparse sitemap files (below SITEMAP_COMPACTION_FILL_FACTOR)
     """
 
     sitemap_dir = app.sitemap_dir
@@ -605,8 +716,10 @@ def task_manage_sitemap(bibcodes, action):
     if action == 'delete-table':
         # reset and empty all entries in sitemap table
         app.delete_contents(SitemapInfo)
+        app.delete_contents(SitemapFile)
+        app.delete_contents(SitemapFileSite)
 
-        # move all sitemap files to a backup directory
+        # swap the sitemap directory to an empty generation, the old files are kept aside
         app.backup_sitemap_files(sitemap_dir)
         return
 
@@ -638,17 +751,35 @@ def task_manage_sitemap(bibcodes, action):
         # Delete all empty files after all batches are processed
         app.delete_sitemap_files(all_files_to_delete, sitemap_dir)
         
-        # Synchronously flag files to regenerate (one row per file)
-        flagged = 0
+        # Flag files to regenerate, one statement (one row per file)
         with app.session_scope() as flag_session:
-            for filename in sorted(all_files_to_update):
-                flagged += app.flag_one_row_for_filename(flag_session, filename)
-                flag_session.commit()
+            flagged = app.flag_sitemap_files(flag_session, all_files_to_update)
+            flag_session.commit()
 
         logger.info('Remove operation completed: %d total bibcodes removed, %d empty files deleted, %d files flagged', 
                     total_removed, len(all_files_to_delete), flagged)
         return
 
+    elif action == 'compact':
+        fill_factor = app.conf.get('SITEMAP_COMPACTION_FILL_FACTOR', 0.75)
+        logger.info('Compacting sitemap files below %d%% full', int(fill_factor * 100))
+        
+        with app.session_scope() as session:
+            moved_count, files_to_delete, files_to_update = app.compact_sitemap_files(session, fill_factor)
+            session.commit()
+        
+        # The emptied files are gone from the table, drop them from disk too
+        app.delete_sitemap_files(files_to_delete, sitemap_dir)
+        
+        # Only the files that received rows are regenerated
+        with app.session_scope() as flag_session:
+            flagged = app.flag_sitemap_files(flag_session, files_to_update)
+            flag_session.commit()
+        
+        logger.info('Compaction completed: %d rows moved, %d files deleted, %d files flagged', 
+                    moved_count, len(files_to_delete), flagged)
+        return
+    
     elif action == 'update-robots':
         logger.info('Force updating robots.txt files for all sites')
         success = update_robots_files(True)
@@ -671,104 +802,51 @@ def task_manage_sitemap(bibcodes, action):
                 return
             
             max_records_per_sitemap = app.conf.get('MAX_RECORDS_PER_SITEMAP', 10000)
-            processed = 0
-            successful_count = 0
-            failed_count = 0
-            last_id = 0
-            
-            # Pre-calculate sitemap filename assignments
-            current_file_index = 1
-            records_in_current_file = 0
-            
             logger.info('Processing records in bulk batches of %d...', batch_size)
             logger.info('Max records per sitemap file: %d', max_records_per_sitemap)
             logger.info('Using keyset pagination for efficient processing of large datasets')
             
-            while True:
-                # Use keyset pagination instead of OFFSET/LIMIT for O(1) performance
-                records_batch = (
-                    session.query(Records.id, Records.bibcode, Records.bib_data_updated, 
-                                Records.bib_data, Records.solr_processed, Records.status)
-                    .filter(Records.id > last_id)
-                    .order_by(Records.id)
-                    .limit(batch_size)
-                    .all()
-                )
-                
-                if not records_batch:
-                    break  # No more records
-                
-                # Prepare bulk insert data
-                bulk_data = []
-                for record in records_batch:
-                    try:
-                        # Apply SOLR filtering - convert record to dict for should_include_in_sitemap
-                        record_dict = {
-                            'bibcode': record.bibcode,
-                            'has_bib_data': bool(record.bib_data),
-                            'bib_data_updated': record.bib_data_updated,
-                            'solr_processed': record.solr_processed,
-                            'status': record.status
-                        }
-                        
-                        # Check if record should be included in sitemap based on SOLR status
-                        if not app.should_include_in_sitemap(record_dict):
-                            logger.debug('Skipping %s in bootstrap: does not meet sitemap inclusion criteria', record.bibcode)
-                            failed_count += 1
-                            continue
-                        
-                        # Calculate sitemap filename
-                        if records_in_current_file >= max_records_per_sitemap:
-                            current_file_index += 1
-                            records_in_current_file = 0
-                        
-                        sitemap_filename = f'sitemap_bib_{current_file_index}.xml'
-                        records_in_current_file += 1
-                        
-                        # Create bulk insert record
-                        bulk_data.append({
-                            'record_id': record.id,
-                            'bibcode': record.bibcode,
-                            'bib_data_updated': record.bib_data_updated,
-                            'scix_id': None,
-                            'sitemap_filename': sitemap_filename,
-                            'filename_lastmoddate': None,
-                            'update_flag': True
-                        })
-                        successful_count += 1
-                        
-                    except Exception as e:
-                        logger.error('Failed to prepare record %s: %s', record.bibcode, str(e))
-                        failed_count += 1
-                        continue
-                
-                # Bulk insert the entire batch 
-                if bulk_data:
-                    try:
-                        insert_sitemap = insert(SitemapInfo)
-                        session.execute(insert_sitemap, bulk_data)
-                        session.commit()
-                        logger.debug('Bulk inserted %d records', len(bulk_data))
-                    except Exception as e:
-                        logger.error('Bulk insert failed for batch: %s', str(e))
-                        session.rollback()
-                        failed_count += len(bulk_data)
-                        successful_count -= len(bulk_data)
-                
-                # Update last_id for next iteration
-                last_id = records_batch[-1].id
-                processed += len(records_batch)
-                
-                # Log progress
-                if processed % (batch_size * 5) == 0 or not records_batch:  # Log every 5 batches
-                    logger.info('Bootstrapped %d records - %d successful, %d failed', 
-                              processed, successful_count, failed_count)
+            processed, successful_count, failed_count = bootstrap_sitemap_range(
+                session, 0, None, 1, max_records_per_sitemap, batch_size)
             
             logger.info('Bootstrap completed: %d successful, %d failed out of %d total records', 
                        successful_count, failed_count, processed)
             logger.info('All records marked with update_flag=True')
         return
     
+    elif action == 'parallel-bootstrap':
+        logger.info('Bootstrapping sitemaps for all existing records in parallel id ranges...')
+        
+        with app.session_scope() as session:
+            existing_sitemap_count = session.query(SitemapInfo).count()
+            if existing_sitemap_count > 0:
+                logger.warning(f'SitemapInfo table already has {existing_sitemap_count} records')
+                logger.warning('Use "force-update" action if you want to update existing sitemap records')
+                return
+            min_id, max_id = session.query(func.min(Records.id), func.max(Records.id)).one()
+        
+        if max_id is None:
+            logger.info('No records to bootstrap')
+            return
+        
+        # A range spans as many ids as its block of files can hold, so it
+        # never runs out of filenames whatever the inclusion rate
+        max_records_per_sitemap = app.conf.get('MAX_RECORDS_PER_SITEMAP', 10000)
+        files_per_range = app.conf.get('SITEMAP_BOOTSTRAP_FILES_PER_RANGE', 20)
+        range_size = files_per_range * max_records_per_sitemap
+        ranges = []
+        range_start = min_id - 1
+        while range_start < max_id:
+            ranges.append((range_start, range_start + range_size, len(ranges) * files_per_range + 1))
+            range_start += range_size
+        
+        run_id = app.start_sitemap_run(len(ranges))
+        for range_start, range_end, first_file_index in ranges:
+            task_bootstrap_sitemap_range.apply_async(
+                args=(range_start, range_end, first_file_index), kwargs={'run_id': run_id})
+        logger.info('Submitted %d bootstrap ranges of %d ids (run %s)', len(ranges), range_size, run_id)
+        return
+    
     elif action in ['add', 'force-update']:
         overall_successful_count = 0
         overall_failed_count = 0
@@ -813,6 +891,43 @@ def task_manage_sitemap(bibcodes, action):
         logger.debug('Records breakdown: %d new, %d updated (total: %d)', 
                     overall_new_count, overall_updated_count, len(all_sitemap_records))
 
+@app.task(queue='manage-sitemap')
+def task_update_sitemaps_auto(cutoff, started=None):
+    """Add the records changed since cutoff (isoformat) to the sitemaps
+
+    The bibcodes (see app.sitemap_auto_changes) are read in pages of
+    SITEMAP_AUTO_CHUNK_SIZE, each a fresh query after the last bibcode of the
+    previous one, and added one chunk after the other in this task: adds must
+    not run concurrently, and neither the message nor the worker ever holds
+    more than the cutoff and one chunk.
+
+    started (isoformat), the time the run was started, becomes the watermark
+    of the next --update-sitemaps-auto run once the last chunk is added; if
+    the task fails the watermark stays and the next run looks at the same
+    records again.
+
+    Returns the number of bibcodes added.
+    """
+    cutoff_date = adsputils.get_date(cutoff)
+    chunk_size = app.conf.get('SITEMAP_AUTO_CHUNK_SIZE', 10000)
+    total = 0
+    last_bibcode = None
+    while True:
+        with app.session_scope() as session:
+            chunk = [r.bibcode for r in
+                     app.sitemap_auto_changes(session, cutoff_date, after_bibcode=last_bibcode).limit(chunk_size)]
+        if not chunk:
+            break
+        task_manage_sitemap(chunk, 'add')
+        total += len(chunk)
+        last_bibcode = chunk[-1]
+        logger.info('Added %d records changed since %s to the sitemaps', total, cutoff)
+        if len(chunk) < chunk_size:
+            break
+    if started is not None:
+        app.set_sitemap_auto_watermark(adsputils.get_date(started))
+    return total
+
 # TODO: Need to query github to find when above dirs are updated: https://docs.github.com/en/rest?apiVersion=2022-11-28
 # TODO: Need to generate an API token from ADStailor (maybe)
 def update_robots_files(force_update=False):
@@ -874,7 +989,13 @@ def update_robots_files(force_update=False):
         return False
 
 def update_sitemap_index():
-    """Generate sitemap index files for all configured sites"""
+    """Generate sitemap index files for all configured sites
+    
+    The index is built from the database alone: the files that have records
+    (sitemap_files) and, per site, the name and time of what was last written
+    (sitemap_file_sites). Files written before sitemap_file_sites was kept
+    are looked up on disk once and recorded.
+    """
     
     try:
         # Get sites configuration
@@ -887,20 +1008,33 @@ def update_sitemap_index():
         updated_sites = 0
         
         with app.session_scope() as session:
-            # Get all distinct sitemap filenames that actually have records in database
-            sitemap_files = (
-                session.query(SitemapInfo.sitemap_filename.distinct())
-                .filter(SitemapInfo.sitemap_filename.isnot(None))
-                .all()
-            )
+            if session.query(SitemapFile.filename).first() is None:
+                # sitemap rows written before sitemap_files was maintained
+                app.refresh_sitemap_files(session)
+                session.commit()
             
-            # Flatten the list of tuples into a list of strings
-            sitemap_filenames = [filename[0] for filename in sitemap_files] if sitemap_files else []
+            # All sitemap files that actually have records in database
+            sitemap_filenames = [
+                filename for (filename,) in
+                session.query(SitemapFile.filename)
+                .filter(SitemapFile.record_count > 0)
+                .order_by(SitemapFile.file_index, SitemapFile.filename)
+            ]
             
             if not sitemap_filenames:
                 logger.info('No sitemap files found in database - generating empty index files')
                 # Still need to generate empty index files to clear old entries
             
+            # site -> filename -> (output filename, generation time)
+            outputs = defaultdict(dict)
+            for output in (
+                session.query(SitemapFileSite.site, SitemapFileSite.filename,
+                              SitemapFileSite.output_filename, SitemapFileSite.generated)
+                .join(SitemapFile, SitemapFile.filename == SitemapFileSite.filename)
+                .filter(SitemapFile.record_count > 0)
+            ):
+                outputs[output.site][output.filename] = (output.output_filename, output.generated)
+            
             for site_key, site_config in sites_config.items():
                 try:
                     # Create site-specific directory if it doesn't exist
@@ -927,17 +1061,20 @@ def update_sitemap_index():
                         sitemap_entries.append(entry)
                         logger.info('Added static sitemap to index for %s', site_key)
                     
+                    site_outputs = outputs[site_key]
                     for filename in sitemap_filenames:
-                        # Check if the actual sitemap file exists for this site
-                        sitemap_filepath = os.path.join(site_output_dir, filename)
-                        if os.path.exists(sitemap_filepath):
-                            # Get file modification time
-                            mtime = os.path.getmtime(sitemap_filepath)
-                            lastmod_date = time.strftime('%Y-%m-%d', time.gmtime(mtime))
-                            
-                            # Create sitemap entry using proper sitemap base URL
-                            entry = templates.format_sitemap_entry(sitemap_base_url, filename, lastmod_date)
-                            sitemap_entries.append(entry)
+                        output = site_outputs.get(filename)
+                        if output is None:
+                            output = _record_existing_sitemap_output(session, site_output_dir, site_key, filename)
+                            if output is None:
+                                # never written for this site
+                                continue
+                        output_filename, generated = output
+                        lastmod_date = generated.strftime('%Y-%m-%d') if generated else time.strftime('%Y-%m-%d', time.gmtime())
+                        
+                        # Create sitemap entry using proper sitemap base URL
+                        entry = templates.format_sitemap_entry(sitemap_base_url, output_filename, lastmod_date)
+                        sitemap_entries.append(entry)
                     
                     # Always generate sitemap index content, even if empty
                     index_content = templates.render_sitemap_index(''.join(sitemap_entries))
@@ -958,6 +1095,9 @@ def update_sitemap_index():
                 except Exception as e:
                     logger.error('Failed to generate sitemap index for site %s: %s', site_key, str(e))
                     continue
+            
+            # keep what was found on disk
+            session.commit()
         
         logger.info('Sitemap index generation completed: %d sites updated', updated_sites)
         return True
@@ -965,12 +1105,144 @@ def update_sitemap_index():
     except Exception as e:
         logger.error('Failed to generate sitemap index files: %s', str(e))
         return False
- 
+
+def _record_existing_sitemap_output(session, site_output_dir, site_key, filename):
+    """Look up a sitemap file written before sitemap_file_sites was kept and
+    record it, so the disk is only checked once per file and site
+    
+    Returns (output filename, modification time) or None if not on disk.
+    """
+    output_filename = app.sitemap_output_filename(filename)
+    sitemap_filepath = os.path.join(site_output_dir, output_filename)
+    if not os.path.exists(sitemap_filepath):
+        return None
+    generated = datetime.fromtimestamp(os.path.getmtime(sitemap_filepath), tz=timezone.utc)
+    session.add(SitemapFileSite(filename=filename, site=site_key, output_filename=output_filename,
+                                generated=generated, byte_size=os.path.getsize(sitemap_filepath)))
+    return output_filename, generated
+
+def write_sitemap_files(sitemap_filename, file_records, sites_config, previous=None):
+    """Write sitemap_filename for every site from a single pass over file_records
+
+    Each record is escaped and its lastmod formatted once, then its entry is
+    written to every site file (the sites only differ in abs_url_pattern). A
+    site that fails is discarded, the others carry on.
+
+    Files go to a temporary name and are renamed into place, unless the
+    content hash matches what was last published for the site (previous,
+    dict site key -> (output filename, content hash)), then the old file is
+    left untouched.
+
+    Returns a dict site key -> closed writer (path, count, size, hash and
+    whether it was published) for the sites done successfully.
+    """
+    previous = previous or {}
+    sitemap_dir = app.sitemap_dir
+    # Ex: sitemap_bib_1.xml, or sitemap_bib_1.xml.gz with SITEMAP_GZIP
+    output_filename = app.sitemap_output_filename(sitemap_filename)
+    compress = output_filename != sitemap_filename
+    stale_filename = sitemap_filename if compress else sitemap_filename + '.gz'
+
+    # site_key -> (writer, url entry formatter for the site's abs_url_pattern)
+    writers = {}
+    for site_key, site_config in sites_config.items():
+        try:
+            # Create site-specific directory only if it doesn't exist
+            # Ex: /app/logs/sitemap/ads/ or /app/logs/sitemap/scix/
+            site_output_dir = os.path.join(sitemap_dir, site_key)
+            if not os.path.exists(site_output_dir):
+                os.makedirs(site_output_dir)
+            # Ex: https://ui.adsabs.harvard.edu/abs/{bibcode}
+            abs_url_pattern = site_config.get('abs_url_pattern', 'https://ui.adsabs.harvard.edu/abs/{bibcode}')
+            # Ex: /app/logs/sitemap/ads/sitemap_bib_1.xml or /app/logs/sitemap/scix/sitemap_bib_1.xml
+            writer = templates.SitemapFileWriter(os.path.join(site_output_dir, output_filename), compress=compress)
+            writers[site_key] = (writer.open(), templates.url_entry_formatter(abs_url_pattern))
+        except Exception as e:
+            logger.error('Failed to generate sitemap file %s for site %s: %s', 
+                       sitemap_filename, site_key, str(e))
+
+    today = None
+    for info in file_records:
+        # Grab the lastmod date from the bib_data_updated field, if present
+        if info.bib_data_updated:
+            lastmod_date = info.bib_data_updated.date().isoformat()
+        else:
+            today = today or adsputils.get_date().date().isoformat()
+            lastmod_date = today
+        escaped_bibcode = html.escape(info.bibcode)
+        # Ex: <url><loc>https://ui.adsabs.harvard.edu/abs/2023ApJ...123..456A/abstract</loc><lastmod>2023-01-01</lastmod></url>
+        for site_key in list(writers):
+            writer, format_entry = writers[site_key]
+            try:
+                writer.write(format_entry(escaped_bibcode, lastmod_date))
+            except Exception as e:
+                logger.error('Failed to generate sitemap file %s for site %s: %s', 
+                           sitemap_filename, site_key, str(e))
+                del writers[site_key]
+                writer.discard()
+
+    successful_sites = {}
+    for site_key, (writer, _) in writers.items():
+        try:
+            writer.close()
+            if previous.get(site_key) == (output_filename, writer.content_hash) and os.path.exists(writer.path):
+                writer.discard()
+                logger.debug('Sitemap %s for site %s unchanged, not published', writer.path, site_key)
+            else:
+                writer.publish()
+                # Drop the copy in the other format, if SITEMAP_GZIP was switched
+                stale_filepath = os.path.join(sitemap_dir, site_key, stale_filename)
+                if os.path.exists(stale_filepath):
+                    os.remove(stale_filepath)
+                logger.debug('Successfully generated %s for site %s with %d records', 
+                           writer.path, sites_config[site_key].get('name', site_key), writer.count)
+            successful_sites[site_key] = writer
+        except Exception as e:
+            writer.discard()
+            logger.error('Failed to generate sitemap file %s for site %s: %s', 
+                       sitemap_filename, site_key, str(e))
+    return successful_sites
+
 @app.task(queue='generate-single-sitemap')
-def task_generate_single_sitemap(sitemap_filename, record_ids):
-    """Worker task: Generate a single sitemap file for all configured sites given record ids"""
+def task_generate_single_sitemap(sitemap_filename, record_ids=None, run_id=None):
+    """Worker task: Generate a single sitemap file for all configured sites
     
-    logger.info('Generating sitemap file: %s (%d records)', sitemap_filename, len(record_ids))
+    The rows of the file are streamed from the sitemap table in id order
+    (using the sitemap_filename index), nothing but the filename needs to be
+    sent with the task. record_ids, if given, restricts the file to those rows.
+    
+    With run_id the task counts itself off the run when it succeeds, the
+    last file of the run submits the index generation. A failure is recorded
+    on the run, which then doesn't finish: the index is not regenerated
+    until task_update_sitemap_files closes the run as stale.
+    
+    Returns False on failure, otherwise a dict with the number of site files
+    'written' and 'skipped' (content unchanged).
+    """
+    result = False
+    try:
+        result = generate_sitemap_file(sitemap_filename, record_ids)
+        return result
+    finally:
+        if run_id is not None:
+            try:
+                if not result:
+                    app.fail_sitemap_run_file(run_id)
+                    logger.error('Sitemap file %s of run %s failed, the run is left unfinished',
+                                 sitemap_filename, run_id)
+                elif app.finish_sitemap_run_file(run_id, written=result['written'],
+                                                 skipped=result['skipped']):
+                    task_generate_sitemap_index.apply_async()
+                    logger.info('Last sitemap file of run %s done, index generation submitted: %s',
+                                run_id, app.get_sitemap_run(run_id))
+            except Exception as e:
+                logger.error('Failed to update sitemap run %s: %s', run_id, str(e))
+
+
+def generate_sitemap_file(sitemap_filename, record_ids=None):
+    """Write sitemap_filename for all sites, see task_generate_single_sitemap"""
+    
+    logger.info('Generating sitemap file: %s', sitemap_filename)
     
     try:
         # Get sites configuration
@@ -979,73 +1251,59 @@ def task_generate_single_sitemap(sitemap_filename, record_ids):
             logger.error('No SITES configuration found')
             return False
             
-        sitemap_dir = app.sitemap_dir
-        
         with app.session_scope() as session:
-            # Get all records for this specific file
-            file_records = (
-                session.query(SitemapInfo)
-                .filter(SitemapInfo.id.in_(record_ids))
-                .all()
+            file_query = (
+                session.query(SitemapInfo.id, SitemapInfo.bibcode, SitemapInfo.bib_data_updated)
+                .filter(SitemapInfo.sitemap_filename == sitemap_filename)
             )
+            if record_ids is not None:
+                file_query = file_query.filter(SitemapInfo.id.in_(record_ids))
             
-            if not file_records:
+            if file_query.first() is None:
                 logger.warning('No records found for sitemap file %s', sitemap_filename)
                 return False
             
-            # Generate file for each configured site
-            successful_sites = 0
-            for site_key, site_config in sites_config.items():
-                try:
-                    # Create site-specific directory only if it doesn't exist
-                    # Ex: /app/logs/sitemap/ads/ or /app/logs/sitemap/scix/
-                    site_output_dir = os.path.join(sitemap_dir, site_key) 
-                    if not os.path.exists(site_output_dir):
-                        os.makedirs(site_output_dir)
-                    
-                    # Ex: /app/logs/sitemap/ads/sitemap_bib_1.xml or /app/logs/sitemap/scix/sitemap_bib_1.xml
-                    site_filepath = os.path.join(site_output_dir, sitemap_filename)
-                    
-                    # Ex: https://ui.adsabs.harvard.edu/abs/{bibcode}
-                    # Get site-specific URL pattern
-                    abs_url_pattern = site_config.get('abs_url_pattern', 'https://ui.adsabs.harvard.edu/abs/{bibcode}')
-                    
-                    url_entries = []
-                    for info in file_records:
-                        # Grab the lastmod date from the bib_data_updated field, if present
-                        lastmod_date = info.bib_data_updated.date() if info.bib_data_updated else adsputils.get_date().date()
-                        # Use site-specific URL pattern
-                        # Ex: https://ui.adsabs.harvard.edu/abs/2023ApJ...123..456A/abstract
-                        url_entry = templates.format_url_entry(info.bibcode, lastmod_date, abs_url_pattern)
-                        url_entries.append(url_entry)
-                    
-                    # Write the site-specific XML file
-                    # Ex: <url><loc>https://ui.adsabs.harvard.edu/abs/2023ApJ...123..456A/abstract</loc><lastmod>2023-01-01</lastmod></url>
-                    sitemap_content = templates.render_sitemap_file(''.join(url_entries))
-                    with open(site_filepath, 'w', encoding='utf-8') as file:
-                        file.write(sitemap_content)
-                
-                    
-                    logger.debug('Successfully generated %s for site %s with %d records', 
-                               site_filepath, site_config.get('name', site_key), len(url_entries))
-                    successful_sites += 1
-                    
-                except Exception as e:
-                    logger.error('Failed to generate sitemap file %s for site %s: %s', 
-                               sitemap_filename, site_key, str(e))
-                    continue
+            streamed = {'count': 0, 'last_id': None}
+            
+            def stream_rows():
+                for row in file_query.order_by(SitemapInfo.id).yield_per(app.conf.get('SITEMAP_STREAM_BATCH_SIZE', 5000)):
+                    streamed['count'] += 1
+                    streamed['last_id'] = row.id
+                    yield row
+            
+            # Generate the file for all configured sites in one pass
+            previous = app.get_sitemap_file_outputs(session, sitemap_filename)
+            successful_sites = write_sitemap_files(sitemap_filename, stream_rows(), sites_config, previous)
             
             # Update database records only after all sites are processed successfully
-            if successful_sites > 0:
-                for info in file_records:
-                    # Filename lastmoddate is updated to current date and time
-                    info.filename_lastmoddate = adsputils.get_date()
-                    info.update_flag = False
+            if successful_sites:
+                # Rows added to the file after the stream started have higher ids
+                # and keep their flag for the next run
+                written = (
+                    session.query(SitemapInfo)
+                    .filter(SitemapInfo.sitemap_filename == sitemap_filename,
+                            SitemapInfo.id <= streamed['last_id'])
+                )
+                if record_ids is not None:
+                    written = written.filter(SitemapInfo.id.in_(record_ids))
+                # Filename lastmoddate is updated to current date and time
+                written.update({SitemapInfo.filename_lastmoddate: adsputils.get_date(),
+                                SitemapInfo.update_flag: False}, synchronize_session=False)
+                published = {site_key: writer for site_key, writer in successful_sites.items() if writer.published}
+                result = {'written': len(published), 'skipped': len(successful_sites) - len(published)}
+                if published:
+                    # one hash for the file over all its sites
+                    file_hash = hashlib.sha256(''.join(
+                        '%s:%s\n' % (site_key, successful_sites[site_key].content_hash)
+                        for site_key in sorted(successful_sites)).encode('utf-8')).hexdigest()
+                    app.mark_sitemap_file_generated(session, sitemap_filename, outputs={
+                        site_key: (os.path.basename(writer.path), writer.size, writer.content_hash)
+                        for site_key, writer in published.items()}, content_hash=file_hash)
                 
                 session.commit()
-                logger.info('Completed sitemap file: %s (%d records, %d sites)', 
-                           sitemap_filename, len(file_records), successful_sites)
-                return True
+                logger.info('Completed sitemap file: %s (%d records, %d sites written, %d unchanged)', 
+                           sitemap_filename, streamed['count'], result['written'], result['skipped'])
+                return result
             else:
                 logger.error('Failed to generate %s for any sites', sitemap_filename)
                 return False
@@ -1054,63 +1312,51 @@ def task_generate_single_sitemap(sitemap_filename, record_ids):
         logger.error('Failed to generate sitemap file %s: %s', sitemap_filename, str(e))
         return False
 
-@app.task(queue='update-sitemap-files', bind=True)
-def task_generate_sitemap_index(self, retry_count=0):
-    """Generate sitemap index files after individual sitemap files are complete
+@app.task(queue='update-sitemap-files')
+def task_generate_sitemap_index():
+    """Generate sitemap index files
     
-    This task will automatically retry if there are still pending file generation tasks,
-    waiting for all files to be complete before generating the index.
-    
-    Uses progressive backoff: starts with 10s delays, increases to 30s after 20 retries,
-    then 60s after 50 retries. Can handle up to 100 retries (~90 minutes total wait time).
+    Submitted by the last sitemap file task of a run of
+    task_update_sitemap_files, so the index is built once, right after all
+    files are written. With SITEMAP_S3_SYNC_ENABLED the upload of the
+    changed files is submitted once the index is written.
     """
-    # Override the default max_retries from config
-    max_retries = app.conf.get('SITEMAP_INDEX_MAX_RETRIES', 100)
-    self.max_retries = max_retries
+    logger.info('Generating sitemap index files')
+    success = update_sitemap_index()
     
-    try:
-        logger.info('Generating sitemap index files (attempt %d/%d)', retry_count + 1, max_retries)
-        
-        with app.session_scope() as session:
-            pending_count = session.query(SitemapInfo).filter(SitemapInfo.update_flag == True).count()
-            
-            if pending_count > 0:
-                if retry_count >= max_retries - 1:
-                    logger.warning('Reached max retries (%d) with %d records still pending - generating index anyway', 
-                                  max_retries, pending_count)
-                    # Fall through to generate index with whatever files are complete
-                else:
-                    if retry_count < 20:
-                        retry_delay = 10  # First 20 retries: 10s each (3m 20s)
-                    elif retry_count < 50:
-                        retry_delay = 30  # Next 30 retries: 30s each (15m)
-                    else:
-                        retry_delay = 60  # Remaining retries: 60s each (50m)
-                    
-                    logger.info('Found %d records still pending file generation - will retry in %ds (attempt %d/%d)', 
-                               pending_count, retry_delay, retry_count + 1, max_retries)
-                    raise self.retry(countdown=retry_delay, kwargs={'retry_count': retry_count + 1})
-        
-        success = update_sitemap_index()
-        
-        if success:
-            logger.info('Sitemap index generation completed successfully')
-        else:
-            logger.error('Sitemap index generation failed')
-            
-        return success
+    if success:
+        logger.info('Sitemap index generation completed successfully')
+        if app.conf.get('SITEMAP_S3_SYNC_ENABLED', False):
+            task_sync_sitemaps.apply_async()
+    else:
+        logger.error('Sitemap index generation failed')
         
-    except Retry:
-        # Re-raise Retry exceptions without logging as errors
-        raise
-    except Exception as e:
-        logger.error('Error in sitemap index generation task: %s', str(e))
-        raise
+    return success
+
+@app.task(queue='sync-sitemaps')
+def task_sync_sitemaps():
+    """Upload the sitemap files that changed since the last sync to
+    SITEMAP_S3_BUCKET and delete the objects of removed files, see
+    sitemap_sync.sync_sitemaps
+    """
+    backend = sitemap_sync.backend_from_config(app.conf)
+    result = sitemap_sync.sync_sitemaps(
+        app, backend, app.sitemap_dir, list(app.conf.get('SITES', {})),
+        concurrency=app.conf.get('SITEMAP_S3_SYNC_CONCURRENCY', sitemap_sync.CONCURRENCY),
+        multipart_threshold=app.conf.get('SITEMAP_S3_MULTIPART_THRESHOLD', sitemap_sync.MULTIPART_THRESHOLD),
+        part_size=app.conf.get('SITEMAP_S3_MULTIPART_PART_SIZE', sitemap_sync.PART_SIZE))
+    if result['failed']:
+        logger.error('Sitemap sync: %d files failed to upload: %s', len(result['failed']), result['failed'])
+    logger.info('Sitemap sync done: %s', result)
+    return result
 
 @app.task(queue='update-sitemap-files') 
 def task_update_sitemap_files(previous_result=None):
     """Orchestrator task: Updates robots.txt first, then spawns parallel tasks for each sitemap file
     
+    Runs left unfinished for SITEMAP_RUN_TIMEOUT_MINUTES (a file task failed
+    or was lost) are closed and the index is regenerated for them.
+    
     Args:
         previous_result: Result from previous task in chain (ignored, but required for chaining)
     """
@@ -1118,6 +1364,10 @@ def task_update_sitemap_files(previous_result=None):
     try:
         logger.info('Starting sitemap workflow')
         
+        stale_runs = app.expire_sitemap_runs(app.conf.get('SITEMAP_RUN_TIMEOUT_MINUTES', 24 * 60))
+        if stale_runs:
+            logger.warning('Closed unfinished sitemap runs %s', stale_runs)
+        
         # Step 1: Update robots.txt files (only if necessary)
         logger.info('Updating robots.txt files...')
         success = update_robots_files(True)  # Simple direct call
@@ -1128,55 +1378,46 @@ def task_update_sitemap_files(previous_result=None):
         # Step 2: Generate sitemap files
         logger.info('Starting sitemap file generation')
         
-        # Find distinct sitemap files that need updating
+        # Find distinct sitemap files that need updating, the workers read their rows
         with app.session_scope() as session:
-            files_needing_update_subquery = (
-                session.query(SitemapInfo.sitemap_filename.distinct())
+            filenames = [
+                filename for (filename,) in
+                session.query(SitemapInfo.sitemap_filename)
                 .filter(SitemapInfo.update_flag == True)
-            )
-            # Get all records for all the sitemap files above (even if they do not need updating)
-            all_records = (
-                session.query(SitemapInfo)
-                .filter(SitemapInfo.sitemap_filename.in_(files_needing_update_subquery))
-                .all()
-            )
-            
-            if not all_records:
-                logger.info('No sitemap files need updating')
-                # Still regenerate index to reflect current database state (in case files were removed)
-                logger.info('Regenerating sitemap index to reflect current database state')
-                success = update_sitemap_index()
-                if success:
-                    logger.info('Sitemap index regeneration completed')
-                else:
-                    logger.error('Sitemap index regeneration failed')
-                return
-            
-            logger.info('Found %d records to process in sitemap files', len(all_records))
-            
-            # Group records by filename. Ex: {'sitemap_bib_1.xml': [1, 2, 3], 'sitemap_bib_2.xml': [4, 5, 6]}
-            files_dict = defaultdict(list)
-            for record in all_records:
-                files_dict[record.sitemap_filename].append(record.id)  
+                .filter(SitemapInfo.sitemap_filename.isnot(None))
+                .distinct()
+                .order_by(SitemapInfo.sitemap_filename)
+            ]
+        
+        if not filenames:
+            logger.info('No sitemap files need updating')
+            # Still regenerate index to reflect current database state (in case files were removed)
+            logger.info('Regenerating sitemap index to reflect current database state')
+            success = update_sitemap_index()
+            if success:
+                logger.info('Sitemap index regeneration completed')
+            else:
+                logger.error('Sitemap index regeneration failed')
+            return
         
         # Spawn parallel Celery tasks - one per file
-        logger.info('Starting file generation for %d sitemap files (%d total records)', len(files_dict), len(all_records))
+        # The run counts the file tasks down, the last one to finish submits
+        # task_generate_sitemap_index
+        run_id = app.start_sitemap_run(len(filenames))
+        logger.info('Starting file generation for %d sitemap files (run %s)', len(filenames), run_id)
 
-        tasks = []
-
-        for sitemap_filename, record_ids in files_dict.items():
+        for sitemap_filename in filenames:
             # Spawn each task independently
-            task_generate_single_sitemap.apply_async(args=(sitemap_filename, record_ids))
-            logger.debug('Spawned task for %s with %d records', sitemap_filename, len(record_ids))
-        
-        # Trigger index generation immediately
-        # The index task will automatically retry if files aren't ready yet
-        if files_dict:
-            task_generate_sitemap_index.apply_async()
-            logger.info('Index generation task submitted (will wait for files to complete)')
+            task_generate_single_sitemap.apply_async(args=(sitemap_filename,), kwargs={'run_id': run_id})
+            logger.debug('Spawned task for %s', sitemap_filename)
         
         logger.info('Sitemap file generation tasks submitted')
         
+        if stale_runs:
+            # the new run may fail as well, don't wait for it
+            task_generate_sitemap_index.apply_async()
+            logger.info('Sitemap index generation submitted for the closed runs')
+        
     except Exception as e:
         logger.error('Error in orchestrator task: %s', str(e))
         raise
@@ -1191,8 +1432,16 @@ def task_boost_request(bibcodes):
     if isinstance(bibcodes, str):
         bibcodes = [bibcodes]
         
+    # fetch records and metrics for the whole batch at once
+    entries = app._get_info_for_boost_entries(bibcodes)
+    result = False
     for bibcode in bibcodes:
-        result = app.generate_boost_request_message(bibcode)
+        entry = entries.get(bibcode)
+        if entry is None:
+            logger.debug('Skipping bibcode with no data: %s', bibcode)
+            result = False
+            continue
+        result = app.generate_boost_request_message(bibcode, entry=entry)
     
     logger.info('Boost requests for %s bibcode(s) sent to boost pipeline', len(bibcodes))
     
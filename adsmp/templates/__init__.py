@@ -1,7 +1,13 @@
 import os
 from pathlib import Path
+from functools import lru_cache
+import gzip
+import hashlib
 import html
 
+# template name -> (mtime, contents)
+_template_cache = {}
+
 # Tested
 def get_template_path(template_name):
     """Get the full path to a template file"""
@@ -10,10 +16,24 @@ def get_template_path(template_name):
 
 # Tested
 def load_template(template_name):
-    """Load a template file and return its contents as a string"""
+    """Load a template file and return its contents as a string
+
+    The file is read once per process; it is read again only when its
+    mtime changes, so edits show up without a restart during development.
+    """
     template_path = get_template_path(template_name)
+    mtime = os.stat(template_path).st_mtime_ns
+    cached = _template_cache.get(template_name)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
     with open(template_path, 'r', encoding='utf-8') as f:
-        return f.read()
+        contents = f.read()
+    _template_cache[template_name] = (mtime, contents)
+    return contents
+
+def clear_template_cache():
+    """Forget the loaded templates"""
+    _template_cache.clear()
 
 # Tested
 def render_robots_txt(sitemap_url):
@@ -33,6 +53,109 @@ def render_sitemap_file(url_entries):
     template = load_template('sitemap_file.xml')
     return template.format(url_entries=url_entries)
 
+def sitemap_file_parts():
+    """Return the (header, footer) of the sitemap file template, the text
+    before and after the url entries"""
+    template = load_template('sitemap_file.xml')
+    header, footer = template.split('{url_entries}', 1)
+    return header, footer
+
+
+class SitemapFileWriter(object):
+    """Streams a sitemap file to disk: the template header, then one url
+    entry at a time, then the footer. Nothing but the entry being written is
+    kept in memory, whatever the number of urls.
+
+    The content goes to a temporary file next to path and a sha256 of it
+    (uncompressed) is computed on the way. After close() the caller either
+    publish()es it, an atomic rename over path, or discard()s it, e.g. when
+    the hash shows nothing changed; readers never see a partial file.
+
+    With compress=True the output is gzipped (the caller picks the .xml.gz
+    name); the gzip header has no timestamp so the same entries always give
+    the same bytes.
+
+        with SitemapFileWriter(path) as writer:
+            writer.write(format_url_entry(bibcode, lastmod, pattern))
+
+    The context manager publishes on success and discards on error.
+    """
+
+    def __init__(self, path, compress=False):
+        self.path = path
+        self.tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        self.compress = compress
+        self.count = 0
+        # bytes on disk and hex sha256 of the content, known once closed
+        self.size = None
+        self.content_hash = None
+        self.published = False
+        self._raw = None
+        self._out = None
+        self._hash = None
+
+    def open(self):
+        header, self._footer = sitemap_file_parts()
+        self._hash = hashlib.sha256()
+        self._raw = open(self.tmp_path, 'wb')
+        if self.compress:
+            self._out = gzip.GzipFile(filename='', mode='wb', fileobj=self._raw, mtime=0)
+        else:
+            self._out = self._raw
+        self._write(header)
+        return self
+
+    def _write(self, text):
+        data = text.encode('utf-8')
+        self._hash.update(data)
+        self._out.write(data)
+
+    def write(self, url_entry):
+        """Write one entry as returned by format_url_entry"""
+        self._write(url_entry)
+        self.count += 1
+
+    def close(self):
+        """Write the footer and close the temporary file"""
+        if self._raw is None:
+            return
+        try:
+            self._write(self._footer)
+            if self._out is not self._raw:
+                # writes the gzip trailer, leaves its fileobj open
+                self._out.close()
+            self.size = self._raw.tell()
+            self.content_hash = self._hash.hexdigest()
+        finally:
+            self._raw.close()
+            self._out = self._raw = None
+
+    def publish(self):
+        """Move the finished file into place"""
+        self.close()
+        os.replace(self.tmp_path, self.path)
+        self.published = True
+
+    def discard(self):
+        """Drop the temporary file, path is left as it was"""
+        try:
+            self.close()
+        except Exception:
+            pass
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.publish()
+        else:
+            self.discard()
+        return False
+
+
 # Tested
 def format_sitemap_entry(sitemap_url, filename, lastmod_date):
     """Format a single sitemap entry for the sitemap index"""
@@ -49,6 +172,32 @@ def format_sitemap_entry(sitemap_url, filename, lastmod_date):
 def format_url_entry(bibcode, lastmod_date, abs_url_pattern='https://ui.adsabs.harvard.edu/abs/{bibcode}/abstract'):
     """Format a single URL entry for a sitemap file"""
     # Escape XML characters in bibcode to prevent malformed XML
-    escaped_bibcode = html.escape(bibcode)
-    url = abs_url_pattern.format(bibcode=escaped_bibcode)
-    return f'\n<url><loc>{url}</loc><lastmod>{lastmod_date}</lastmod></url>' 
\ No newline at end of file
+    return format_escaped_url_entry(html.escape(bibcode), lastmod_date, abs_url_pattern)
+
+def format_escaped_url_entry(escaped_bibcode, lastmod_date, abs_url_pattern):
+    """Format a URL entry for a bibcode that is already XML escaped, so a
+    record written to several sites is escaped only once"""
+    return url_entry_formatter(abs_url_pattern)(escaped_bibcode, str(lastmod_date))
+
+@lru_cache(maxsize=64)
+def url_entry_formatter(abs_url_pattern):
+    """Compile abs_url_pattern into a function (escaped_bibcode, lastmod_date)
+    -> url entry, the same text as format_escaped_url_entry; lastmod_date
+    must be a string
+
+    The pattern is parsed once: it is rendered with a marker in place of the
+    bibcode and split around it, so each entry is only string concatenation.
+    """
+    marker = '\x00'
+    parts = abs_url_pattern.format(bibcode=marker).split(marker)
+    if len(parts) == 2:
+        prefix = '\n<url><loc>' + parts[0]
+        suffix = parts[1] + '</loc><lastmod>'
+
+        def format_entry(escaped_bibcode, lastmod_date):
+            return prefix + escaped_bibcode + suffix + lastmod_date + '</lastmod></url>'
+    else:
+        # no or several {bibcode} in the pattern
+        def format_entry(escaped_bibcode, lastmod_date):
+            return '\n<url><loc>' + escaped_bibcode.join(parts) + '</loc><lastmod>' + lastmod_date + '</lastmod></url>'
+    return format_entry 
\ No newline at end of file
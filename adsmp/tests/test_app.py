@@ -67,6 +67,31 @@ class TestAdsOrcidCelery(unittest.TestCase):
         assert self.app._config.get("SQLALCHEMY_URL") == "sqlite:///"
         assert self.app.conf.get("SQLALCHEMY_URL") == "sqlite:///"
 
+    def test_metrics_db_lazy_init(self):
+        """the metrics engine is only created when the metrics db is used"""
+        a = app.ADSMasterPipelineCelery(
+            "test",
+            local_config={
+                "SQLALCHEMY_URL": "sqlite:///",
+                "METRICS_SQLALCHEMY_URL": "postgresql://postgres@127.0.0.1:15678/test",
+            },
+        )
+        self.assertIsNone(a._metrics_db)
+        # the upsert statement comes from MetricsModel, no connection needed
+        self.assertIs(a._metrics_table_upsert, self.app._metrics_table_upsert)
+        self.assertIsNone(a._metrics_db)
+        self.assertEqual(a.get_metrics("nonexistent"), {})
+        self.assertIsNotNone(a._metrics_db)
+        self.assertIs(a._metrics_engine, a._metrics_db["engine"])
+        a.close_app()
+
+        a = app.ADSMasterPipelineCelery(
+            "test", local_config={"SQLALCHEMY_URL": "sqlite:///", "METRICS_SQLALCHEMY_URL": None}
+        )
+        self.assertIsNone(a._metrics_session)
+        self.assertIsNone(a._metrics_engine)
+        a.close_app()
+
     def test_mark_processed(self):
         self.app.mark_processed(["abc"], "solr", checksums=["jkl"], status="success")
         r = self.app.get_record("abc")
@@ -379,6 +404,14 @@ class TestAdsOrcidCelery(unittest.TestCase):
             self.app.index_metrics([metrics_payload], [checksum])
             self.assertEqual(trans.commit.call_count, 2)
 
+    def _sent_datalinks(self, call):
+        """decode the payload of a mocked Session.put call"""
+        args, kwargs = call
+        self.assertEqual(args, ("http://localhost:8080/update",))
+        # not gzipped unless LINKS_RESOLVER_GZIP is set
+        self.assertEqual(kwargs["headers"], {})
+        return json.loads(kwargs["data"])
+
     def test_index_datalinks_success(self):
         """verify passed data sent to resolver service
         verify handles success from service
@@ -389,21 +422,22 @@ class TestAdsOrcidCelery(unittest.TestCase):
         # init database so timestamps and checksum can be updated
         nonbib_data = {"data_links_rows": [{"baz": 0}]}
         self.app.update_storage("linkstest", "nonbib_data", nonbib_data)
-        with mock.patch("requests.put", return_value=m) as p:
+        with mock.patch("requests.Session.put", return_value=m) as p:
             datalinks_payload = {
                 "bibcode": "linkstest",
                 "data_links_rows": [{"baz": 0}],
             }
             checksum = "thechecksum"
             self.app.index_datalinks([datalinks_payload], [checksum])
-            p.assert_called_with(
-                "http://localhost:8080/update",
-                data=json.dumps(
-                    [{"bibcode": "linkstest", "data_links_rows": [{"baz": 0}]}]
-                ),
-                headers={"Authorization": "Bearer fixme"},
+            self.assertEqual(
+                self._sent_datalinks(p.call_args),
+                [{"bibcode": "linkstest", "data_links_rows": [{"baz": 0}]}],
             )
             self.assertEqual(p.call_count, 1)
+            self.assertEqual(
+                self.app.datalinks_updater.session.headers["Authorization"],
+                "Bearer fixme",
+            )
             # verify database updated
             rec = self.app.get_record(bibcode="linkstest")
             self.assertEqual(rec["datalinks_checksum"], "thechecksum")
@@ -421,36 +455,35 @@ class TestAdsOrcidCelery(unittest.TestCase):
         # init database so timestamps and checksum can be updated
         nonbib_data = {"data_links_rows": [{"baz": 0}]}
         self.app.update_storage("linkstest", "nonbib_data", nonbib_data)
-        with mock.patch("requests.put", return_value=m) as p:
+        with mock.patch("requests.Session.put", return_value=m) as p:
             datalinks_payload = {
                 "bibcode": "linkstest",
                 "data_links_rows": [{"baz": 0}],
             }
             checksum = "thechecksum"
             self.app.index_datalinks([datalinks_payload], [checksum])
-            p.assert_called_with(
-                "http://localhost:8080/update",
-                data=json.dumps(
-                    [{"bibcode": "linkstest", "data_links_rows": [{"baz": 0}]}]
-                ),
-                headers={"Authorization": "Bearer fixme"},
+            self.assertEqual(
+                self._sent_datalinks(p.call_args),
+                [{"bibcode": "linkstest", "data_links_rows": [{"baz": 0}]}],
             )
 
             rec = self.app.get_record(bibcode="linkstest")
-            self.assertEqual(p.call_count, 2)
+            # the resolver failed, the record is not retried
+            self.assertEqual(p.call_count, 1)
             self.assertEqual(rec["datalinks_checksum"], None)
             self.assertEqual(rec["solr_checksum"], None)
             self.assertEqual(rec["metrics_checksum"], None)
             self.assertEqual(rec["status"], "links-failed")
             self.assertTrue(rec["datalinks_processed"])
 
-    def test_index_datalinks_service_only_batch_failure(self):
+    def test_index_datalinks_service_transient_failure(self):
         # init database so timestamps and checksum can be updated
         nonbib_data = {"data_links_rows": [{"baz": 0}]}
         self.app.update_storage("linkstest", "nonbib_data", nonbib_data)
-        with mock.patch("requests.put") as p:
+        self.app.conf["LINKS_RESOLVER_BACKOFF"] = 0
+        with mock.patch("requests.Session.put") as p:
             bad = mock.Mock()
-            bad.status_code = 500
+            bad.status_code = 503
             good = mock.Mock()
             good.status_code = 200
             p.side_effect = [bad, good]
@@ -460,12 +493,9 @@ class TestAdsOrcidCelery(unittest.TestCase):
             }
             checksum = "thechecksum"
             self.app.index_datalinks([datalinks_payload], [checksum])
-            p.assert_called_with(
-                "http://localhost:8080/update",
-                data=json.dumps(
-                    [{"bibcode": "linkstest", "data_links_rows": [{"baz": 0}]}]
-                ),
-                headers={"Authorization": "Bearer fixme"},
+            self.assertEqual(
+                self._sent_datalinks(p.call_args),
+                [{"bibcode": "linkstest", "data_links_rows": [{"baz": 0}]}],
             )
             self.assertEqual(p.call_count, 2)
             # verify database updated
@@ -476,13 +506,85 @@ class TestAdsOrcidCelery(unittest.TestCase):
             self.assertEqual(rec["status"], "success")
             self.assertTrue(rec["datalinks_processed"])
 
+    def test_index_datalinks_bisect_marks_only_sent(self):
+        """a rejected batch is bisected, only accepted records get their checksum"""
+        bibcodes = ["links%s" % i for i in range(5)]
+        for bibcode in bibcodes:
+            self.app.update_storage(bibcode, "nonbib_data", {"data_links_rows": [{"baz": 0}]})
+
+        def put(url, data=None, headers=None, timeout=None):
+            r = mock.Mock()
+            sent = json.loads(data)
+            r.status_code = 400 if any(x["bibcode"] == "links3" for x in sent) else 200
+            return r
+
+        with mock.patch("requests.Session.put", side_effect=put) as p, mock.patch.object(
+            self.app, "mark_processed", wraps=self.app.mark_processed
+        ) as mark:
+            payload = [{"bibcode": b, "data_links_rows": [{"baz": 0}]} for b in bibcodes]
+            checksums = ["checksum%s" % i for i in range(5)]
+            self.app.index_datalinks(payload, checksums)
+            # one call for the successes and one for the failures
+            self.assertEqual(mark.call_count, 2)
+
+        for i, bibcode in enumerate(bibcodes):
+            rec = self.app.get_record(bibcode=bibcode)
+            if bibcode == "links3":
+                self.assertEqual(rec["status"], "links-failed")
+                self.assertEqual(rec["datalinks_checksum"], None)
+            else:
+                self.assertEqual(rec["status"], "success")
+                self.assertEqual(rec["datalinks_checksum"], "checksum%s" % i)
+
+    def test_index_datalinks_deltas(self):
+        """records known to the resolver are sent as row level deltas"""
+        self.app.conf["LINKS_RESOLVER_DELTA_URL"] = "http://localhost:8080/delta"
+        rows = [{"link_type": "DATA", "link_sub_type": "CDS", "url": ["http://a"]},
+                {"link_type": "DATA", "link_sub_type": "NED", "url": ["http://b"]}]
+        for bibcode in ("links0", "links1"):
+            self.app.update_storage(bibcode, "nonbib_data", {"data_links_rows": rows})
+        ok = mock.Mock()
+        ok.status_code = 200
+        with mock.patch("requests.Session.put", return_value=ok) as p:
+            # first time the complete records go to the update url
+            payload = [{"bibcode": b, "data_links_rows": rows} for b in ("links0", "links1")]
+            self.app.index_datalinks(payload, ["c0", "c1"])
+            self.assertEqual(p.call_count, 1)
+            self.assertEqual(self._sent_datalinks(p.call_args), payload)
+
+            # links0 lost a row, links1 is unchanged
+            p.reset_mock()
+            payload = [{"bibcode": "links0", "data_links_rows": rows[:1]},
+                       {"bibcode": "links1", "data_links_rows": rows}]
+            self.app.index_datalinks(payload, ["c2", "c1"])
+            self.assertEqual(p.call_count, 1)
+            args, kwargs = p.call_args
+            self.assertEqual(args, ("http://localhost:8080/delta",))
+            self.assertEqual(json.loads(kwargs["data"]),
+                             [{"bibcode": "links0", "upsert": [],
+                               "delete": [{"link_type": "DATA", "link_sub_type": "NED"}]}])
+        self.assertEqual(self.app.get_record("links0")["datalinks_checksum"], "c2")
+        self.assertEqual(self.app.get_record("links1")["datalinks_checksum"], "c1")
+        self.assertEqual(list(self.app.get_datalinks_fingerprints(["links0"])["links0"]), ["DATA/CDS"])
+
+        # a resolver without deltas gets the full record instead
+        missing = mock.Mock()
+        missing.status_code = 404
+        with mock.patch("requests.Session.put", side_effect=[missing, ok]) as p:
+            payload = [{"bibcode": "links0", "data_links_rows": rows}]
+            self.app.index_datalinks(payload, ["c3"])
+            self.assertEqual(p.call_count, 2)
+            self.assertEqual(self._sent_datalinks(p.call_args), payload)
+        self.assertEqual(self.app.get_record("links0")["datalinks_checksum"], "c3")
+        self.assertEqual(self.app.datalinks_updater.delta_url, None)
+
     def test_index_datalinks_update_processed_false(self):
         m = mock.Mock()
         m.status_code = 200
         # init database so timestamps and checksum can be updated
         nonbib_data = {"data_links_rows": [{"baz": 0}]}
         self.app.update_storage("linkstest", "nonbib_data", nonbib_data)
-        with mock.patch("requests.put", return_value=m) as p:
+        with mock.patch("requests.Session.put", return_value=m) as p:
             datalinks_payload = {
                 "bibcode": "linkstest",
                 "data_links_rows": [{"baz": 0}],
@@ -491,12 +593,9 @@ class TestAdsOrcidCelery(unittest.TestCase):
             self.app.index_datalinks(
                 [datalinks_payload], [checksum], update_processed=False
             )
-            p.assert_called_with(
-                "http://localhost:8080/update",
-                data=json.dumps(
-                    [{"bibcode": "linkstest", "data_links_rows": [{"baz": 0}]}]
-                ),
-                headers={"Authorization": "Bearer fixme"},
+            self.assertEqual(
+                self._sent_datalinks(p.call_args),
+                [{"bibcode": "linkstest", "data_links_rows": [{"baz": 0}]}],
             )
             # verify database updated
             rec = self.app.get_record(bibcode="linkstest")
@@ -1138,6 +1237,9 @@ class TestAdsOrcidCelery(unittest.TestCase):
                         session.add(sitemap_info)
                         bibcode_index += 1
             session.commit()
+            # rows written directly, bring the per file counters in step
+            self.app.refresh_sitemap_files(session)
+            session.commit()
 
             # Test with fewer records in last file
             start_time = adsputils.get_date()
@@ -1240,6 +1342,8 @@ class TestAdsOrcidCelery(unittest.TestCase):
             # Clear all sitemap info
             session.query(SitemapInfo).delete(synchronize_session=False)
             session.commit()
+            self.app.refresh_sitemap_files(session)
+            session.commit()
 
             result = self.app.get_current_sitemap_state(session)
 
@@ -3289,74 +3393,51 @@ class TestAdsOrcidCelery(unittest.TestCase):
     def test_backup_sitemap_files(self):
         """Test backup_sitemap_files method"""
 
-        # Create temporary directory for test
         with tempfile.TemporaryDirectory() as temp_dir:
-            # Create test sitemap files
+            # plain directory, as before the versioned layout
+            sitemap_dir = os.path.join(temp_dir, "sitemap")
             test_files = ["sitemap_bib_1.xml", "sitemap_bib_2.xml", "sitemap_index.xml"]
-
+            os.makedirs(os.path.join(sitemap_dir, "ads"))
             for filename in test_files:
-                file_path = os.path.join(temp_dir, filename)
-                with open(file_path, "w") as f:
+                with open(os.path.join(sitemap_dir, "ads", filename), "w") as f:
                     f.write(f"<sitemap>Test content for {filename}</sitemap>")
 
-            # Verify files exist before backup
-            initial_files = os.listdir(temp_dir)
+            with patch("os.system") as system:
+                backup = self.app.backup_sitemap_files(sitemap_dir + "/")
+            self.assertFalse(system.called, "No shell commands should be run")
+
+            # the old files moved as a whole, the sitemap dir is now an empty generation
+            generations = os.path.join(temp_dir, "sitemap.generations")
+            self.assertEqual(os.path.dirname(backup), generations)
+            self.assertEqual(sorted(os.listdir(os.path.join(backup, "ads"))), sorted(test_files))
+            self.assertTrue(os.path.islink(sitemap_dir))
+            self.assertEqual(os.listdir(sitemap_dir), [])
+            self.assertEqual(len(os.listdir(generations)), 2)
+
+            # swapped again, the previous generation is kept
+            with open(os.path.join(sitemap_dir, "robots.txt"), "w") as f:
+                f.write("User-agent: *")
+            current = os.path.realpath(sitemap_dir)
+            self.assertEqual(self.app.backup_sitemap_files(sitemap_dir), current)
+            self.assertEqual(os.listdir(current), ["robots.txt"])
+            self.assertEqual(os.listdir(sitemap_dir), [])
             self.assertEqual(
-                len(initial_files), 3, "Should have 3 test files before backup"
+                [x for x in os.listdir(temp_dir) if x.endswith(".tmp")], [], "No temporary symlink left"
             )
-            for filename in test_files:
-                self.assertIn(
-                    filename,
-                    initial_files,
-                    f"File {filename} should exist before backup",
-                )
 
-            # Mock os.system to capture the backup commands
-            backup_commands = []
-            original_system = os.system
-
-            def mock_system(command):
-                backup_commands.append(command)
-                # Execute mkdir command but skip mv command for testing
-                if command.startswith("mkdir"):
-                    return original_system(command)
-                return 0  # Success for mv command
-
-            # Test backup_sitemap_files with mocked os.system
-            with patch("os.system", side_effect=mock_system):
-                self.app.backup_sitemap_files(temp_dir)
-
-            # Verify backup commands were called
+            # only SITEMAP_BACKUP_GENERATIONS old generations are kept
+            saved = self.app.conf.get("SITEMAP_BACKUP_GENERATIONS")
+            self.app.conf["SITEMAP_BACKUP_GENERATIONS"] = 1
+            try:
+                last = self.app.backup_sitemap_files(sitemap_dir)
+            finally:
+                self.app.conf["SITEMAP_BACKUP_GENERATIONS"] = saved
             self.assertEqual(
-                len(backup_commands), 2, "Should execute 2 commands (mkdir + mv)"
-            )
-
-            # Check mkdir command
-            mkdir_command = backup_commands[0]
-            self.assertTrue(
-                mkdir_command.startswith("mkdir -p /app/logs/tmp/sitemap_"),
-                "First command should create backup directory",
-            )
-
-            # Check mv command
-            mv_command = backup_commands[1]
-            self.assertTrue(
-                mv_command.startswith(f"mv {temp_dir}/*"),
-                "Second command should move files from source directory",
-            )
-            self.assertIn(
-                "/app/logs/tmp/sitemap_",
-                mv_command,
-                "Move command should target backup directory",
-            )
-
-            # Verify backup directory path format (contains date components)
-
-            date_pattern = r"/app/logs/tmp/sitemap_\d{4}_\d{1,2}_\d{1,2}-"
-            self.assertTrue(
-                re.search(date_pattern, mkdir_command),
-                "Backup directory should contain date components",
+                sorted(os.listdir(generations)),
+                sorted([os.path.basename(last), os.path.basename(os.path.realpath(sitemap_dir))]),
             )
+            self.assertFalse(os.path.exists(backup))
+            self.assertFalse(os.path.exists(current))
 
     def test_execute_remove_action_basic_functionality(self):
         """Test basic functionality of _execute_remove_action method"""
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from adsmp.datalinks_updater import DatalinksUpdater, make_delta, row_fingerprints
+
+
+class FakeResolverHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the links resolver update endpoint"""
+
+    def do_PUT(self):
+        server = self.server
+        if self.path == '/delta' and not server.deltas:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        records = json.loads(body.decode('utf-8'))
+        server.requests.append((self.headers.get('Authorization'), [x['bibcode'] for x in records]))
+
+        if server.status is not None:
+            status = server.status
+        elif server.unavailable > 0:
+            server.unavailable -= 1
+            status = 503
+        elif any(x['bibcode'] in server.bad_bibcodes for x in records):
+            status = 400
+        else:
+            status = 200
+            server.received.extend(records)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDatalinksUpdater(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = HTTPServer(('127.0.0.1', 0), FakeResolverHandler)
+        self.server.requests = []
+        self.server.received = []
+        self.server.bad_bibcodes = set()
+        self.server.unavailable = 0
+        self.server.status = None
+        self.server.deltas = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        url = 'http://127.0.0.1:%s/update' % self.server.server_address[1]
+        self.updater = DatalinksUpdater(url, api_token='secret', timeout=5, max_retries=2, backoff=0,
+                                        delta_url=url.replace('/update', '/delta'))
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.updater.close()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def records(self, n):
+        return [{'bibcode': 'bib%s' % i, 'data_links_rows': [{'url': ['http://x/%s' % i]}]} for i in range(n)]
+
+    def test_send_batch(self):
+        records = self.records(10)
+        sent, failed = self.updater.send(records)
+        self.assertEqual(sent, list(range(10)))
+        self.assertEqual(failed, [])
+        # one request with the token
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0][0], 'Bearer secret')
+        self.assertEqual(self.server.received, records)
+
+    def test_send_compressed(self):
+        self.updater.compress = True
+        records = self.records(2)
+        self.assertEqual(self.updater.encode(records)[1], {'Content-Encoding': 'gzip'})
+        self.assertEqual(self.updater.send(records), ([0, 1], []))
+        self.assertEqual(self.server.received, records)
+
+    def test_bisect_bad_records(self):
+        self.server.bad_bibcodes = {'bib3', 'bib12'}
+        records = self.records(16)
+        sent, failed = self.updater.send(records)
+        self.assertEqual(failed, [3, 12])
+        self.assertEqual(sent, [i for i in range(16) if i not in (3, 12)])
+        self.assertEqual(sorted(x['bibcode'] for x in self.server.received),
+                         sorted(records[i]['bibcode'] for i in sent))
+        # far fewer requests than one per record
+        self.assertLess(len(self.server.requests), 16)
+
+    def test_retry_transient_failures(self):
+        self.server.unavailable = 2
+        sent, failed = self.updater.send(self.records(3))
+        self.assertEqual(sent, [0, 1, 2])
+        self.assertEqual(len(self.server.requests), 3)
+
+        # retries exhausted, the batch fails as a whole and is not bisected
+        self.server.requests = []
+        self.server.unavailable = 3
+        sent, failed = self.updater.send(self.records(2))
+        self.assertEqual(sent, [])
+        self.assertEqual(failed, [0, 1])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_resolver_down(self):
+        self.server.status = 503
+        sent, failed = self.updater.send(self.records(16))
+        self.assertEqual((sent, failed), ([], list(range(16))))
+        # one request and its retries, not one per bisected half
+        self.assertEqual(len(self.server.requests), self.updater.max_retries + 1)
+
+        # a refused token is neither retried nor bisected
+        self.server.requests = []
+        self.server.status = 401
+        sent, failed = self.updater.send(self.records(16))
+        self.assertEqual((sent, failed), ([], list(range(16))))
+        self.assertEqual(len(self.server.requests), 1)
+
+        # nor is any other server error
+        self.server.requests = []
+        self.server.status = 500
+        self.assertEqual(self.updater.send_deltas(self.records(4)), ([], [0, 1, 2, 3], []))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_connection_error(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        self.updater.max_retries = 1
+        sent, failed = self.updater.send(self.records(1))
+        self.assertEqual(sent, [])
+        self.assertEqual(failed, [0])
+
+    def test_make_delta(self):
+        rows = [{'link_type': 'ESOURCE', 'link_sub_type': 'PUB_PDF', 'url': ['http://a']},
+                {'link_type': 'DATA', 'link_sub_type': 'CDS', 'url': ['http://b'], 'item_count': 1}]
+        record = {'bibcode': 'bib', 'data_links_rows': rows}
+        fingerprints = row_fingerprints(rows)
+        self.assertEqual(sorted(fingerprints), ['DATA/CDS', 'ESOURCE/PUB_PDF'])
+        # nothing known about the record, full replacement
+        self.assertEqual(make_delta(record, fingerprints, None), None)
+        # nothing changed
+        self.assertEqual(make_delta(record, fingerprints, fingerprints),
+                         {'bibcode': 'bib', 'upsert': [], 'delete': []})
+
+        new_rows = [{'link_type': 'ESOURCE', 'link_sub_type': 'PUB_PDF', 'url': ['http://a']},
+                    {'link_type': 'DATA', 'link_sub_type': 'CDS', 'url': ['http://b', 'http://c'], 'item_count': 2},
+                    {'link_type': 'DATA', 'link_sub_type': 'NED', 'url': ['http://d']}]
+        new_record = {'bibcode': 'bib', 'data_links_rows': new_rows}
+        self.assertEqual(make_delta(new_record, row_fingerprints(new_rows), fingerprints),
+                         {'bibcode': 'bib', 'upsert': new_rows[1:], 'delete': []})
+        self.assertEqual(make_delta(record, fingerprints, row_fingerprints(new_rows)),
+                         {'bibcode': 'bib', 'upsert': rows[1:],
+                          'delete': [{'link_type': 'DATA', 'link_sub_type': 'NED'}]})
+
+        # rows sharing a key can't be addressed individually
+        self.assertEqual(row_fingerprints(rows + rows[:1]), None)
+        self.assertEqual(make_delta(record, None, fingerprints), None)
+
+    def test_send_deltas(self):
+        deltas = [{'bibcode': 'bib%s' % i, 'upsert': [{'url': ['http://x/%s' % i]}], 'delete': []}
+                  for i in range(4)]
+        self.assertEqual(self.updater.send_deltas(deltas), ([0, 1, 2, 3], [], []))
+        self.assertEqual(self.server.received, deltas)
+
+    def test_send_deltas_unsupported(self):
+        self.server.deltas = False
+        deltas = [{'bibcode': 'bib%s' % i, 'upsert': [], 'delete': []} for i in range(3)]
+        self.assertEqual(self.updater.send_deltas(deltas), ([], [], [0, 1, 2]))
+        # the resolver is not asked again
+        self.assertEqual(self.updater.delta_url, None)
+        self.assertEqual(self.updater.send_deltas(deltas), ([], [], [0, 1, 2]))
+        self.assertEqual(self.server.received, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -165,6 +165,49 @@ class TestAdsOrcidCelery(unittest.TestCase):
         self.assertFalse(x['refereed'])
         self.assertTrue(y['refereed'])
 
+
+    def test_update_batch_with_bad_record(self):
+        """a bad row in a batch is isolated by bisection, the rest lands in the db"""
+        app = self.app
+        batch = [{"bibcode": "bisect%s" % i, "author_num": i} for i in range(8)]
+        batch[5]["author_num"] = "not-a-number"
+        for x in batch:
+            app.update_storage(x["bibcode"], "metrics", x)
+        checksums = [app.checksum(x) for x in batch]
+        app.index_metrics(batch, checksums)
+
+        with app.metrics_session_scope() as session:
+            stored = set(x.bibcode for x in session.query(models.MetricsModel).all())
+        self.assertEqual(stored, set(x["bibcode"] for x in batch) - {"bisect5"})
+
+        for x, checksum in zip(batch, checksums):
+            r = app.get_record(x["bibcode"])
+            self.assertTrue(r["metrics_processed"])
+            if x["bibcode"] == "bisect5":
+                self.assertEqual("metrics-failed", r["status"])
+                self.assertEqual(None, r["metrics_checksum"])
+            else:
+                self.assertEqual("success", r["status"])
+                self.assertEqual(checksum, r["metrics_checksum"])
+
+    def test_get_metrics_bulk(self):
+        app = self.app
+        batch = [test1.copy(), test2.copy(), test3.copy()]
+        app.index_metrics(batch, [app.checksum(x) for x in batch])
+
+        x = app.get_metrics_bulk(['bib1', 'bib3', 'nope'])
+        self.assertEqual(set(x.keys()), {'bib1', 'bib3'})
+        self.assertEqual(x['bib1'], app.get_metrics('bib1'))
+        self.assertEqual(x['bib3']['author_num'], 3)
+
+        x = app.get_metrics_bulk(['bib1', 'bib2'], columns=['author_num', 'refereed'])
+        self.assertEqual(x, {'bib1': {'bibcode': 'bib1', 'author_num': 1, 'refereed': True},
+                             'bib2': {'bibcode': 'bib2', 'author_num': 2, 'refereed': True}})
+
+        self.assertEqual(app.get_metrics_bulk([]), {})
+        with self.assertRaises(ValueError):
+            app.get_metrics_bulk(['bib1'], columns=['foo'])
+
         
 if __name__ == '__main__':
     unittest.main()
@@ -7,7 +7,7 @@ import io
 import testing.postgresql
 
 from adsmp import app, tasks
-from adsmp.models import Base, Records, SitemapInfo
+from adsmp.models import Base, KeyValue, Records, SitemapInfo
 from run import reindex_failed_bibcodes, manage_sitemap, update_sitemap_files, update_sitemaps_auto, cleanup_invalid_sitemaps
 from datetime import datetime, timedelta, timezone
 from adsputils import get_date
@@ -500,7 +500,7 @@ class TestSitemapCommandLine(unittest.TestCase):
                 mock_manage_sig = Mock()
                 mock_files_sig = Mock()
                 
-                with patch.object(tasks.task_manage_sitemap, 's', return_value=mock_manage_sig):
+                with patch.object(tasks.task_update_sitemaps_auto, 'si', return_value=mock_manage_sig):
                     with patch.object(tasks.task_update_sitemap_files, 's', return_value=mock_files_sig):
                         # Call the function
                         workflow_id = update_sitemaps_auto(days_back=1)
@@ -589,13 +589,13 @@ class TestSitemapCommandLine(unittest.TestCase):
                 mock_workflow.apply_async.return_value = mock_result
                 mock_chain.return_value = mock_workflow
                 
-                # Mock the task signatures to capture bibcodes
-                captured_bibcodes = []
-                def capture_manage_sig(bibcodes, action):
-                    captured_bibcodes.extend(bibcodes)
+                # Mock the task signature to capture the cutoff
+                cutoffs = []
+                def capture_auto_sig(cutoff, started):
+                    cutoffs.append(cutoff)
                     return Mock()
                 
-                with patch.object(tasks.task_manage_sitemap, 's', side_effect=capture_manage_sig):
+                with patch.object(tasks.task_update_sitemaps_auto, 'si', side_effect=capture_auto_sig):
                     with patch.object(tasks.task_update_sitemap_files, 's', return_value=Mock()):
                         # Call the function
                         workflow_id = update_sitemaps_auto(days_back=1)
@@ -607,9 +607,72 @@ class TestSitemapCommandLine(unittest.TestCase):
                         self.assertTrue(mock_chain.called)
                         
                         # Should include bibcodes from both bib_data_updated and solr_processed queries
+                        with self.app.session_scope() as session:
+                            captured_bibcodes = [r.bibcode for r in
+                                                 self.app.sitemap_auto_changes(session, get_date(cutoffs[0]))]
                         expected_bibcodes = ['2023ApJ...123..791E', '2023ApJ...123..789C', '2023ApJ...123..790D']
                         self.assertEqual(set(captured_bibcodes), set(expected_bibcodes))
 
+    def test_update_sitemaps_auto_watermark_and_chunks(self):
+        """Later runs start from the previous one, flagged records are left out"""
+        now = get_date()
+        with self.app.session_scope() as session:
+            for i, hours in enumerate([30, 20, 10, 2, 1]):
+                session.add(Records(bibcode='2023ApJ...123..%03dW' % i, bib_data='{"title": "x"}',
+                                    bib_data_updated=now - timedelta(hours=hours), status='success'))
+            session.flush()
+            record = session.query(Records).filter_by(bibcode='2023ApJ...123..004W').one()
+            session.add(SitemapInfo(bibcode=record.bibcode, record_id=record.id, update_flag=True,
+                                    sitemap_filename='sitemap_bib_1.xml'))
+            session.commit()
+
+        def run_auto(finish=True, **kwargs):
+            # the bibcodes task_update_sitemaps_auto would add, and the
+            # watermark it saves once done
+            bibcodes = []
+            def auto_sig(cutoff, started):
+                with self.app.session_scope() as session:
+                    bibcodes.extend(r.bibcode for r in self.app.sitemap_auto_changes(session, get_date(cutoff)))
+                if finish:
+                    self.app.set_sitemap_auto_watermark(get_date(started))
+            with patch('run.chain') as mock_chain, patch('run.app', self.app), \
+                    patch.object(tasks.task_update_sitemaps_auto, 'si', side_effect=auto_sig), \
+                    patch.object(tasks.task_update_sitemap_files, 's'):
+                mock_chain.return_value.apply_async.return_value.id = 'wf'
+                workflow_id = update_sitemaps_auto(**kwargs)
+            return workflow_id, bibcodes
+
+        self.app.conf['SITEMAP_AUTO_WATERMARK_OVERLAP_MINUTES'] = 60
+        # first run, no watermark: one day back
+        workflow_id, bibcodes = run_auto(finish=False, days_back=1)
+        self.assertEqual(workflow_id, 'wf')
+        self.assertEqual(bibcodes, ['2023ApJ...123..001W', '2023ApJ...123..002W', '2023ApJ...123..003W'])
+        # submitted is not done, the task saves the watermark
+        self.assertIsNone(self.app.get_sitemap_auto_watermark())
+
+        # so the next run looks at the same records again
+        workflow_id, bibcodes = run_auto(days_back=1)
+        self.assertEqual(bibcodes, ['2023ApJ...123..001W', '2023ApJ...123..002W', '2023ApJ...123..003W'])
+        self.assertGreaterEqual(self.app.get_sitemap_auto_watermark(), now)
+
+        # next run only sees what changed since, less the overlap
+        with self.app.session_scope() as session:
+            session.query(Records).filter_by(bibcode='2023ApJ...123..000W').update(
+                {'solr_processed': get_date() - timedelta(minutes=30)})
+            session.commit()
+        workflow_id, bibcodes = run_auto(days_back=1)
+        self.assertEqual(bibcodes, ['2023ApJ...123..000W'])
+
+        # nothing new
+        with self.app.session_scope() as session:
+            session.query(KeyValue).filter_by(key='last.sitemap.auto').update(
+                {'value': (get_date() + timedelta(hours=2)).isoformat()})
+            session.commit()
+        self.assertEqual(run_auto(days_back=1), (None, []))
+        # unless asked to look back
+        workflow_id, bibcodes = run_auto(days_back=2, use_watermark=False)
+        self.assertEqual(len(bibcodes), 4)
+
     def test_cleanup_invalid_sitemaps(self):
         """Test cleanup_invalid_sitemaps function"""
         
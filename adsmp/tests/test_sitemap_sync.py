@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from adsmp import app, sitemap_sync
+from adsmp.models import Base, SitemapFileSite, SitemapSyncedFile
+
+
+class TestSitemapSync(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.app = app.ADSMasterPipelineCelery('test', local_config={
+            'SQLALCHEMY_URL': 'sqlite:///',
+            'SQLALCHEMY_ECHO': False,
+            'METRICS_SQLALCHEMY_URL': None,
+        })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+        self.directory = tempfile.mkdtemp()
+        self.sitemap_dir = os.path.join(self.directory, 'sitemap')
+        self.backend = sitemap_sync.DirectoryBackend(os.path.join(self.directory, 'bucket'))
+        self.write('ads', 'sitemap_bib_1.xml', b'<urlset>1</urlset>')
+        self.write('ads', 'sitemap_index.xml', b'<sitemapindex/>')
+        self.write('ads', 'robots.txt', b'User-agent: *')
+        self.write('scix', 'sitemap_bib_1.xml', b'<urlset>scix 1</urlset>')
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+        self.app.close_app()
+        shutil.rmtree(self.directory)
+
+    def write(self, site, filename, content):
+        os.makedirs(os.path.join(self.sitemap_dir, site), exist_ok=True)
+        with open(os.path.join(self.sitemap_dir, site, filename), 'wb') as f:
+            f.write(content)
+
+    def remote(self, site, filename):
+        with open(os.path.join(self.backend.root, site, filename), 'rb') as f:
+            return f.read()
+
+    def sync(self, **kwargs):
+        return sitemap_sync.sync_sitemaps(self.app, self.backend, self.sitemap_dir, ['ads', 'scix'], **kwargs)
+
+    def test_sync(self):
+        result = self.sync()
+        self.assertEqual(result, {'uploaded': 4, 'unchanged': 0, 'deleted': 0, 'failed': []})
+        self.assertEqual(self.remote('scix', 'sitemap_bib_1.xml'), b'<urlset>scix 1</urlset>')
+        with self.app.session_scope() as session:
+            rows = session.query(SitemapSyncedFile).filter_by(site='ads', filename='robots.txt').one()
+            self.assertEqual(rows.content_hash,
+                             sitemap_sync.file_sha256(os.path.join(self.sitemap_dir, 'ads', 'robots.txt')))
+
+        # nothing changed, nothing uploaded
+        with patch.object(self.backend, 'put') as put:
+            result = self.sync()
+        self.assertFalse(put.called)
+        self.assertEqual(result, {'uploaded': 0, 'unchanged': 4, 'deleted': 0, 'failed': []})
+
+        # a changed file is uploaded again, a removed one deleted remotely
+        self.write('ads', 'sitemap_bib_1.xml', b'<urlset>1 changed</urlset>')
+        os.remove(os.path.join(self.sitemap_dir, 'scix', 'sitemap_bib_1.xml'))
+        # files being written are left alone
+        self.write('ads', 'sitemap_bib_2.xml.tmp', b'<urlset>')
+        result = self.sync()
+        self.assertEqual(result, {'uploaded': 1, 'unchanged': 2, 'deleted': 1, 'failed': []})
+        self.assertEqual(self.remote('ads', 'sitemap_bib_1.xml'), b'<urlset>1 changed</urlset>')
+        self.assertFalse(os.path.exists(os.path.join(self.backend.root, 'scix', 'sitemap_bib_1.xml')))
+        self.assertFalse(os.path.exists(os.path.join(self.backend.root, 'ads', 'sitemap_bib_2.xml.tmp')))
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(SitemapSyncedFile).filter_by(site='scix').count(), 0)
+
+    def test_sync_hash_from_db(self):
+        path = os.path.join(self.sitemap_dir, 'ads', 'sitemap_bib_1.xml')
+        with self.app.session_scope() as session:
+            session.add(SitemapFileSite(filename='sitemap_bib_1.xml', site='ads', output_filename='sitemap_bib_1.xml',
+                                        byte_size=os.path.getsize(path), content_hash='a' * 64))
+            session.commit()
+        with patch('adsmp.sitemap_sync.file_sha256', return_value='b' * 64) as sha:
+            self.sync()
+        # the other three files were hashed from disk
+        self.assertEqual(sha.call_count, 3)
+        with self.app.session_scope() as session:
+            row = session.query(SitemapSyncedFile).filter_by(site='ads', filename='sitemap_bib_1.xml').one()
+            self.assertEqual(row.content_hash, 'a' * 64)
+
+    def test_sync_multipart(self):
+        content = os.urandom(2500)
+        self.write('ads', 'sitemap_bib_2.xml.gz', content)
+        result = self.sync(multipart_threshold=1000, part_size=1000)
+        self.assertEqual(result['uploaded'], 5)
+        self.assertEqual(self.backend.multipart_uploads, 1)
+        self.assertEqual(self.remote('ads', 'sitemap_bib_2.xml.gz'), content)
+        self.assertEqual(os.listdir(os.path.join(self.backend.root, '.multipart')), [])
+        self.assertEqual(sitemap_sync.content_type('sitemap_bib_2.xml.gz'), 'application/gzip')
+
+    def test_sync_failed_upload(self):
+        put = self.backend.put
+
+        def flaky_put(key, path, content_type):
+            if key == 'ads/robots.txt':
+                raise IOError('connection reset')
+            put(key, path, content_type)
+
+        with patch.object(self.backend, 'put', side_effect=flaky_put):
+            result = self.sync()
+        self.assertEqual(result['uploaded'], 3)
+        self.assertEqual(result['failed'], ['ads/robots.txt'])
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(SitemapSyncedFile).filter_by(site='ads', filename='robots.txt').count(), 0)
+
+        # tried again on the next sync
+        result = self.sync()
+        self.assertEqual(result, {'uploaded': 1, 'unchanged': 3, 'deleted': 0, 'failed': []})
+        self.assertEqual(self.remote('ads', 'robots.txt'), b'User-agent: *')
+
+    def test_backend_from_config(self):
+        backend = sitemap_sync.backend_from_config({'SITEMAP_S3_BUCKET': 'file://' + self.directory,
+                                                    'SITEMAP_S3_PREFIX': 'prod/'})
+        self.assertTrue(isinstance(backend, sitemap_sync.DirectoryBackend))
+        self.assertEqual(backend.root, os.path.join(self.directory, 'prod', ''))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from adsmp import app, solr_export, solr_updater
+from adsmp.models import Base
+
+
+class TestSolrExport(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.app = app.ADSMasterPipelineCelery('test', local_config={
+            'SQLALCHEMY_URL': 'sqlite:///',
+            'SQLALCHEMY_ECHO': False,
+            'METRICS_SQLALCHEMY_URL': None,
+            'SOLR_DOC_STORE': True,
+        })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+        self.directory = tempfile.mkdtemp()
+        self.bibcodes = ['2020Test.......%04dA' % i for i in range(7)]
+        for bibcode in self.bibcodes:
+            self.app.update_storage(bibcode, 'bib_data', {'bibcode': bibcode, 'title': ['title of %s' % bibcode]})
+        # no bib data, not exported
+        self.app.update_storage('2020Test.......9999A', 'nonbib_data', {'boost': 0.1})
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+        self.app.close_app()
+        shutil.rmtree(self.directory)
+
+    def read_shard(self, filename):
+        with gzip.open(os.path.join(self.directory, filename), 'rt') as f:
+            return [json.loads(line) for line in f]
+
+    def test_export(self):
+        manifest = solr_export.export_solr_docs(self.app, self.directory, batch_size=2, shard_size=3, workers=1)
+        self.assertEqual(manifest['count'], 7)
+        self.assertEqual([x['file'] for x in manifest['shards']],
+                         ['solr-docs-00000.jsonl.gz', 'solr-docs-00001.jsonl.gz', 'solr-docs-00002.jsonl.gz'])
+        self.assertEqual([x['count'] for x in manifest['shards']], [3, 3, 1])
+        with open(os.path.join(self.directory, 'manifest.json')) as f:
+            self.assertEqual(json.load(f), manifest)
+
+        lines = self.read_shard('solr-docs-00000.jsonl.gz')
+        self.assertEqual([x['bibcode'] for x in lines], self.bibcodes[:3])
+        # same doc and checksum as reindex would send
+        record = self.app.get_record(self.bibcodes[0])
+        doc = solr_updater.to_solr_doc(record)
+        self.assertEqual(lines[0]['doc'], json.loads(json.dumps(doc)))
+        self.assertEqual(lines[0]['checksum'], self.app.checksum(doc))
+        self.assertEqual(lines[0]['doc']['identifier'], [self.bibcodes[0]])
+
+        # restart after the last exported id, nothing left
+        manifest = solr_export.export_solr_docs(self.app, self.directory + '/more', start_id=manifest['last_id'],
+                                                workers=1)
+        self.assertEqual(manifest['count'], 0)
+        self.assertEqual(manifest['shards'], [])
+
+    def test_export_parallel(self):
+        serial = solr_export.export_solr_docs(self.app, self.directory + '/serial', batch_size=2, workers=1)
+        parallel = solr_export.export_solr_docs(self.app, self.directory + '/parallel', batch_size=2, workers=2)
+        self.assertEqual(parallel['count'], 7)
+        # same content in the same order
+        exported = []
+        for name in ('serial', 'parallel'):
+            with gzip.open(os.path.join(self.directory, name, 'solr-docs-00000.jsonl.gz'), 'rt') as f:
+                exported.append([json.loads(x) for x in f])
+        self.assertEqual(exported[0], exported[1])
+        self.assertEqual([x['bibcode'] for x in exported[1]], self.bibcodes)
+
+    def test_load(self):
+        solr_export.export_solr_docs(self.app, self.directory, shard_size=4, workers=1)
+        bad = self.bibcodes[2]
+
+        def update_solr(docs, urls, ignore_errors=False, commit=False):
+            if any(d['bibcode'] == bad for d in docs):
+                if ignore_errors:
+                    return [400]
+                raise Exception('rejected')
+            return []
+
+        with patch('adsmp.solr_updater.update_solr', side_effect=update_solr) as p:
+            posted, failed = solr_export.load_solr_export(self.directory, ['http://solr/collection2/update'],
+                                                          batch_size=3, commit=True, app=self.app,
+                                                          update_processed=True)
+        self.assertEqual(posted, 6)
+        self.assertEqual(failed, [bad])
+        # the last call commits
+        self.assertEqual(p.call_args, (([], ['http://solr/collection2/update']), {'commit': True}))
+        for bibcode in self.bibcodes:
+            r = self.app.get_record(bibcode)
+            if bibcode == bad:
+                self.assertEqual(r['solr_checksum'], None)
+            else:
+                self.assertEqual(r['status'], 'success')
+                self.assertEqual(r['solr_checksum'], self.app.checksum(solr_updater.to_solr_doc(r)))
+
+    def test_load_corrupted(self):
+        solr_export.export_solr_docs(self.app, self.directory, shard_size=4, workers=1)
+        with open(os.path.join(self.directory, 'solr-docs-00001.jsonl.gz'), 'ab') as f:
+            f.write(b'junk')
+        with patch('adsmp.solr_updater.update_solr') as p:
+            with self.assertRaises(ValueError):
+                solr_export.load_solr_export(self.directory, ['http://solr/collection2/update'])
+            # nothing was posted
+            self.assertFalse(p.called)
+
+
+    def index(self, bibcodes):
+        docs = [solr_updater.to_solr_doc(self.app.get_record(b)) for b in bibcodes]
+        checksums = [self.app.checksum(d) for d in docs]
+        with patch('adsmp.solr_updater.update_solr', return_value=[]):
+            self.app.index_solr(docs, checksums, ['http://solr/collection1/update'])
+        return docs
+
+    def test_doc_store(self):
+        docs = self.index(self.bibcodes[:3])
+        stored = self.app.get_solr_docs(self.bibcodes)
+        self.assertEqual(sorted(stored), self.bibcodes[:3])
+        self.assertEqual(stored[self.bibcodes[0]], json.loads(json.dumps(docs[0])))
+        # sent again, replaced
+        self.index(self.bibcodes[:1])
+        self.assertEqual([x[0] for x in self.app.iter_solr_docs(batch_size=2)], self.bibcodes[:3])
+
+        # not stored when the store is off or nothing is marked processed
+        self.app.conf['SOLR_DOC_STORE'] = False
+        self.index(self.bibcodes[3:4])
+        self.app.conf['SOLR_DOC_STORE'] = True
+        with patch('adsmp.solr_updater.update_solr', return_value=[]):
+            self.app.index_solr(docs[:1], ['x'], ['http://solr/collection1/update'], update_processed=False)
+        self.assertEqual(sorted(self.app.get_solr_docs(self.bibcodes)), self.bibcodes[:3])
+
+        # the stored doc goes with the record
+        self.app.delete_by_bibcode(self.bibcodes[0])
+        self.assertEqual(sorted(self.app.get_solr_docs(self.bibcodes)), self.bibcodes[1:3])
+
+    def test_doc_store_individual_retry(self):
+        docs = [solr_updater.to_solr_doc(self.app.get_record(b)) for b in self.bibcodes[:2]]
+        docs[1]['body'] = 'bad body'
+
+        def update_solr(docs, urls, ignore_errors=False, commit=False):
+            if any('body' in d for d in docs):
+                if ignore_errors:
+                    return [400]
+                raise Exception('error in body field')
+            return []
+
+        with patch('adsmp.solr_updater.update_solr', side_effect=update_solr):
+            self.app.index_solr(docs, ['c0', 'c1'], ['http://solr/collection1/update'])
+        stored = self.app.get_solr_docs(self.bibcodes)
+        self.assertEqual(sorted(stored), self.bibcodes[:2])
+        # what solr actually accepted, without the body
+        self.assertTrue('body' not in stored[self.bibcodes[1]])
+
+    def test_replay(self):
+        self.index(self.bibcodes)
+        with patch('adsmp.solr_updater.update_solr', return_value=[]) as p:
+            posted, failed = solr_export.replay_solr_docs(self.app, ['http://solr/collection2/update'],
+                                                          batch_size=4)
+        self.assertEqual((posted, failed), (7, []))
+        self.assertEqual([len(c[0][0]) for c in p.call_args_list], [4, 3])
+        self.assertEqual([d['bibcode'] for c in p.call_args_list for d in c[0][0]], self.bibcodes)
+
+    def test_diff(self):
+        self.index(self.bibcodes[:2])
+        self.app.update_storage(self.bibcodes[0], 'bib_data', {'bibcode': self.bibcodes[0],
+                                                                'title': ['new title'], 'year': '2020'})
+        diffs = solr_export.diff_stored_solr_docs(self.app, self.bibcodes[:3])
+        self.assertEqual(sorted(diffs), self.bibcodes[:2])
+        self.assertEqual(diffs[self.bibcodes[0]]['added'], {'year': '2020'})
+        self.assertEqual(diffs[self.bibcodes[0]]['removed'], {})
+        self.assertEqual(diffs[self.bibcodes[0]]['changed']['title'],
+                         (['title of %s' % self.bibcodes[0]], ['new title']))
+        self.assertEqual(diffs[self.bibcodes[1]], {'added': {}, 'removed': {}, 'changed': {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
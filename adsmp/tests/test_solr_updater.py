@@ -870,5 +870,77 @@ class TestSolrUpdater(unittest.TestCase):
         )
 
 
+    def test_generate_hier_facet(self):
+        self.assertEqual([], solr_updater.generate_hier_facet())
+        self.assertEqual(
+            ["0/NASA", "1/NASA/NNX12AB34C"],
+            solr_updater.generate_hier_facet("NASA", "NNX12AB34C"),
+        )
+        # results are cached, callers must get their own list
+        facet = solr_updater.generate_hier_facet("Moon", "Crater", "Alder")
+        facet.append("junk")
+        self.assertEqual(
+            ["0/Moon", "1/Moon/Crater", "2/Moon/Crater/Alder"],
+            solr_updater.generate_hier_facet("Moon", "Crater", "Alder"),
+        )
+
+    def test_map_object_types(self):
+        for otype, expected in (("G", "Galaxy"), ("Sy2", "Other"), ("**", "Star"),
+                                ("PN?", "Nebula"), ("HII", "HII Region"), ("Radio(cm)", "Radio"),
+                                ("RedSG*", "Star"), ("IR", "Infrared"), ("", "Other")):
+            self.assertEqual(expected, solr_updater.map_simbad_type(otype))
+            # memoized lookups return the same answer
+            self.assertEqual(expected, solr_updater.map_simbad_type(otype))
+        for otype, expected in (("!*", "Galactic Object"), ("*Cl", "Star"), ("UvES", "UV"),
+                                ("RadioS", "Radio"), ("GPair", "Galaxy"), ("SNR", "Star"),
+                                ("QSO", "Other")):
+            self.assertEqual(expected, solr_updater.map_ned_type(otype))
+        # the tables agree with the rules
+        for otype, mapped in solr_updater.SIMBAD_TYPES.items():
+            self.assertEqual(mapped, solr_updater._simbad_class(otype))
+        for otype, mapped in solr_updater.NED_TYPES.items():
+            self.assertEqual(mapped, solr_updater._ned_class(otype))
+
+
+    def test_has_alnum(self):
+        self.assertTrue(solr_updater.has_alnum("a"))
+        self.assertTrue(solr_updater.has_alnum(["-", "", "- x"]))
+        self.assertTrue(solr_updater.has_alnum(["-", "\u00e9"]))
+        self.assertTrue(solr_updater.has_alnum(12))
+        self.assertFalse(solr_updater.has_alnum("-"))
+        self.assertFalse(solr_updater.has_alnum(["-", "_", " ; "]))
+        self.assertFalse(solr_updater.has_alnum([]))
+
+
+    def test_transform_stats(self):
+        self.assertEqual({}, solr_updater.transform_stats())
+        solr_updater.enable_transform_stats(log_interval=0.000001)
+        try:
+            record = {
+                "bibcode": "2020Test.........1A",
+                "id": 1,
+                "bib_data": {"title": ["a title"], "author": ["Doe, J."]},
+                "nonbib_data": {"simbad_objects": ["1 G", "2 **"], "bibgroup": ["CfA"]},
+            }
+            with patch.object(solr_updater.logger, "info") as info:
+                solr_updater.transform_json_record(record)
+                solr_updater.transform_json_record(record)
+                self.assertEqual(2, info.call_count)
+            stats = solr_updater.transform_stats()
+            self.assertEqual(2, stats["records"])
+            stages = stats["stages"]
+            for stage in ("bib_data", "id", "extract_data_pipeline", "get_timestamps",
+                          "links", "bibgroup", "boost_columns", "has"):
+                self.assertEqual(2, stages[stage]["calls"], stage)
+            self.assertEqual(2, stages["bib_data"]["size"] // 2)
+            self.assertEqual(1, stages["bibgroup"]["size"] // 2)
+            self.assertTrue(stages["extract_data_pipeline"]["seconds"] > 0)
+            # columns missing from the record are not counted
+            self.assertTrue("extract_fulltext" not in stages)
+        finally:
+            solr_updater.disable_transform_stats()
+        self.assertEqual({}, solr_updater.transform_stats())
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,4 +1,5 @@
 import copy
+import gzip
 import html
 import json
 import logging
@@ -23,9 +24,10 @@ from adsmsg import (
 from adsmsg.orcid_claims import OrcidClaims
 from adsputils import get_date
 from mock import MagicMock, Mock, patch
+from sqlalchemy import event, func
 
 from adsmp import app, tasks
-from adsmp.models import Base, ChangeLog, Records, SitemapInfo
+from adsmp.models import Base, ChangeLog, Records, SitemapFile, SitemapFileSite, SitemapInfo, SitemapRun, SitemapSyncedFile
 from adsmp.tasks import update_robots_files, update_sitemap_index
 
 logger = logging.getLogger(__name__)
@@ -478,7 +480,7 @@ class TestWorkers(unittest.TestCase):
             "adsmp.tasks.task_index_data_links_resolver.apply_async",
             wraps=unwind_task_index_data_links_resolver_apply_async,
         ), patch(
-            "requests.put", return_value=r, new_callable=CopyingMock
+            "requests.Session.put", return_value=r, new_callable=CopyingMock
         ) as p:
             tasks.task_index_records(
                 ["linkstest"],
@@ -487,12 +489,17 @@ class TestWorkers(unittest.TestCase):
                 update_links=True,
                 force=True,
             )
-            p.assert_called_with(
-                "http://localhost:8080/update",
-                data=json.dumps(
-                    [{"bibcode": "linkstest", "data_links_rows": [{"baz": 0}]}]
-                ),
-                headers={"Authorization": "Bearer api_token"},
+            self.assertEqual(p.call_count, 1)
+            args, kwargs = p.call_args
+            self.assertEqual(args, ("http://localhost:8080/update",))
+            self.assertEqual(
+                json.loads(kwargs["data"]),
+                [{"bibcode": "linkstest", "data_links_rows": [{"baz": 0}]}],
+            )
+            self.assertEqual(kwargs["headers"], {})
+            self.assertEqual(
+                self.app.datalinks_updater.session.headers["Authorization"],
+                "Bearer api_token",
             )
 
         rec = self.app.get_record(bibcode="linkstest")
@@ -518,7 +525,7 @@ class TestWorkers(unittest.TestCase):
             "adsmp.tasks.task_index_data_links_resolver.apply_async",
             wraps=unwind_task_index_data_links_resolver_apply_async,
         ), patch(
-            "requests.put", new_callable=CopyingMock
+            "requests.Session.put", new_callable=CopyingMock
         ) as p:
             tasks.task_index_records(
                 ["linkstest"],
@@ -618,7 +625,7 @@ class TestWorkers(unittest.TestCase):
             "adsmp.tasks.task_index_data_links_resolver.apply_async",
             wraps=unwind_task_index_data_links_resolver_apply_async,
         ), patch(
-            "requests.put", return_value=r, new_callable=CopyingMock
+            "requests.Session.put", return_value=r, new_callable=CopyingMock
         ) as p:
             # update with matching checksum and then update and ignore checksums
             tasks.task_index_records(
@@ -736,6 +743,27 @@ class TestWorkers(unittest.TestCase):
             self.app.get_record("bibcode")["scix_id"], "scix:6Z3P-MJ87-67A1"
         )
 
+    def test_task_boost_request_bulk_metrics(self):
+        self.app.update_storage("boost1", "bib_data", {"title": "boost test 1"})
+        self.app.update_storage("boost2", "bib_data", {"title": "boost test 2"})
+        metrics = {"boost1": {"bibcode": "boost1", "citation_num": 3}}
+        with patch.object(
+            self.app, "get_metrics_bulk", return_value=metrics
+        ) as bulk, patch.object(self.app, "get_metrics") as single, patch.object(
+            self.app, "forward_message"
+        ) as forward:
+            result = tasks.task_boost_request(["boost1", "boost2", "missing"])
+            # one metrics lookup for the whole batch, none per bibcode
+            bulk.assert_called_once_with(["boost1", "boost2"])
+            single.assert_not_called()
+            self.assertEqual(forward.call_count, 2)
+            messages = {
+                c[0][0]["bibcode"]: c[0][0] for c in forward.call_args_list
+            }
+            self.assertEqual(messages["boost1"]["metrics"], metrics["boost1"])
+            self.assertEqual(messages["boost2"]["metrics"], {})
+            self.assertFalse(result)
+
 
 class TestSitemapWorkflow(unittest.TestCase):
     """
@@ -935,7 +963,6 @@ class TestSitemapWorkflow(unittest.TestCase):
 
         # Verify result structure and content
         self.assertIsInstance(result, dict, "Should return result dictionary")
-        self.assertIn("total_processed", result, "Should include total_processed count")
         self.assertIn("invalid_removed", result, "Should include invalid_removed count")
         self.assertIn(
             "batches_processed", result, "Should include batches_processed count"
@@ -945,10 +972,7 @@ class TestSitemapWorkflow(unittest.TestCase):
         )
         self.assertIn("files_flagged", result, "Should include files_flagged count")
 
-        # Verify cleanup results - should have processed exactly our 5 records
-        self.assertEqual(
-            result["total_processed"], 5, "Should have processed exactly 5 records"
-        )
+        # Verify cleanup results
         self.assertEqual(
             result["invalid_removed"],
             3,
@@ -1127,9 +1151,6 @@ class TestSitemapWorkflow(unittest.TestCase):
             self.app.conf["SITEMAP_BOOTSTRAP_BATCH_SIZE"] = original_batch_size
 
         # Verify cleanup results
-        self.assertEqual(
-            result["total_processed"], 4, "Should have processed 4 records"
-        )
         self.assertEqual(
             result["invalid_removed"], 2, "Should have removed 2 invalid records"
         )
@@ -1257,10 +1278,7 @@ class TestSitemapWorkflow(unittest.TestCase):
             # Restore original batch size
             self.app.conf["SITEMAP_BOOTSTRAP_BATCH_SIZE"] = original_batch_size
 
-        # Verify cleanup results - should have processed exactly 3 records and removed 2 orphaned ones
-        self.assertEqual(
-            result["total_processed"], 3, "Should have processed exactly 3 records"
-        )
+        # Verify cleanup results - should have removed the 2 orphaned records
         self.assertEqual(
             result["invalid_removed"],
             2,
@@ -1297,6 +1315,67 @@ class TestSitemapWorkflow(unittest.TestCase):
                 "Orphaned records should be removed from sitemap",
             )
 
+    def test_task_cleanup_invalid_sitemaps_set_based(self):
+        """Invalid rows are found and deleted by the database, counters follow"""
+        cases = [
+            # bibcode, file, bib_data, status, record kept
+            ("2023SetCleanup..1A", "sitemap_bib_8.xml", None, "success", True),
+            ("2023SetCleanup..2B", "sitemap_bib_8.xml", '{"title": "x"}', "solr-failed", True),
+            ("2023SetCleanup..3C", "sitemap_bib_9.xml", '{"title": "x"}', "retrying", True),
+            ("2023SetCleanup..4D", "sitemap_bib_9.xml", '{"title": "x"}', "success", True),
+            ("2023SetCleanup..5E", "sitemap_bib_9.xml", '{"title": "x"}', None, True),
+            ("2023SetCleanup..6F", "sitemap_bib_9.xml", '{"title": "x"}', "metrics-failed", True),
+            ("2023SetCleanup..7G", "sitemap_bib_9.xml", '{"title": "x"}', "success", False),
+        ]
+        with self.app.session_scope() as session:
+            for bibcode, filename, bib_data, status, kept in cases:
+                record = Records(bibcode=bibcode, bib_data=bib_data, status=status,
+                                 bib_data_updated=get_date() - timedelta(days=1))
+                session.add(record)
+                session.flush()
+                session.add(SitemapInfo(bibcode=bibcode, record_id=record.id, sitemap_filename=filename,
+                                        update_flag=False))
+            session.commit()
+            session.query(Records).filter_by(bibcode="2023SetCleanup..7G").delete(synchronize_session=False)
+            self.app.refresh_sitemap_files(session)
+            session.commit()
+
+            # the SQL predicate agrees with should_include_in_sitemap
+            included = set(
+                b for (b,) in session.query(SitemapInfo.bibcode)
+                .outerjoin(Records, SitemapInfo.bibcode == Records.bibcode)
+                .filter(SitemapInfo.bibcode.like("2023SetCleanup%"), self.app.sitemap_inclusion_clause()))
+            for bibcode, _, bib_data, status, kept in cases:
+                expected = kept and self.app.should_include_in_sitemap(
+                    {"bibcode": bibcode, "has_bib_data": bib_data is not None, "status": status})
+                self.assertEqual(bibcode in included, expected, bibcode)
+
+        original_batch_size = self.app.conf.get("SITEMAP_BOOTSTRAP_BATCH_SIZE", 50000)
+        self.app.conf["SITEMAP_BOOTSTRAP_BATCH_SIZE"] = 1
+        try:
+            with patch.object(self.app, "delete_sitemap_files") as mock_delete_files, \
+                    patch.object(self.app, "should_include_in_sitemap") as mock_include:
+                result = tasks.task_cleanup_invalid_sitemaps()
+                # no row goes through python
+                self.assertFalse(mock_include.called)
+        finally:
+            self.app.conf["SITEMAP_BOOTSTRAP_BATCH_SIZE"] = original_batch_size
+
+        self.assertEqual(result["invalid_removed"], 4)
+        self.assertEqual(result["batches_processed"], 4)
+        self.assertEqual(result["files_flagged"], 1)
+        self.assertEqual(mock_delete_files.call_args[0][0], {"sitemap_bib_8.xml"})
+        with self.app.session_scope() as session:
+            self.assertEqual(
+                sorted(b for (b,) in session.query(SitemapInfo.bibcode).filter(
+                    SitemapInfo.bibcode.like("2023SetCleanup%"))),
+                ["2023SetCleanup..4D", "2023SetCleanup..5E", "2023SetCleanup..6F"])
+            files = dict(session.query(SitemapFile.filename, SitemapFile.record_count))
+            self.assertNotIn("sitemap_bib_8.xml", files)
+            self.assertEqual(files["sitemap_bib_9.xml"], 3)
+            self.assertEqual(session.query(SitemapInfo).filter_by(
+                sitemap_filename="sitemap_bib_9.xml", update_flag=True).count(), 1)
+
     def test_task_cleanup_invalid_sitemaps_orphaned_entries_verification(self):
         """Test verification that remaining entries are valid after orphan cleanup (part 3)"""
 
@@ -1459,7 +1538,6 @@ class TestSitemapWorkflow(unittest.TestCase):
             3,
             "Should remove 3 invalid records (None, solr-failed, retrying)",
         )
-        self.assertEqual(result["total_processed"], 5, "Should process all 5 records")
         self.assertTrue(
             result["files_regenerated"], "Should indicate files need regeneration"
         )
@@ -2126,6 +2204,136 @@ class TestSitemapWorkflow(unittest.TestCase):
                 "Should not include solr-failed record",
             )
 
+    def test_flag_sitemap_files(self):
+        """One row per file is flagged in a single statement, files already flagged are left alone"""
+        with self.app.session_scope() as session:
+            for n, (filename, flag) in enumerate([("sitemap_bib_1.xml", False), ("sitemap_bib_1.xml", False),
+                                                  ("sitemap_bib_2.xml", False), ("sitemap_bib_2.xml", True),
+                                                  ("sitemap_bib_3.xml", False)]):
+                session.add(SitemapInfo(bibcode="2023Flag.%04d" % n, record_id=n + 1, update_flag=flag,
+                                        sitemap_filename=filename))
+            session.commit()
+
+            statements = []
+            engine = session.get_bind()
+            listener = lambda *args: statements.append(args[2])
+            event.listen(engine, "before_cursor_execute", listener)
+            try:
+                flagged = self.app.flag_sitemap_files(
+                    session, ["sitemap_bib_1.xml", "sitemap_bib_2.xml", "sitemap_bib_3.xml",
+                              "sitemap_bib_9.xml", None])
+            finally:
+                event.remove(engine, "before_cursor_execute", listener)
+            session.commit()
+            self.assertEqual(flagged, 2)
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(
+                sorted(session.query(SitemapInfo.bibcode).filter_by(update_flag=True)),
+                [("2023Flag.0000",), ("2023Flag.0003",), ("2023Flag.0004",)])
+            # already flagged now
+            self.assertEqual(self.app.flag_one_row_for_filename(session, "sitemap_bib_1.xml"), 0)
+
+    def test_task_manage_sitemap_compact(self):
+        """Sparse files are merged whole into each other, full files and the last file are left alone"""
+        layout = {1: 10, 2: 2, 3: 5, 4: 3, 5: 4}
+        with self.app.session_scope() as session:
+            n = 0
+            for index, count in layout.items():
+                for _ in range(count):
+                    n += 1
+                    session.add(SitemapInfo(bibcode="2023Compact.%04d" % n, record_id=n, update_flag=False,
+                                            sitemap_filename="sitemap_bib_%d.xml" % index))
+            self.app.refresh_sitemap_files(session)
+            session.commit()
+            before = dict(session.query(SitemapInfo.bibcode, SitemapInfo.sitemap_filename))
+
+        self.assertEqual(
+            self.app.plan_sitemap_compaction({"a.xml": 2, "b.xml": 5, "c.xml": 3, "d.xml": 10}, 10, 0.75),
+            {"a.xml": "b.xml", "c.xml": "b.xml"})
+
+        original_max_records = self.app.conf.get("MAX_RECORDS_PER_SITEMAP", 50000)
+        self.app.conf["MAX_RECORDS_PER_SITEMAP"] = 10
+        try:
+            with patch.object(self.app, "delete_sitemap_files") as mock_delete_files:
+                tasks.task_manage_sitemap([], "compact")
+        finally:
+            self.app.conf["MAX_RECORDS_PER_SITEMAP"] = original_max_records
+
+        self.assertEqual(mock_delete_files.call_args[0][0], {"sitemap_bib_2.xml", "sitemap_bib_4.xml"})
+        with self.app.session_scope() as session:
+            self.assertEqual(dict(session.query(SitemapFile.filename, SitemapFile.record_count)),
+                             {"sitemap_bib_1.xml": 10, "sitemap_bib_3.xml": 10, "sitemap_bib_5.xml": 4})
+            after = dict(session.query(SitemapInfo.bibcode, SitemapInfo.sitemap_filename))
+            moved = set(b for b in before if before[b] != after[b])
+            # only the rows of the emptied files changed file
+            self.assertEqual(moved, set(b for b in before if before[b] in ("sitemap_bib_2.xml", "sitemap_bib_4.xml")))
+            self.assertEqual(
+                [f for (f,) in session.query(SitemapInfo.sitemap_filename).filter_by(update_flag=True)],
+                ["sitemap_bib_3.xml"])
+
+        # nothing left to do
+        with self.app.session_scope() as session:
+            self.assertEqual(self.app.compact_sitemap_files(session, 0.75, max_records=10), (0, set(), set()))
+
+    def test_sitemap_files_counters(self):
+        """sitemap_files follows add, remove, bootstrap and generation without scanning the sitemap table"""
+        bibcodes = [r["bibcode"] for r in self.test_records]
+
+        def files():
+            with self.app.session_scope() as session:
+                return {
+                    f.filename: f.record_count
+                    for f in session.query(SitemapFile).order_by(SitemapFile.file_index)
+                }
+
+        original_max_records = self.app.conf.get("MAX_RECORDS_PER_SITEMAP", 50000)
+        self.app.conf["MAX_RECORDS_PER_SITEMAP"] = 3
+        try:
+            tasks.task_manage_sitemap(bibcodes[:2], "add")
+            self.assertEqual(files(), {"sitemap_bib_1.xml": 2})
+            tasks.task_manage_sitemap(bibcodes[2:], "add")
+            self.assertEqual(files(), {"sitemap_bib_1.xml": 3, "sitemap_bib_2.xml": 1})
+            # existing records don't change the counts
+            tasks.task_manage_sitemap(bibcodes, "force-update")
+            self.assertEqual(files(), {"sitemap_bib_1.xml": 3, "sitemap_bib_2.xml": 1})
+
+            # state comes from sitemap_files alone
+            with self.app.session_scope() as session:
+                with patch.object(self.app, "refresh_sitemap_files") as refresh:
+                    state = self.app.get_current_sitemap_state(session)
+                self.assertFalse(refresh.called)
+            self.assertEqual(state, {"filename": "sitemap_bib_2.xml", "count": 1, "index": 2})
+
+            with tempfile.TemporaryDirectory() as temp_dir:
+                self.app.conf["SITEMAP_DIR"] = temp_dir
+                tasks.task_manage_sitemap(bibcodes[:1], "remove")
+                self.assertEqual(files(), {"sitemap_bib_1.xml": 2, "sitemap_bib_2.xml": 1})
+                # emptied file is dropped, the next records go back to file 1
+                tasks.task_manage_sitemap(bibcodes[3:], "remove")
+                self.assertEqual(files(), {"sitemap_bib_1.xml": 2})
+                with self.app.session_scope() as session:
+                    self.assertEqual(self.app.get_current_sitemap_state(session)["filename"], "sitemap_bib_1.xml")
+
+                with self.app.session_scope() as session:
+                    ids = [
+                        x.id
+                        for x in session.query(SitemapInfo).filter(SitemapInfo.sitemap_filename == "sitemap_bib_1.xml")
+                    ]
+                tasks.task_generate_single_sitemap("sitemap_bib_1.xml", ids)
+                with self.app.session_scope() as session:
+                    generated = session.query(SitemapFile).filter_by(filename="sitemap_bib_1.xml").one()
+                    self.assertIsNotNone(generated.last_generated)
+                    self.assertEqual(generated.record_count, 2)
+
+                # delete-table empties both tables, bootstrap fills them again
+                with patch.object(self.app, "backup_sitemap_files"):
+                    tasks.task_manage_sitemap([], "delete-table")
+                self.assertEqual(files(), {})
+                tasks.task_manage_sitemap([], "bootstrap")
+                self.assertEqual(files(), {"sitemap_bib_1.xml": 3, "sitemap_bib_2.xml": 1})
+        finally:
+            self.app.conf["MAX_RECORDS_PER_SITEMAP"] = original_max_records
+
     def test_task_manage_sitemap_bootstrap_action_batch_processing(self):
         """Test task_manage_sitemap bootstrap action with batch processing"""
 
@@ -2208,6 +2416,118 @@ class TestSitemapWorkflow(unittest.TestCase):
             self.app.conf["SITEMAP_BOOTSTRAP_BATCH_SIZE"] = original_batch_size
             self.app.conf["MAX_RECORDS_PER_SITEMAP"] = original_max_records_per_sitemap
 
+    def test_task_update_sitemaps_auto(self):
+        """Changed records are added one chunk after the other, flagged and old ones are left out"""
+        now = get_date()
+        with self.app.session_scope() as session:
+            session.query(SitemapInfo).delete(synchronize_session=False)
+            session.query(Records).delete(synchronize_session=False)
+            for i, hours in enumerate([1, 2, 3, 4, 5, 50]):
+                session.add(Records(bibcode="2023Auto...123..%03dA" % i, bib_data='{"title": "x"}',
+                                    bib_data_updated=now - timedelta(hours=hours), status="success"))
+            session.flush()
+            record = session.query(Records).filter_by(bibcode="2023Auto...123..004A").one()
+            session.add(SitemapInfo(bibcode=record.bibcode, record_id=record.id, update_flag=True,
+                                    sitemap_filename="sitemap_bib_1.xml"))
+            session.commit()
+
+        cutoff = (now - timedelta(days=1)).isoformat()
+        original = self.app.conf.get("SITEMAP_AUTO_CHUNK_SIZE")
+        self.app.conf["SITEMAP_AUTO_CHUNK_SIZE"] = 2
+        try:
+            # a chunk fails: the watermark is not moved
+            with patch("adsmp.tasks.task_manage_sitemap", side_effect=[None, Exception("db gone")]):
+                with self.assertRaises(Exception):
+                    tasks.task_update_sitemaps_auto(cutoff, now.isoformat())
+            self.assertIsNone(self.app.get_sitemap_auto_watermark())
+
+            with patch("adsmp.tasks.task_manage_sitemap", wraps=tasks.task_manage_sitemap) as manage:
+                total = tasks.task_update_sitemaps_auto(cutoff, now.isoformat())
+        finally:
+            self.app.conf["SITEMAP_AUTO_CHUNK_SIZE"] = original
+        self.assertEqual(total, 4)
+        # the next run starts from this one
+        self.assertEqual(self.app.get_sitemap_auto_watermark(), now)
+        self.assertEqual([c[0] for c in manage.call_args_list],
+                         [(["2023Auto...123..000A", "2023Auto...123..001A"], "add"),
+                          (["2023Auto...123..002A", "2023Auto...123..003A"], "add")])
+        with self.app.session_scope() as session:
+            self.assertEqual(
+                sorted(r.bibcode for r in session.query(SitemapInfo.bibcode)),
+                ["2023Auto...123..%03dA" % i for i in range(5)],
+            )
+
+    def test_task_manage_sitemap_parallel_bootstrap(self):
+        """Each id range fills its own block of files, the last range submits the files update"""
+        test_bibcodes = [f"2023BootPara..{i:03d}..{i:03d}A" for i in range(1, 201)]
+        with self.app.session_scope() as session:
+            session.query(SitemapInfo).delete(synchronize_session=False)
+            session.query(Records).delete(synchronize_session=False)
+            session.commit()
+            for i, bibcode in enumerate(test_bibcodes):
+                record = Records()
+                record.bibcode = bibcode
+                record.bib_data = f'{{"title": "Test Parallel Bootstrap {i}"}}'
+                record.bib_data_updated = get_date() - timedelta(days=1)
+                record.solr_processed = get_date() - timedelta(hours=12)
+                record.status = "success" if i % 10 != 0 else "solr-failed"
+                session.add(record)
+            session.commit()
+
+        original = {k: self.app.conf.get(k) for k in ("SITEMAP_BOOTSTRAP_BATCH_SIZE", "MAX_RECORDS_PER_SITEMAP",
+                                                      "SITEMAP_BOOTSTRAP_FILES_PER_RANGE")}
+        self.app.conf["SITEMAP_BOOTSTRAP_BATCH_SIZE"] = 30
+        self.app.conf["MAX_RECORDS_PER_SITEMAP"] = 50
+        self.app.conf["SITEMAP_BOOTSTRAP_FILES_PER_RANGE"] = 2
+        try:
+            sent = []
+            with patch("adsmp.tasks.task_bootstrap_sitemap_range.apply_async",
+                       side_effect=lambda args, kwargs: sent.append((args, kwargs))):
+                tasks.task_manage_sitemap([], "parallel-bootstrap")
+            # 100 ids per range, two files each
+            self.assertEqual([args[2] for args, _ in sent], [1, 3])
+
+            with patch("adsmp.tasks.task_update_sitemap_files.apply_async") as mock_update:
+                # ranges may run in any order
+                for args, kwargs in reversed(sent):
+                    self.assertFalse(mock_update.called)
+                    tasks.task_bootstrap_sitemap_range(*args, **kwargs)
+                self.assertEqual(mock_update.call_count, 1)
+        finally:
+            for k, v in original.items():
+                self.app.conf[k] = v
+
+        expected = {"sitemap_bib_1.xml": 50, "sitemap_bib_2.xml": 40,
+                    "sitemap_bib_3.xml": 50, "sitemap_bib_4.xml": 40}
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(SitemapInfo).filter_by(update_flag=True).count(), 180)
+            counts = dict(session.query(SitemapInfo.sitemap_filename, func.count(SitemapInfo.id))
+                          .group_by(SitemapInfo.sitemap_filename))
+            self.assertEqual(counts, expected)
+            self.assertEqual(dict(session.query(SitemapFile.filename, SitemapFile.record_count)), expected)
+            # files follow the id order
+            first_ids = [session.query(func.min(SitemapInfo.record_id)).filter_by(sitemap_filename=f).scalar()
+                         for f in sorted(expected)]
+            self.assertEqual(first_ids, sorted(first_ids))
+
+        # a second bootstrap does nothing
+        with patch("adsmp.tasks.task_bootstrap_sitemap_range.apply_async") as mock_range:
+            tasks.task_manage_sitemap([], "parallel-bootstrap")
+            self.assertFalse(mock_range.called)
+
+    def test_task_bootstrap_sitemap_range_failed(self):
+        """A failed range is recorded on the run, the files are not generated"""
+        run_id = self.app.start_sitemap_run(2)
+        with patch("adsmp.tasks.task_update_sitemap_files.apply_async") as mock_update:
+            with patch("adsmp.tasks.bootstrap_sitemap_range", side_effect=Exception("db gone")):
+                with self.assertRaises(Exception):
+                    tasks.task_bootstrap_sitemap_range(0, 100, 1, run_id=run_id)
+            tasks.task_bootstrap_sitemap_range(100, 200, 3, run_id=run_id)
+            self.assertFalse(mock_update.called)
+        run = self.app.get_sitemap_run(run_id)
+        self.assertEqual((run["pending_files"], run["failed_files"]), (1, 1))
+        self.assertIsNone(run["finished"])
+
     def test_task_update_sitemap_files_orchestration(self):
         """
         Test the complete task_update_sitemap_files workflow orchestration
@@ -2254,10 +2574,174 @@ class TestSitemapWorkflow(unittest.TestCase):
                         "Should have at least one sitemap file to generate",
                     )
 
-                    # Verify task_generate_sitemap_index was called
-                    self.assertTrue(
-                        mock_index.called, "Should have spawned index generation task"
+                    # The index is left to the last file task of the run
+                    self.assertFalse(
+                        mock_index.called, "Index should wait for the file tasks"
                     )
+                    run_id = mock_generate.call_args[1]["kwargs"]["run_id"]
+                    with self.app.session_scope() as session:
+                        run = session.query(SitemapRun).filter_by(id=run_id).one()
+                        self.assertEqual(run.total_files, mock_generate.call_count)
+                        self.assertEqual(run.pending_files, mock_generate.call_count)
+
+    def test_task_update_sitemap_files_index_after_last_file(self):
+        """The index is generated once, when the last file task of the run finishes"""
+        bibcodes = [r["bibcode"] for r in self.test_records]
+        original_max_records = self.app.conf.get("MAX_RECORDS_PER_SITEMAP", 50000)
+        self.app.conf["MAX_RECORDS_PER_SITEMAP"] = 1
+        try:
+            tasks.task_manage_sitemap(bibcodes, "add")
+        finally:
+            self.app.conf["MAX_RECORDS_PER_SITEMAP"] = original_max_records
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.app.conf["SITEMAP_DIR"] = temp_dir
+            sent = []
+            with patch("adsmp.tasks.task_generate_single_sitemap.apply_async",
+                       side_effect=lambda args, kwargs: sent.append((args, kwargs))), \
+                    patch("adsmp.tasks.task_generate_sitemap_index.apply_async") as mock_index:
+                tasks.task_update_sitemap_files()
+                self.assertEqual(len(sent), 4)
+                for args, kwargs in sent[:3]:
+                    tasks.task_generate_single_sitemap(*args, **kwargs)
+                    self.assertFalse(mock_index.called)
+                tasks.task_generate_single_sitemap(*sent[3][0], **sent[3][1])
+                self.assertEqual(mock_index.call_count, 1)
+                # a duplicate delivery doesn't build it again
+                tasks.task_generate_single_sitemap(*sent[3][0], **sent[3][1])
+                self.assertEqual(mock_index.call_count, 1)
+
+            with self.app.session_scope() as session:
+                run = session.query(SitemapRun).one()
+                self.assertEqual(run.pending_files, 0)
+                self.assertIsNotNone(run.finished)
+
+    def test_task_update_sitemap_files_failed_run(self):
+        """A failed file leaves the run unfinished, the next update closes it once stale"""
+        bibcodes = [r["bibcode"] for r in self.test_records]
+        original_max_records = self.app.conf.get("MAX_RECORDS_PER_SITEMAP", 50000)
+        self.app.conf["MAX_RECORDS_PER_SITEMAP"] = 1
+        try:
+            tasks.task_manage_sitemap(bibcodes, "add")
+        finally:
+            self.app.conf["MAX_RECORDS_PER_SITEMAP"] = original_max_records
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.app.conf["SITEMAP_DIR"] = temp_dir
+            sent = []
+            with patch("adsmp.tasks.task_generate_single_sitemap.apply_async",
+                       side_effect=lambda args, kwargs: sent.append((args, kwargs))), \
+                    patch("adsmp.tasks.task_generate_sitemap_index.apply_async") as mock_index:
+                tasks.task_update_sitemap_files()
+                run_id = sent[0][1]["run_id"]
+                failed_file = sent[0][0]
+                with patch("adsmp.tasks.generate_sitemap_file", side_effect=Exception("disk full")):
+                    with self.assertRaises(Exception):
+                        tasks.task_generate_single_sitemap(*sent[0][0], **sent[0][1])
+                for args, kwargs in sent[1:]:
+                    tasks.task_generate_single_sitemap(*args, **kwargs)
+                # the failed file is not counted as done
+                self.assertFalse(mock_index.called)
+                run = self.app.get_sitemap_run(run_id)
+                self.assertEqual((run["pending_files"], run["failed_files"]), (1, 1))
+                self.assertIsNone(run["finished"])
+
+                # not stale yet: left alone
+                del sent[:]
+                tasks.task_update_sitemap_files()
+                self.assertFalse(mock_index.called)
+                self.assertIsNone(self.app.get_sitemap_run(run_id)["finished"])
+
+                # past SITEMAP_RUN_TIMEOUT_MINUTES the run is closed and the index regenerated
+                with self.app.session_scope() as session:
+                    session.query(SitemapRun).update(
+                        {SitemapRun.created: get_date() - timedelta(days=2)}, synchronize_session=False)
+                    session.commit()
+                del sent[:]
+                tasks.task_update_sitemap_files()
+                self.assertEqual(mock_index.call_count, 1)
+                self.assertIsNotNone(self.app.get_sitemap_run(run_id)["finished"])
+                # the failed file is sent again
+                self.assertEqual([args for args, _ in sent], [failed_file])
+
+    def test_task_generate_single_sitemap_skips_unchanged(self):
+        """A file with the same content is not rewritten, a changed one replaces it atomically"""
+        bibcodes = [r["bibcode"] for r in self.test_records]
+        tasks.task_manage_sitemap(bibcodes, "add")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.app.conf["SITEMAP_DIR"] = temp_dir
+            ads_file = os.path.join(temp_dir, "ads", "sitemap_bib_1.xml")
+            self.assertEqual(tasks.task_generate_single_sitemap("sitemap_bib_1.xml"),
+                             {"written": 2, "skipped": 0})
+            with self.app.session_scope() as session:
+                generated = session.query(SitemapFileSite).filter_by(site="ads").one().generated
+                content_hash = session.query(SitemapFile).filter_by(filename="sitemap_bib_1.xml").one().content_hash
+            self.assertIsNotNone(content_hash)
+            os.utime(ads_file, (1000000000, 1000000000))
+
+            # same records, nothing published, still counted on the run
+            run_id = self.app.start_sitemap_run(1)
+            with patch("adsmp.tasks.task_generate_sitemap_index.apply_async") as mock_index:
+                self.assertEqual(tasks.task_generate_single_sitemap("sitemap_bib_1.xml", run_id=run_id),
+                                 {"written": 0, "skipped": 2})
+                self.assertTrue(mock_index.called)
+            self.assertEqual(os.stat(ads_file).st_mtime, 1000000000)
+            run = self.app.get_sitemap_run(run_id)
+            self.assertEqual((run["written_files"], run["skipped_files"]), (0, 2))
+            with self.app.session_scope() as session:
+                self.assertEqual(session.query(SitemapFileSite).filter_by(site="ads").one().generated, generated)
+                self.assertEqual(session.query(SitemapInfo).filter_by(update_flag=True).count(), 0)
+
+            # a changed record rewrites the file
+            with self.app.session_scope() as session:
+                info = session.query(SitemapInfo).filter_by(bibcode=bibcodes[0]).one()
+                info.bib_data_updated = datetime(2020, 1, 1, tzinfo=timezone.utc)
+                session.commit()
+            self.assertEqual(tasks.task_generate_single_sitemap("sitemap_bib_1.xml"),
+                             {"written": 2, "skipped": 0})
+            self.assertNotEqual(os.stat(ads_file).st_mtime, 1000000000)
+            with open(ads_file) as f:
+                self.assertIn("2020-01-01", f.read())
+            with self.app.session_scope() as session:
+                self.assertNotEqual(
+                    session.query(SitemapFile).filter_by(filename="sitemap_bib_1.xml").one().content_hash,
+                    content_hash)
+            for site_key in ("ads", "scix"):
+                self.assertEqual(os.listdir(os.path.join(temp_dir, site_key)), ["sitemap_bib_1.xml"])
+
+    def test_task_update_sitemap_files_sends_filenames(self):
+        """Only the filenames are sent, the worker streams the rows of the file in id order"""
+        bibcodes = [r["bibcode"] for r in self.test_records]
+        original_max_records = self.app.conf.get("MAX_RECORDS_PER_SITEMAP", 50000)
+        self.app.conf["MAX_RECORDS_PER_SITEMAP"] = 2
+        try:
+            tasks.task_manage_sitemap(bibcodes, "add")
+        finally:
+            self.app.conf["MAX_RECORDS_PER_SITEMAP"] = original_max_records
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.app.conf["SITEMAP_DIR"] = temp_dir
+            with patch("adsmp.tasks.task_generate_single_sitemap.apply_async") as mock_generate, \
+                    patch("adsmp.tasks.task_generate_sitemap_index.apply_async"):
+                tasks.task_update_sitemap_files()
+            self.assertEqual(
+                [c[1]["args"] for c in mock_generate.call_args_list],
+                [("sitemap_bib_1.xml",), ("sitemap_bib_2.xml",)],
+            )
+
+            self.assertTrue(tasks.task_generate_single_sitemap("sitemap_bib_2.xml"))
+            with open(os.path.join(temp_dir, "ads", "sitemap_bib_2.xml")) as f:
+                content = f.read()
+            self.assertLess(content.index(bibcodes[2]), content.index(bibcodes[3]))
+            self.assertNotIn(bibcodes[0], content)
+
+            with self.app.session_scope() as session:
+                flagged = sorted(
+                    x.sitemap_filename for x in session.query(SitemapInfo).filter(SitemapInfo.update_flag == True)
+                )
+            self.assertEqual(flagged, ["sitemap_bib_1.xml", "sitemap_bib_1.xml"])
+            self.assertFalse(tasks.task_generate_single_sitemap("sitemap_bib_9.xml"))
 
     def test_task_update_sitemap_files_full_workflow(self):
         """Test the complete task_update_sitemap_files workflow with actual file generation"""
@@ -2944,6 +3428,102 @@ class TestSitemapWorkflow(unittest.TestCase):
             # Restore original configuration
             self.app.conf["MAX_RECORDS_PER_SITEMAP"] = original_max_records
 
+    def test_task_generate_single_sitemap_gzip(self):
+        """With SITEMAP_GZIP the files are written as .xml.gz and listed as such in the index"""
+        with self.app.session_scope() as session:
+            record_ids = []
+            for record in session.query(Records).order_by(Records.id).all():
+                info = SitemapInfo(
+                    bibcode=record.bibcode,
+                    record_id=record.id,
+                    sitemap_filename="sitemap_bib_1.xml",
+                    bib_data_updated=record.bib_data_updated,
+                    update_flag=True,
+                )
+                session.add(info)
+                session.flush()
+                record_ids.append(info.id)
+            session.commit()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.app.conf["SITEMAP_DIR"] = temp_dir
+            # plain version from before the switch
+            tasks.task_generate_single_sitemap("sitemap_bib_1.xml", record_ids)
+            plain_file = os.path.join(temp_dir, "ads", "sitemap_bib_1.xml")
+            with open(plain_file, "r", encoding="utf-8") as f:
+                plain_content = f.read()
+
+            self.app.conf["SITEMAP_GZIP"] = True
+            try:
+                self.assertTrue(tasks.task_generate_single_sitemap("sitemap_bib_1.xml", record_ids))
+                for site_key in ("ads", "scix"):
+                    gz_file = os.path.join(temp_dir, site_key, "sitemap_bib_1.xml.gz")
+                    with gzip.open(gz_file, "rt", encoding="utf-8") as f:
+                        content = f.read()
+                    self.assertEqual(content.count("<url>"), 4)
+                    self.assertTrue(content.rstrip().endswith("</urlset>"))
+                    # the plain copy is gone
+                    self.assertFalse(os.path.exists(os.path.join(temp_dir, site_key, "sitemap_bib_1.xml")))
+                    if site_key == "ads":
+                        self.assertEqual(content, plain_content)
+
+                self.assertTrue(update_sitemap_index())
+                with open(os.path.join(temp_dir, "ads", "sitemap_index.xml"), "r") as f:
+                    self.assertIn("https://ui.adsabs.harvard.edu/sitemap/sitemap_bib_1.xml.gz", f.read())
+
+                self.app.delete_sitemap_files({"sitemap_bib_1.xml"}, temp_dir)
+                self.assertFalse(os.path.exists(os.path.join(temp_dir, "ads", "sitemap_bib_1.xml.gz")))
+            finally:
+                self.app.conf["SITEMAP_GZIP"] = False
+
+    def test_task_generate_single_sitemap_single_pass(self):
+        """Every record is escaped once for all sites, a failing site doesn't stop the others"""
+        with self.app.session_scope() as session:
+            record_ids = []
+            for record in session.query(Records).order_by(Records.id).all():
+                info = SitemapInfo(
+                    bibcode=record.bibcode,
+                    record_id=record.id,
+                    sitemap_filename="sitemap_bib_1.xml",
+                    bib_data_updated=record.bib_data_updated,
+                    update_flag=True,
+                )
+                session.add(info)
+                session.flush()
+                record_ids.append(info.id)
+            session.commit()
+
+        sites = dict(self.app.conf["SITES"])
+        sites["mirror"] = {"name": "Mirror", "abs_url_pattern": "https://mirror.example.org/abs/{bibcode}"}
+        sites["broken"] = {"name": "Broken", "abs_url_pattern": "https://broken.example.org/abs/{bibcode}"}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.app.conf["SITEMAP_DIR"] = temp_dir
+            # a file where the site directory should be
+            with open(os.path.join(temp_dir, "broken"), "w") as f:
+                f.write("")
+            original_sites = self.app.conf["SITES"]
+            self.app.conf["SITES"] = sites
+            try:
+                with patch("adsmp.tasks.html.escape", wraps=html.escape) as escape:
+                    self.assertTrue(tasks.task_generate_single_sitemap("sitemap_bib_1.xml", record_ids))
+                self.assertEqual(escape.call_count, 4)
+            finally:
+                self.app.conf["SITES"] = original_sites
+
+            for site_key in ("ads", "scix", "mirror"):
+                with open(os.path.join(temp_dir, site_key, "sitemap_bib_1.xml"), "r") as f:
+                    content = f.read()
+                self.assertEqual(content.count("<url>"), 4)
+                for record in self.test_records:
+                    self.assertIn(
+                        "<lastmod>%s</lastmod>" % record["bib_data_updated"].date().isoformat(), content
+                    )
+            with open(os.path.join(temp_dir, "mirror", "sitemap_bib_1.xml"), "r") as f:
+                self.assertIn("https://mirror.example.org/abs/2023ApJ...123..456A", f.read())
+
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(SitemapInfo).filter(SitemapInfo.update_flag == True).count(), 0)
+
     def test_task_update_robots_files_creation(self):
         """Test robots.txt file creation for multiple sites with content validation"""
 
@@ -3386,6 +3966,67 @@ class TestSitemapWorkflow(unittest.TestCase):
                 )
                 session.commit()
 
+    def test_update_sitemap_index_from_database(self):
+        """Index entries come from sitemap_file_sites, the files are not looked at"""
+        bibcodes = [r["bibcode"] for r in self.test_records]
+        original_max_records = self.app.conf.get("MAX_RECORDS_PER_SITEMAP", 50000)
+        self.app.conf["MAX_RECORDS_PER_SITEMAP"] = 2
+        try:
+            tasks.task_manage_sitemap(bibcodes, "add")
+        finally:
+            self.app.conf["MAX_RECORDS_PER_SITEMAP"] = original_max_records
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.app.conf["SITEMAP_DIR"] = temp_dir
+            self.assertTrue(tasks.task_generate_single_sitemap("sitemap_bib_1.xml"))
+            self.assertTrue(tasks.task_generate_single_sitemap("sitemap_bib_2.xml"))
+
+            with self.app.session_scope() as session:
+                outputs = session.query(SitemapFileSite).order_by(SitemapFileSite.filename, SitemapFileSite.site).all()
+                self.assertEqual(
+                    [(x.filename, x.site) for x in outputs],
+                    [("sitemap_bib_1.xml", "ads"), ("sitemap_bib_1.xml", "scix"),
+                     ("sitemap_bib_2.xml", "ads"), ("sitemap_bib_2.xml", "scix")],
+                )
+                for x in outputs:
+                    self.assertEqual(x.byte_size, os.path.getsize(os.path.join(temp_dir, x.site, x.output_filename)))
+                # lastmod comes from the recorded time, not the file
+                session.query(SitemapFileSite).filter_by(filename="sitemap_bib_2.xml").update(
+                    {"generated": datetime(2020, 5, 17, tzinfo=timezone.utc)}
+                )
+                session.commit()
+
+            with patch("adsmp.tasks.os.path.getmtime", side_effect=AssertionError("stat")):
+                self.assertTrue(update_sitemap_index())
+            with open(os.path.join(temp_dir, "ads", "sitemap_index.xml")) as f:
+                content = f.read()
+            self.assertIn("<loc>https://ui.adsabs.harvard.edu/sitemap/sitemap_bib_1.xml</loc>", content)
+            self.assertIn(
+                "<loc>https://ui.adsabs.harvard.edu/sitemap/sitemap_bib_2.xml</loc>\n"
+                "            <lastmod>2020-05-17</lastmod>",
+                content,
+            )
+
+            # removing a whole file drops it from the index
+            tasks.task_manage_sitemap(bibcodes[2:], "remove")
+            self.assertTrue(update_sitemap_index())
+            with open(os.path.join(temp_dir, "scix", "sitemap_index.xml")) as f:
+                self.assertNotIn("sitemap_bib_2.xml", f.read())
+            with self.app.session_scope() as session:
+                self.assertEqual(session.query(SitemapFileSite).filter_by(filename="sitemap_bib_2.xml").count(), 0)
+
+            # a file written before sitemap_file_sites existed is picked up from disk once
+            with self.app.session_scope() as session:
+                session.query(SitemapFileSite).delete()
+                session.commit()
+            self.assertTrue(update_sitemap_index())
+            with self.app.session_scope() as session:
+                self.assertEqual(session.query(SitemapFileSite).count(), 2)
+            with patch("adsmp.tasks.os.path.getmtime", side_effect=AssertionError("stat")):
+                self.assertTrue(update_sitemap_index())
+            with open(os.path.join(temp_dir, "ads", "sitemap_index.xml")) as f:
+                self.assertIn("sitemap_bib_1.xml", f.read())
+
     def test_task_generate_sitemap_index(self):
         """Test the Celery task wrapper for sitemap index generation"""
 
@@ -3623,6 +4264,34 @@ class TestSitemapWorkflow(unittest.TestCase):
                 ).delete(synchronize_session=False)
                 session.commit()
 
+    def test_task_sync_sitemaps(self):
+        """The index generation submits the sync, which uploads the site directories"""
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sitemap_dir = os.path.join(temp_dir, "sitemap")
+            os.makedirs(os.path.join(sitemap_dir, "ads"))
+            with open(os.path.join(sitemap_dir, "ads", "sitemap_bib.0001.xml"), "w") as f:
+                f.write("<urlset></urlset>")
+            saved = {k: self.app.conf.get(k) for k in ("SITEMAP_DIR", "SITEMAP_S3_SYNC_ENABLED", "SITEMAP_S3_BUCKET")}
+            self.app.conf["SITEMAP_DIR"] = sitemap_dir
+            self.app.conf["SITEMAP_S3_SYNC_ENABLED"] = True
+            self.app.conf["SITEMAP_S3_BUCKET"] = "file://" + os.path.join(temp_dir, "bucket")
+            try:
+                with patch("adsmp.tasks.update_sitemap_index", return_value=True), \
+                        patch.object(tasks.task_sync_sitemaps, "apply_async") as sync:
+                    tasks.task_generate_sitemap_index()
+                self.assertTrue(sync.called)
+
+                result = tasks.task_sync_sitemaps()
+                self.assertEqual(result["uploaded"], 1)
+                self.assertTrue(os.path.exists(os.path.join(temp_dir, "bucket", "ads", "sitemap_bib.0001.xml")))
+                self.assertEqual(tasks.task_sync_sitemaps()["uploaded"], 0)
+            finally:
+                self.app.conf.update(saved)
+                with self.app.session_scope() as session:
+                    session.query(SitemapSyncedFile).delete(synchronize_session=False)
+                    session.commit()
+
     def test_force_update_workflow(self):
         """Test the complete force-update workflow with timestamp updates"""
         test_bibcode = "2023Test.....1....A"
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import datetime
+import gzip
+import hashlib
 import os
 import tempfile
 import unittest
+from unittest.mock import patch
 
 from adsmp import templates
 import xml.etree.ElementTree as ET
@@ -350,6 +354,114 @@ class TestTemplates(unittest.TestCase):
                         self.assertIn(expected_sitemap_url, content)
                 
                         
+    def test_sitemap_file_writer(self):
+        """Test the streaming writer gives the same file as render_sitemap_file"""
+        entries = [templates.format_url_entry('2023ApJ...123..%03dA' % i, '2024-01-15') for i in range(100)]
+        expected = templates.render_sitemap_file(''.join(entries))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'sitemap_bib_1.xml')
+            with templates.SitemapFileWriter(path) as writer:
+                for entry in entries:
+                    writer.write(entry)
+            self.assertEqual(writer.count, 100)
+            with open(path, 'r', encoding='utf-8') as f:
+                self.assertEqual(f.read(), expected)
+
+            gz_path = path + '.gz'
+            with templates.SitemapFileWriter(gz_path, compress=True) as writer:
+                for entry in entries:
+                    writer.write(entry)
+            with gzip.open(gz_path, 'rt', encoding='utf-8') as f:
+                self.assertEqual(f.read(), expected)
+            # no timestamp in the gzip header, same entries give the same bytes
+            with open(gz_path, 'rb') as f:
+                first = f.read()
+            with templates.SitemapFileWriter(gz_path, compress=True) as writer:
+                for entry in entries:
+                    writer.write(entry)
+            with open(gz_path, 'rb') as f:
+                self.assertEqual(f.read(), first)
+
+            # empty file is still valid xml
+            with templates.SitemapFileWriter(path):
+                pass
+            with open(path, 'r', encoding='utf-8') as f:
+                root = ET.fromstring(f.read())
+            self.assertEqual(len(root), 0)
+
+    def test_sitemap_file_writer_publish(self):
+        """The file only replaces the published one when done, the hash is over the xml"""
+        entry = templates.format_url_entry('2023ApJ...123..456A', '2024-01-15')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'sitemap_bib_1.xml')
+            with open(path, 'w') as f:
+                f.write('old')
+            writer = templates.SitemapFileWriter(path).open()
+            writer.write(entry)
+            writer.close()
+            # not visible until published
+            with open(path) as f:
+                self.assertEqual(f.read(), 'old')
+            self.assertFalse(writer.published)
+            self.assertEqual(writer.content_hash, hashlib.sha256(
+                templates.render_sitemap_file(entry).encode('utf-8')).hexdigest())
+            writer.publish()
+            self.assertTrue(writer.published)
+            with open(path) as f:
+                self.assertEqual(f.read(), templates.render_sitemap_file(entry))
+
+            # same content compressed, same hash
+            gz_writer = templates.SitemapFileWriter(path + '.gz', compress=True).open()
+            gz_writer.write(entry)
+            gz_writer.close()
+            self.assertEqual(gz_writer.content_hash, writer.content_hash)
+            gz_writer.discard()
+            self.assertFalse(os.path.exists(path + '.gz'))
+
+            # an error leaves the published file alone
+            with self.assertRaises(ValueError):
+                with templates.SitemapFileWriter(path) as writer:
+                    writer.write(entry)
+                    raise ValueError('boom')
+            with open(path) as f:
+                self.assertEqual(f.read(), templates.render_sitemap_file(entry))
+            self.assertEqual(os.listdir(temp_dir), ['sitemap_bib_1.xml'])
+
+    def test_template_cache(self):
+        """Templates are read once, and again when the file changes"""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'test.xml')
+            with open(path, 'w') as f:
+                f.write('first {x}')
+            templates.clear_template_cache()
+            with patch('adsmp.templates.get_template_path', return_value=path), \
+                    patch('builtins.open', wraps=open) as mock_open:
+                self.assertEqual(templates.load_template('test.xml'), 'first {x}')
+                self.assertEqual(templates.load_template('test.xml'), 'first {x}')
+                self.assertEqual(mock_open.call_count, 1)
+
+                with open(path, 'w') as f:
+                    f.write('second {x}')
+                os.utime(path, ns=(0, 10 ** 9))
+                self.assertEqual(templates.load_template('test.xml'), 'second {x}')
+            templates.clear_template_cache()
+
+    def test_url_entry_formatter(self):
+        """The compiled formatter gives the same entries as str.format on the pattern"""
+        patterns = ['https://ui.adsabs.harvard.edu/abs/{bibcode}/abstract',
+                    'https://scixplorer.org/abs/{bibcode}',
+                    'https://x.org/{bibcode}/{{raw}}/{bibcode}',
+                    'no-placeholder']
+        for pattern in patterns:
+            format_entry = templates.url_entry_formatter(pattern)
+            self.assertIs(templates.url_entry_formatter(pattern), format_entry)
+            for bibcode in ('2023ApJ...123..456A', '2023A&amp;A...1..2B'):
+                url = pattern.format(bibcode=bibcode)
+                self.assertEqual(format_entry(bibcode, '2024-01-15'),
+                                 f'\n<url><loc>{url}</loc><lastmod>2024-01-15</lastmod></url>')
+        self.assertEqual(templates.format_escaped_url_entry('b', datetime.date(2024, 1, 15), patterns[1]),
+                         '\n<url><loc>https://scixplorer.org/abs/b</loc><lastmod>2024-01-15</lastmod></url>')
+
     def test_url_formatting_edge_cases(self):
         """Test URL formatting with various edge cases"""
         # Test with bibcode containing special characters
@@ -0,0 +1,29 @@
+"""add sitemap_runs table
+
+Revision ID: 2f6c8a1b7d35
+Revises: 8b3f1d9e2a64
+Create Date: 2026-10-19 15:02:44.861290
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f6c8a1b7d35'
+down_revision = '8b3f1d9e2a64'
+
+from alembic import op
+import sqlalchemy as sa
+import adsmp.models
+
+
+def upgrade():
+    op.create_table('sitemap_runs',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('total_files', sa.Integer(), nullable=False),
+                    sa.Column('pending_files', sa.Integer(), nullable=False),
+                    sa.Column('created', adsmp.models.UTCDateTime(), nullable=True),
+                    sa.Column('finished', adsmp.models.UTCDateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('sitemap_runs')
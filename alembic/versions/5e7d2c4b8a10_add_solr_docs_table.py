@@ -0,0 +1,28 @@
+"""add solr_docs table
+
+Revision ID: 5e7d2c4b8a10
+Revises: c3a91f0e5b27
+Create Date: 2026-10-19 11:02:47.118934
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e7d2c4b8a10'
+down_revision = 'c3a91f0e5b27'
+
+from alembic import op
+import sqlalchemy as sa
+import adsmp.models
+
+
+def upgrade():
+    op.create_table('solr_docs',
+                    sa.Column('bibcode', sa.String(length=19), nullable=False),
+                    sa.Column('checksum', sa.String(length=10), nullable=True),
+                    sa.Column('doc', sa.LargeBinary(), nullable=True),
+                    sa.Column('updated', adsmp.models.UTCDateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('bibcode'))
+
+
+def downgrade():
+    op.drop_table('solr_docs')
@@ -0,0 +1,33 @@
+"""add sitemap_runs failed_files
+
+Revision ID: 7c1e4b9d2f53
+Revises: f5c2a7d91e38
+Create Date: 2026-10-19 21:12:44.318206
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c1e4b9d2f53'
+down_revision = 'f5c2a7d91e38'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # sqlite doesn't have ALTER command
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        with op.batch_alter_table("sitemap_runs") as batch_op:
+            batch_op.add_column(sa.Column('failed_files', sa.Integer, nullable=False, server_default='0'))
+    else:
+        op.add_column('sitemap_runs', sa.Column('failed_files', sa.Integer, nullable=False, server_default='0'))
+
+
+def downgrade():
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        with op.batch_alter_table("sitemap_runs") as batch_op:
+            batch_op.drop_column('failed_files')
+    else:
+        op.drop_column('sitemap_runs', 'failed_files')
@@ -0,0 +1,49 @@
+"""add sitemap_files table
+
+Revision ID: 8b3f1d9e2a64
+Revises: 5e7d2c4b8a10
+Create Date: 2026-10-19 14:21:09.530117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8b3f1d9e2a64'
+down_revision = '5e7d2c4b8a10'
+
+from alembic import op
+import sqlalchemy as sa
+import adsmp.models
+
+
+def file_index(filename):
+    try:
+        return int(filename.split('_bib_')[1].split('.')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def upgrade():
+    sitemap_files = op.create_table('sitemap_files',
+                                    sa.Column('filename', sa.String(length=255), nullable=False),
+                                    sa.Column('file_index', sa.Integer(), nullable=True),
+                                    sa.Column('record_count', sa.Integer(), nullable=False),
+                                    sa.Column('last_generated', adsmp.models.UTCDateTime(), nullable=True),
+                                    sa.Column('content_hash', sa.String(length=64), nullable=True),
+                                    sa.PrimaryKeyConstraint('filename'))
+    op.create_index('ix_sitemap_files_file_index', 'sitemap_files', ['file_index'], unique=True)
+
+    # one pass over the sitemap table to fill in the existing files
+    conn = op.get_bind()
+    rows = conn.execute(sa.text('SELECT sitemap_filename, count(id), max(filename_lastmoddate) FROM sitemap '
+                                'WHERE sitemap_filename IS NOT NULL GROUP BY sitemap_filename')).fetchall()
+    if rows:
+        op.bulk_insert(sitemap_files, [{'filename': filename,
+                                        'file_index': file_index(filename),
+                                        'record_count': count,
+                                        'last_generated': last_generated}
+                                       for filename, count, last_generated in rows])
+
+
+def downgrade():
+    op.drop_index('ix_sitemap_files_file_index', table_name='sitemap_files')
+    op.drop_table('sitemap_files')
@@ -0,0 +1,31 @@
+"""add sitemap_file_sites table
+
+Revision ID: a4e9c3f5b812
+Revises: 2f6c8a1b7d35
+Create Date: 2026-10-19 15:40:12.307644
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4e9c3f5b812'
+down_revision = '2f6c8a1b7d35'
+
+from alembic import op
+import sqlalchemy as sa
+import adsmp.models
+
+
+def upgrade():
+    # filled in as files are written; files written before are picked up
+    # from disk once by update_sitemap_index
+    op.create_table('sitemap_file_sites',
+                    sa.Column('filename', sa.String(length=255), nullable=False),
+                    sa.Column('site', sa.String(length=64), nullable=False),
+                    sa.Column('output_filename', sa.String(length=255), nullable=False),
+                    sa.Column('generated', adsmp.models.UTCDateTime(), nullable=True),
+                    sa.Column('byte_size', sa.BigInteger(), nullable=True),
+                    sa.PrimaryKeyConstraint('filename', 'site'))
+
+
+def downgrade():
+    op.drop_table('sitemap_file_sites')
@@ -0,0 +1,33 @@
+"""add datalinks fingerprints
+
+Revision ID: c3a91f0e5b27
+Revises: 1d216b5e6c90
+Create Date: 2026-10-19 10:12:31.417203
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3a91f0e5b27'
+down_revision = '1d216b5e6c90'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # sqlite doesn't have ALTER command
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        with op.batch_alter_table("records") as batch_op:
+            batch_op.add_column(sa.Column('datalinks_fingerprints', sa.Text))
+    else:
+        op.add_column('records', sa.Column('datalinks_fingerprints', sa.Text))
+
+
+def downgrade():
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        with op.batch_alter_table("records") as batch_op:
+            batch_op.drop_column('datalinks_fingerprints')
+    else:
+        op.drop_column('records', 'datalinks_fingerprints')
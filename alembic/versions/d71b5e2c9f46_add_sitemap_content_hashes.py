@@ -0,0 +1,43 @@
+"""add sitemap content hashes and run counts
+
+Revision ID: d71b5e2c9f46
+Revises: a4e9c3f5b812
+Create Date: 2026-10-19 16:18:37.052911
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd71b5e2c9f46'
+down_revision = 'a4e9c3f5b812'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # sqlite doesn't have ALTER command
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        with op.batch_alter_table("sitemap_file_sites") as batch_op:
+            batch_op.add_column(sa.Column('content_hash', sa.String(length=64)))
+        with op.batch_alter_table("sitemap_runs") as batch_op:
+            batch_op.add_column(sa.Column('written_files', sa.Integer, nullable=False, server_default='0'))
+            batch_op.add_column(sa.Column('skipped_files', sa.Integer, nullable=False, server_default='0'))
+    else:
+        op.add_column('sitemap_file_sites', sa.Column('content_hash', sa.String(length=64)))
+        op.add_column('sitemap_runs', sa.Column('written_files', sa.Integer, nullable=False, server_default='0'))
+        op.add_column('sitemap_runs', sa.Column('skipped_files', sa.Integer, nullable=False, server_default='0'))
+
+
+def downgrade():
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        with op.batch_alter_table("sitemap_runs") as batch_op:
+            batch_op.drop_column('skipped_files')
+            batch_op.drop_column('written_files')
+        with op.batch_alter_table("sitemap_file_sites") as batch_op:
+            batch_op.drop_column('content_hash')
+    else:
+        op.drop_column('sitemap_runs', 'skipped_files')
+        op.drop_column('sitemap_runs', 'written_files')
+        op.drop_column('sitemap_file_sites', 'content_hash')
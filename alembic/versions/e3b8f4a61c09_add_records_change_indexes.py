@@ -0,0 +1,25 @@
+"""add records change indexes
+
+Revision ID: e3b8f4a61c09
+Revises: d71b5e2c9f46
+Create Date: 2026-10-19 18:02:11.418305
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e3b8f4a61c09'
+down_revision = 'd71b5e2c9f46'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # range scans of --update-sitemaps-auto
+    op.create_index(op.f('ix_records_bib_data_updated'), 'records', ['bib_data_updated'], unique=False)
+    op.create_index(op.f('ix_records_solr_processed'), 'records', ['solr_processed'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_records_solr_processed'), table_name='records')
+    op.drop_index(op.f('ix_records_bib_data_updated'), table_name='records')
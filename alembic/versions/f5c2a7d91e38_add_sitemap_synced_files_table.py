@@ -0,0 +1,30 @@
+"""add sitemap_synced_files table
+
+Revision ID: f5c2a7d91e38
+Revises: e3b8f4a61c09
+Create Date: 2026-10-19 18:40:27.913502
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f5c2a7d91e38'
+down_revision = 'e3b8f4a61c09'
+
+from alembic import op
+import sqlalchemy as sa
+import adsmp.models
+
+
+def upgrade():
+    # empty at first, the first sync uploads everything
+    op.create_table('sitemap_synced_files',
+                    sa.Column('site', sa.String(length=64), nullable=False),
+                    sa.Column('filename', sa.String(length=255), nullable=False),
+                    sa.Column('content_hash', sa.String(length=64), nullable=False),
+                    sa.Column('byte_size', sa.BigInteger(), nullable=True),
+                    sa.Column('synced', adsmp.models.UTCDateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('site', 'filename'))
+
+
+def downgrade():
+    op.drop_table('sitemap_synced_files')
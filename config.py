@@ -46,16 +46,49 @@ SOLR_URL_OLD = "http://localhost:9984/solr/collection1/query"
 # new links data is sent to this url, the mircoservice updates its datastore
 LINKS_RESOLVER_UPDATE_URL = "http://localhost:8080/update"
 ADS_API_TOKEN = "fixme"
+# requests to the resolver reuse one pooled session per worker, transient
+# failures (connection errors, 429/502/503/504) are retried with exponential
+# backoff (LINKS_RESOLVER_BACKOFF, doubled on every attempt) and rejected
+# batches (4xx but 401/403) are bisected until the bad records are isolated;
+# when the resolver stays unavailable the batch is marked links-failed
+LINKS_RESOLVER_TIMEOUT = 60
+LINKS_RESOLVER_MAX_RETRIES = 3
+LINKS_RESOLVER_BACKOFF = 1.0
+# gzip request bodies (Content-Encoding: gzip), only if the resolver decodes them
+LINKS_RESOLVER_GZIP = False
+# when set, records already known to the resolver are sent to this url as row
+# level deltas (added/changed rows and the keys of removed rows) instead of a
+# full replacement; if the resolver answers 404/405/415/501 deltas are switched
+# off for the worker and full records are sent to LINKS_RESOLVER_UPDATE_URL
+LINKS_RESOLVER_DELTA_URL = None
 
 # Sitemap configuration
 MAX_RECORDS_PER_SITEMAP = 50000
 SITEMAP_BOOTSTRAP_BATCH_SIZE = 50000  
+# parallel-bootstrap: each records.id range task gets a block of this many
+# files and spans as many ids as the block can hold
+SITEMAP_BOOTSTRAP_FILES_PER_RANGE = 20
+# compact: files less full than this fraction of MAX_RECORDS_PER_SITEMAP are
+# merged into each other
+SITEMAP_COMPACTION_FILL_FACTOR = 0.75
+# --update-sitemaps-auto: bibcodes read and added at a time, and how far
+# before the last run's start time the next run looks back
+SITEMAP_AUTO_CHUNK_SIZE = 10000
+SITEMAP_AUTO_WATERMARK_OVERLAP_MINUTES = 60
 SITEMAP_DIR = '/app/logs/sitemap/'
+# SITEMAP_DIR is a symlink into SITEMAP_DIR.generations, swapped to an empty
+# generation by the delete-table action; previous generations kept
+SITEMAP_BACKUP_GENERATIONS = 3
+# write gzipped sitemap files (sitemap_bib_N.xml.gz), the database keeps the
+# plain .xml names
+SITEMAP_GZIP = False
+# rows fetched at a time while a sitemap file is written
+SITEMAP_STREAM_BATCH_SIZE = 5000
 SITEMAP_INDEX_GENERATION_DELAY = 15 # This is the delay between the generation of the sitemap and the indexing of the sitemap
-
-# Sitemap index generation retry configuration
-# Default 100 retries = ~90 minutes. Increase for larger databases (e.g., 300 for ~5.5 hours)
-SITEMAP_INDEX_MAX_RETRIES = 100
+# a sitemap run whose file tasks haven't all succeeded this long after it was
+# started is closed and the index regenerated by the next update-sitemap-files;
+# bootstrap ranges count on runs too, keep it above the length of a bootstrap
+SITEMAP_RUN_TIMEOUT_MINUTES = 24 * 60
 
 
 # Site configurations for multi-site sitemap generation
@@ -75,14 +108,33 @@ SITES = {
 }
 
 # S3 Configuration for sitemap file sync
-SITEMAP_S3_SYNC_ENABLED = True  # Set to True to enable S3 sync
+# upload the changed sitemap files after every index generation
+# (task_sync_sitemaps); a 'file:///path' bucket writes to a local directory
+SITEMAP_S3_SYNC_ENABLED = False
 SITEMAP_S3_BUCKET = 'sitemaps'  # S3 bucket for sitemap files
+SITEMAP_S3_PREFIX = ''  # key prefix, objects are <prefix><site>/<filename>
+SITEMAP_S3_ENDPOINT_URL = None  # for S3 compatible stores
+SITEMAP_S3_SYNC_CONCURRENCY = 8  # uploads running at the same time
+# files from this size on are uploaded in parts of SITEMAP_S3_MULTIPART_PART_SIZE
+SITEMAP_S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+SITEMAP_S3_MULTIPART_PART_SIZE = 8 * 1024 * 1024
 AWS_ACCESS_KEY_ID = 'AWS_ACCESS_KEY_ID'
 AWS_SECRET_ACCESS_KEY = 'AWS_SECRET_ACCESS_KEY'
 AWS_DEFAULT_REGION = 'us-east-1'
 
 ENABLE_HAS = True
 
+# collect cumulative time, calls and output size per stage of the solr
+# transform (solr_updater.transform_json_record) and log a summary line at
+# most every SOLR_TRANSFORM_STATS_INTERVAL seconds
+SOLR_TRANSFORM_STATS = False
+SOLR_TRANSFORM_STATS_INTERVAL = 300
+
+# keep a compressed copy of the last document accepted by solr for every
+# bibcode (solr_docs table); it can be replayed into another collection
+# (run.py --replay-solr-docs) and diffed against a fresh build (--diff-solr-docs)
+SOLR_DOC_STORE = False
+
 HAS_FIELDS = [
     "abstract",
     "ack",
@@ -19,7 +19,7 @@ except ImportError:
 
 from adsputils import setup_logging, get_date, load_config
 from adsmp.models import KeyValue, Records, SitemapInfo
-from adsmp import tasks, solr_updater, validate #s3_utils
+from adsmp import tasks, solr_updater, solr_export, validate
 from sqlalchemy.orm import load_only
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from celery import chain
@@ -37,7 +37,7 @@ app = tasks.app
 # =============================== FUNCTIONS ======================================= #
 
 
-def _print_record(bibcode):
+def _print_record(bibcode, metrics=None):
     with app.session_scope() as session:
         print('stored by us:', bibcode)
         r = session.query(Records).filter_by(bibcode=bibcode).first()
@@ -47,6 +47,11 @@ def _print_record(bibcode):
             print('None')
         print('-' * 80)
 
+        if metrics is not None:
+            print('as seen by the metrics db')
+            print(json.dumps(metrics.get(bibcode), indent=2, default=str, sort_keys=True))
+            print('-' * 80)
+
         print('as seen by SOLR')
         solr_doc = solr_updater.transform_json_record(r.toJSON())
         print(json.dumps(solr_doc, indent=2, default=str, sort_keys=True))
@@ -67,8 +72,13 @@ def diagnostics(bibcodes):
             for r in session.query(Records).limit(3).all():
                 bibcodes.append(r.bibcode)
 
+    # one query against the metrics db for all the bibcodes
+    metrics = None
+    if app._metrics_session:
+        metrics = app.get_metrics_bulk(bibcodes)
+
     for b in bibcodes:
-        _print_record(b)
+        _print_record(b, metrics=metrics)
 
     with app.session_scope() as session:
         for x in dir(Records):
@@ -481,6 +491,9 @@ def manage_sitemap(bibcodes, action):
     - 'force-update': force update sitemap table entries for given bibcodes  
     - 'remove': remove bibcodes from sitemap table
     - 'bootstrap': populate entire sitemap table from all valid records in database
+    - 'parallel-bootstrap': same as bootstrap, split into id ranges processed by
+      parallel tasks; the last range submits the files update itself
+    - 'compact': merge sparse sitemap files, deleting the emptied ones
     - 'delete-table': delete all contents of sitemap table and backup files
     - 'update-robots': force update robots.txt files for all sites
     
@@ -497,7 +510,7 @@ def manage_sitemap(bibcodes, action):
     
     
     # Actions that modify records should automatically update files
-    if action in ['add', 'remove', 'force-update', 'bootstrap']:
+    if action in ['add', 'remove', 'force-update', 'bootstrap', 'compact']:
         # Chain: manage_sitemap → update_sitemap_files
         workflow = chain(
             tasks.task_manage_sitemap.s(bibcodes, action),
@@ -509,7 +522,7 @@ def manage_sitemap(bibcodes, action):
         print(f"Processing {len(bibcodes)} bibcodes")
         print("Files will be automatically updated after management completes")
     else:
-        # Other actions (delete-table, update-robots) run standalone
+        # Other actions (delete-table, update-robots, parallel-bootstrap) run standalone
         result = tasks.task_manage_sitemap.apply_async(args=(bibcodes, action))
         print(f"Sitemap management task submitted: {result.id}")
         print(f"Action: {action}")
@@ -555,7 +568,7 @@ def cleanup_invalid_sitemaps():
     logger.info('Sitemap cleanup workflow submitted: %s', result.id)
     return result.id
 
-def update_sitemaps_auto(days_back=1):
+def update_sitemaps_auto(days_back=1, use_watermark=True):
     """
     Automatically find and process records needing sitemap updates
     
@@ -567,64 +580,58 @@ def update_sitemaps_auto(days_back=1):
     newly ingested OR recently processed by SOLR are included in sitemaps.
     
     Excludes records that already have update_flag=True to avoid duplicate work,
-    as those records are already scheduled for sitemap regeneration.
+    as those records are already scheduled for sitemap regeneration (see
+    app.sitemap_auto_changes).
+    
+    The cutoff is the start of the last successful run, kept in the storage
+    table under 'last.sitemap.auto' less SITEMAP_AUTO_WATERMARK_OVERLAP_MINUTES
+    (for transactions still open at that time), so a run costs what changed
+    since. Without a stored watermark, or with use_watermark=False, it is
+    days_back days ago.
+    
+    Only the cutoff is sent: task_update_sitemaps_auto reads the bibcodes in
+    chunks of SITEMAP_AUTO_CHUNK_SIZE and adds them one chunk after the other,
+    then task_update_sitemap_files runs.
     
     Args:
-        days_back: Number of days to look back for changes
+        days_back: Number of days to look back for changes, without a watermark
+        use_watermark: Start from the last successful run, if there was one
     
     Returns:
         str: Workflow task ID (chains manage + file generation), or None if no updates needed
     """
     
-    
-    logger.info('Starting automatic sitemap update (looking back %d days)', days_back)
-    
-    # Calculate cutoff date
-    cutoff_date = get_date() - timedelta(days=days_back)
+    now = get_date()
+    cutoff_date = None
+    if use_watermark:
+        watermark = app.get_sitemap_auto_watermark()
+        if watermark is not None:
+            overlap = app.conf.get('SITEMAP_AUTO_WATERMARK_OVERLAP_MINUTES', 60)
+            cutoff_date = watermark - timedelta(minutes=overlap)
+    if cutoff_date is None:
+        cutoff_date = now - timedelta(days=days_back)
+        logger.info('Starting automatic sitemap update (looking back %d days)', days_back)
+    else:
+        logger.info('Starting automatic sitemap update from the last run watermark')
     logger.info('Looking for records updated since: %s', cutoff_date.isoformat())
     
-    bibcodes_to_update = []
-    
     with app.session_scope() as session:
-        # Find all records that were updated recently OR had SOLR processing recently
-        # Exclude records that already have update_flag=True to avoid duplicate work
-        
-        # Subquery to get bibcodes that already have update_flag=True
-        already_flagged_subquery = session.query(SitemapInfo.bibcode).filter(
-            SitemapInfo.update_flag.is_(True)
-        )
-        
-        bib_data_query = session.query(Records.bibcode).filter(
-            Records.bib_data_updated >= cutoff_date,
-            ~Records.bibcode.in_(already_flagged_subquery)
-        )
-        
-        solr_processed_query = session.query(Records.bibcode).filter(
-            Records.solr_processed >= cutoff_date,
-            ~Records.bibcode.in_(already_flagged_subquery)
-        )
-        
-        # UNION automatically eliminates duplicates
-        combined_query = bib_data_query.union(solr_processed_query)
-        
-        bibcodes_to_update = [record.bibcode for record in combined_query]
-        
-        logger.info('Found %d records updated since %s (excluding already flagged)', len(bibcodes_to_update), cutoff_date.isoformat())
+        found = app.sitemap_auto_changes(session, cutoff_date).first() is not None
     
-    if not bibcodes_to_update:
+    if not found:
         logger.info('No records need sitemap updates')
+        app.set_sitemap_auto_watermark(now)
         return None
     
-    logger.info('Submitting %d records for sitemap processing', len(bibcodes_to_update))
-    
-    # Chain tasks: manage sitemap → update files
+    # Chain tasks: manage sitemap (chunk by chunk, in the task) → update files;
+    # the task moves the watermark to now once every chunk is added, a failed
+    # run is looked at again next time
     workflow = chain(
-        tasks.task_manage_sitemap.s(bibcodes_to_update, 'add'),
+        tasks.task_update_sitemaps_auto.si(cutoff_date.isoformat(), now.isoformat()),
         tasks.task_update_sitemap_files.s()
     )
     result = workflow.apply_async(priority=0)
-    logger.info('Submitted sitemap workflow: %s', result.id)
-    
+    logger.info('Submitted sitemap workflow for records updated since %s: %s', cutoff_date.isoformat(), result.id)
     return result.id
 
 
@@ -741,6 +748,32 @@ if __name__ == '__main__':
                         action='store_true',
                         default=False,
                         help='Will send all solr docs for indexing to another collection; by purpose this task is synchronous. You can send the name of the collection or the full url to the solr instance incl http via --solr-collection')
+    parser.add_argument('--export-solr-docs',
+                        dest='export_solr_docs',
+                        action='store',
+                        default=None,
+                        help='directory; write the solr docs of all records there as sharded, gzipped json lines (no celery involved), uses --batch_size and --workers')
+    parser.add_argument('--load-solr-export',
+                        dest='load_solr_export',
+                        action='store',
+                        default=None,
+                        help='directory; post a solr docs export to the collection given with --solr-collection (or the configured SOLR_URLS), with --update-processed the solr checksums are stored')
+    parser.add_argument('--replay-solr-docs',
+                        dest='replay_solr_docs',
+                        action='store_true',
+                        default=False,
+                        help='post the stored last sent solr docs (SOLR_DOC_STORE) to the collection given with --solr-collection')
+    parser.add_argument('--diff-solr-docs',
+                        dest='diff_solr_docs',
+                        action='store_true',
+                        default=False,
+                        help='print the field level differences between the stored last sent solr docs and freshly built ones, works with --bibcodes or --filename')
+    parser.add_argument('--workers',
+                        dest='workers',
+                        action='store',
+                        default=None,
+                        type=int,
+                        help='number of processes used by --export-solr-docs, defaults to the number of cpus')
     parser.add_argument('--priority',
                         dest='priority',
                         action='store',
@@ -759,8 +792,8 @@ if __name__ == '__main__':
                         help='populate sitemap table for list of bibcodes')
     parser.add_argument('--action',
                         default=False,
-                        choices=['add', 'delete-table', 'force-update', 'remove', 'update-robots', 'bootstrap'],
-                        help='action: add (add bibcodes), force-update (force update bibcodes), remove (remove bibcodes), delete-table (clear sitemap table), update-robots (force update robots.txt files), bootstrap (initialize sitemaps for all existing records)')
+                        choices=['add', 'delete-table', 'force-update', 'remove', 'update-robots', 'bootstrap', 'parallel-bootstrap', 'compact'],
+                        help='action: add (add bibcodes), force-update (force update bibcodes), remove (remove bibcodes), delete-table (clear sitemap table), update-robots (force update robots.txt files), bootstrap (initialize sitemaps for all existing records), parallel-bootstrap (bootstrap in parallel id ranges), compact (merge sparse sitemap files)')
     parser.add_argument('--update-sitemap-files',
                         action='store_true',
                         default=False,
@@ -775,17 +808,22 @@ if __name__ == '__main__':
                         type=int,
                         default=1,
                         dest='days_back',
-                        help='number of days to look back for changed records (used with --update-sitemaps-auto)')
+                        help='number of days to look back for changed records (used with --update-sitemaps-auto when no watermark is stored, or with --ignore-watermark)')
+    parser.add_argument('--ignore-watermark',
+                        action='store_true',
+                        default=False,
+                        dest='ignore_watermark',
+                        help='look back --days-back days instead of starting from the last --update-sitemaps-auto run')
     parser.add_argument('--cleanup-invalid-sitemaps',
                         dest='cleanup_invalid_sitemaps',
                         action='store_true',
                         default=False,
                         help='Cleanup invalid sitemap entries (records that became invalid due to SOLR failures, missing data, etc.)')
-    # parser.add_argument('--sync-sitemap-s3',
-    #                     action='store_true',
-    #                     default=False,
-    #                     dest='sync_sitemap_s3',
-    #                     help='manually sync all sitemap files to S3')
+    parser.add_argument('--sync-sitemap-s3',
+                        action='store_true',
+                        default=False,
+                        dest='sync_sitemap_s3',
+                        help='upload the sitemap files changed since the last sync to SITEMAP_S3_BUCKET')
     parser.add_argument('--update-scix-id',
                         action='store_true',
                         default=False,
@@ -977,6 +1015,43 @@ if __name__ == '__main__':
 
     elif args.rebuild_collection:
         rebuild_collection(args.solr_collection, args.batch_size)
+    elif args.export_solr_docs:
+        manifest = solr_export.export_solr_docs(app, args.export_solr_docs, batch_size=args.batch_size,
+                                                workers=args.workers)
+        print('exported {} solr docs in {} files to {}'.format(manifest['count'], len(manifest['shards']),
+                                                              args.export_solr_docs))
+    elif args.load_solr_export:
+        solr_urls = collection_to_urls(args.solr_collection)
+        posted, failed = solr_export.load_solr_export(args.load_solr_export, solr_urls, batch_size=args.batch_size,
+                                                      commit=True, app=app, update_processed=args.update_processed)
+        logger.info('posted %s solr docs from %s to %s, %s failed: %s', posted, args.load_solr_export,
+                    ';'.join(solr_urls), len(failed), failed)
+    elif args.replay_solr_docs:
+        solr_urls = collection_to_urls(args.solr_collection)
+        posted, failed = solr_export.replay_solr_docs(app, solr_urls, batch_size=args.batch_size, commit=True)
+        logger.info('replayed %s stored solr docs to %s, %s failed: %s', posted, ';'.join(solr_urls),
+                    len(failed), failed)
+    elif args.diff_solr_docs:
+        bibcodes = args.bibcodes or []
+        if args.filename:
+            with open(args.filename) as f:
+                bibcodes = [line.strip() for line in f if line.strip()]
+        diffs = solr_export.diff_stored_solr_docs(app, bibcodes)
+        for bibcode in bibcodes:
+            if bibcode not in diffs:
+                print('{}: no stored solr doc'.format(bibcode))
+                continue
+            d = diffs[bibcode]
+            if not (d['added'] or d['removed'] or d['changed']):
+                print('{}: unchanged'.format(bibcode))
+                continue
+            print('{}:'.format(bibcode))
+            for field, value in sorted(d['added'].items()):
+                print('  + {}: {}'.format(field, json.dumps(value)))
+            for field, value in sorted(d['removed'].items()):
+                print('  - {}: {}'.format(field, json.dumps(value)))
+            for field, (old, new) in sorted(d['changed'].items()):
+                print('  ~ {}: {} -> {}'.format(field, json.dumps(old), json.dumps(new)))
     elif args.index_failed:
         reindex_failed_bibcodes(app, args.update_processed)
     elif args.manage_sitemap:
@@ -984,7 +1059,7 @@ if __name__ == '__main__':
         # Validate required action parameter
         if not args.action:
             print("Error: --action is required when using --populate-sitemap-table")
-            print("Available actions: add, remove, force-update, delete-table, update-robots, bootstrap")
+            print("Available actions: add, remove, force-update, delete-table, update-robots, bootstrap, parallel-bootstrap, compact")
             sys.exit(1)
         
         action = args.action
@@ -1011,7 +1086,7 @@ if __name__ == '__main__':
     elif args.update_sitemap_files:
         update_sitemap_files()
     elif args.update_sitemaps_auto:
-        workflow_id = update_sitemaps_auto(args.days_back)
+        workflow_id = update_sitemaps_auto(args.days_back, use_watermark=not args.ignore_watermark)
         if workflow_id:
             print(f"Automatic sitemap update initiated:")
             print(f"  Workflow ID: {workflow_id} (chains: manage sitemap → generate files)")
@@ -1021,8 +1096,9 @@ if __name__ == '__main__':
     elif args.cleanup_invalid_sitemaps:
         task_id = cleanup_invalid_sitemaps()
         print(f"Sitemap cleanup task submitted: {task_id}")
-    # elif args.sync_sitemap_s3:
-    #     sync_sitemap_to_s3()
+    elif args.sync_sitemap_s3:
+        result = tasks.task_sync_sitemaps.apply_async()
+        print(f"Sitemap sync task submitted: {result.id}")
     elif args.update_scixid:
         if args.filename:
             bibs = []
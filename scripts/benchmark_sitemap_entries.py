@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for sitemap url entries (adsmp.templates).
+
+Builds a synthetic sitemap file worth of bibcodes and times the url entry
+formatting, the old per call str.format and the compiled formatter, and a
+full file written with SitemapFileWriter; no database is needed.
+
+    python scripts/benchmark_sitemap_entries.py --urls 50000 --sites 2
+"""
+
+import argparse
+import html
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+proj_home = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if proj_home not in sys.path:
+    sys.path.append(proj_home)
+
+from adsmp import templates
+
+PATTERNS = ['https://ui.adsabs.harvard.edu/abs/{bibcode}/abstract',
+            'https://scixplorer.org/abs/{bibcode}',
+            'https://mirror.example.org/abs/{bibcode}']
+JOURNALS = ['ApJ..', 'MNRAS', 'A&A..', 'AJ...', 'PhRvD', 'arXiv']
+
+
+def make_rows(urls, rnd):
+    """(bibcode, lastmod) pairs, a few bibcodes need escaping (A&A)"""
+    start = date(2000, 1, 1)
+    return [('%d%s.%04d..%04d%s' % (rnd.randint(1990, 2024), rnd.choice(JOURNALS), rnd.randint(1, 9999),
+                                     i % 10000, rnd.choice('ABCDE')),
+             (start + timedelta(days=rnd.randint(0, 9000))).isoformat())
+            for i in range(urls)]
+
+
+def str_format(rows, patterns):
+    """What writing an entry cost before the compiled formatter"""
+    for bibcode, lastmod in rows:
+        escaped = html.escape(bibcode)
+        for pattern in patterns:
+            url = pattern.format(bibcode=escaped)
+            f'\n<url><loc>{url}</loc><lastmod>{lastmod}</lastmod></url>'
+
+
+def compiled(rows, patterns):
+    formatters = [templates.url_entry_formatter(p) for p in patterns]
+    for bibcode, lastmod in rows:
+        escaped = html.escape(bibcode)
+        for format_entry in formatters:
+            format_entry(escaped, lastmod)
+
+
+def write_files(rows, patterns, directory, compress):
+    formatters = [templates.url_entry_formatter(p) for p in patterns]
+    writers = [templates.SitemapFileWriter(os.path.join(directory, 'sitemap_bib_%d.xml' % i), compress=compress).open()
+               for i in range(len(patterns))]
+    for bibcode, lastmod in rows:
+        escaped = html.escape(bibcode)
+        for writer, format_entry in zip(writers, formatters):
+            writer.write(format_entry(escaped, lastmod))
+    for writer in writers:
+        writer.publish()
+
+
+def best_of(repeat, f, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(urls, sites, repeat, seed, compress):
+    rows = make_rows(urls, random.Random(seed))
+    patterns = PATTERNS[:sites]
+    entries = urls * sites
+    with tempfile.TemporaryDirectory() as directory:
+        timings = [('str.format', best_of(repeat, str_format, rows, patterns)),
+                   ('compiled formatter', best_of(repeat, compiled, rows, patterns)),
+                   ('file%s' % (' (gzip)' if compress else ''),
+                    best_of(repeat, write_files, rows, patterns, directory, compress))]
+    print('urls=%s sites=%s best of %s:' % (urls, sites, repeat))
+    for name, elapsed in timings:
+        print('  %-20s %8.3fs %12.0f entries/s' % (name, elapsed, entries / elapsed))
+    print('url_entry_formatter %s' % (templates.url_entry_formatter.cache_info(),))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time sitemap url entry formatting for one sitemap file')
+    parser.add_argument('--urls', type=int, default=50000, help='urls in the file (MAX_RECORDS_PER_SITEMAP)')
+    parser.add_argument('--sites', type=int, default=2, choices=range(1, len(PATTERNS) + 1))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--gzip', action='store_true', default=False, help='write gzipped files (SITEMAP_GZIP)')
+    args = parser.parse_args()
+    run(args.urls, args.sites, args.repeat, args.seed, args.gzip)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for the solr transform (adsmp.solr_updater).
+
+Builds a synthetic corpus of database records and times
+transform_json_record over it, no database or solr is needed.
+
+    python scripts/benchmark_solr_transform.py --corpus objects --records 2000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+proj_home = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if proj_home not in sys.path:
+    sys.path.append(proj_home)
+
+from adsmp import solr_updater
+
+SIMBAD_TYPES = ['G', 'Sy2', 'QSO', '**', 'V*', 'PN', 'HII', 'X', 'Radio', 'IR', 'RedSG*', 'SNR', 'Cl*', 'GinCl']
+NED_TYPES = ['G', 'GPair', '!*', '*Cl', 'UvS', 'RadioS', 'QSO', 'SN', 'IrS', 'HII', 'PN']
+UAT = ['cosmology/origin of the universe/early universe/recombination (cosmology)/322',
+       'interstellar medium/interstellar emissions/radio continuum emission/5',
+       'stellar astronomy/stellar types/stellar evolutionary types/evolved stars/subgiant stars/1646',
+       'galaxies/galaxy classification systems/spiral galaxies/1560']
+GRANTS = ['NASA NNX12AB34C', 'NSF AST-1234567', 'ERC 123456', 'DFG SFB-956']
+
+
+def object_record(i, rnd, n_objects):
+    """Record of a survey/catalog paper: thousands of SIMBAD/NED objects"""
+    now = datetime.now()
+    return {
+        'bibcode': '2020Bench%010d' % i,
+        'id': i,
+        'bib_data': {'title': ['record %s' % i], 'author': ['Doe, J.']},
+        'bib_data_updated': now,
+        'nonbib_data': {
+            'simbad_objects': ['%s %s' % (rnd.randint(1, 10 ** 7), rnd.choice(SIMBAD_TYPES))
+                               for _ in range(n_objects)],
+            'ned_objects': ['NED_%s %s' % (rnd.randint(1, 10 ** 7), rnd.choice(NED_TYPES))
+                            for _ in range(n_objects // 2)],
+            'uat': rnd.sample(UAT, 2),
+            'grants': rnd.sample(GRANTS, 2),
+            'planetary_feature': ['Moon/Crater/Alder/171', 'Mars/Terra/Terra Cimmeria/5930'],
+        },
+        'nonbib_data_updated': now,
+    }
+
+
+def fulltext_record(i, rnd, n_objects):
+    """Record with fulltext and long reference/citation lists, this is
+    what the "has" field computation scans"""
+    now = datetime.now()
+    words = ['galaxy', 'star', 'redshift', 'spectrum', 'the', 'of', '-', 'flux', 'model']
+    body = ' '.join(rnd.choice(words) for _ in range(50000))
+    references = ['%sApJ...%03d..%03dX' % (rnd.randint(1950, 2020), rnd.randint(1, 999), rnd.randint(1, 999))
+                  for _ in range(300)]
+    return {
+        'bibcode': '2020Bench%010d' % i,
+        'id': i,
+        'bib_data': {'title': ['record %s' % i], 'author': ['Doe, J.', 'Roe, R.'], 'aff': ['-', '-'],
+                     'abstract': ' '.join(rnd.choice(words) for _ in range(300))},
+        'bib_data_updated': now,
+        'nonbib_data': {'reference': references, 'property': ['REFEREED', 'ARTICLE']},
+        'nonbib_data_updated': now,
+        'metrics': {'citations': references[:200]},
+        'fulltext': {'body': body, 'acknowledgements': 'We thank the referee.'},
+        'fulltext_updated': now,
+    }
+
+
+CORPORA = {
+    'objects': object_record,
+    'fulltext': fulltext_record,
+}
+
+
+def run(corpus, records, objects, repeat, seed, stats=False):
+    rnd = random.Random(seed)
+    make = CORPORA[corpus]
+    data = [make(i, rnd, objects) for i in range(records)]
+    if stats:
+        solr_updater.enable_transform_stats()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for r in data:
+            solr_updater.transform_json_record(r)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('corpus=%s records=%s best of %s: %.3fs (%.3f ms/record)'
+          % (corpus, records, repeat, best, 1000.0 * best / records))
+    print('SIMBAD types: %d precomputed, others %s' % (len(solr_updater.SIMBAD_TYPES),
+                                                       solr_updater._simbad_class.cache_info()))
+    print('NED types: %d precomputed, others %s' % (len(solr_updater.NED_TYPES),
+                                                    solr_updater._ned_class.cache_info()))
+    print('hier facet parents %s' % (solr_updater._hier_parents.cache_info(),))
+    if stats:
+        collected = solr_updater.transform_stats()
+        print('per stage, all repeats (stage, seconds, calls, fields produced):')
+        for stage, v in sorted(collected['stages'].items(), key=lambda x: -x[1]['seconds']):
+            print('  %-35s %8.3f %8s %10s' % (stage, v['seconds'], v['calls'], v['size']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time transform_json_record over a synthetic corpus')
+    parser.add_argument('--corpus', default='objects', choices=sorted(CORPORA))
+    parser.add_argument('--records', type=int, default=1000)
+    parser.add_argument('--objects', type=int, default=2000, help='objects per record (objects corpus)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--stats', action='store_true', default=False,
+                        help='print the per stage timings (adds some overhead)')
+    args = parser.parse_args()
+    run(args.corpus, args.records, args.objects, args.repeat, args.seed, args.stats)